@@ -0,0 +1,173 @@
+"""
+ASGI entry point for the integrated application.
+
+    pip install uvicorn a2wsgi
+    uvicorn asgi_app:application --host 0.0.0.0 --port 5000
+
+Status polls, chunk uploads and downloads are handled on the event loop:
+request bodies are received without holding a thread and written to the
+part file block by block as they arrive, file I/O runs in short thread hops
+and downloads are streamed block by block, so slow clients do not occupy
+request threads. Every other route is passed to the Flask app, which runs
+in a bounded thread pool (WSGI_WORKERS). Processing runs in the worker
+processes of integrated_app (PROCESSING_WORKERS).
+
+Run a single server process: task status and upload sessions are held in
+memory by integrated_app.
+"""
+import asyncio
+import os
+import re
+
+from a2wsgi import WSGIMiddleware
+from itsdangerous import BadSignature
+from werkzeug.http import parse_cookie
+
+from integrated_app import (
+    app, auth_cache, download_target, init_db, open_chunk, processing_status
+)
+
+WSGI_WORKERS = int(os.environ.get('WSGI_WORKERS', 32))
+DOWNLOAD_BLOCK_SIZE = 1024 * 1024
+CHUNK_WRITE_SIZE = 1024 * 1024  # body bytes buffered before each write of a chunk upload
+
+_STATUS = re.compile(r'^/status/([^/]+)$')
+_CHUNK = re.compile(r'^/upload/([^/]+)/chunk/(\d+)$')
+_DOWNLOAD = re.compile(r'^/download/([^/]+?)(?:/(\d+))?$')
+
+wsgi = WSGIMiddleware(app, workers=WSGI_WORKERS)
+_session_serializer = app.session_interface.get_signing_serializer(app)
+
+def _headers(scope):
+    return {name.decode('latin-1').lower(): value.decode('latin-1') for name, value in scope['headers']}
+
+async def _session_user(headers):
+    """User id from the Flask session cookie if it belongs to an active user, else None"""
+    cookie = parse_cookie(headers.get('cookie', '')).get(app.config['SESSION_COOKIE_NAME'])
+    if not cookie:
+        return None
+    try:
+        session = _session_serializer.loads(cookie, max_age=int(app.permanent_session_lifetime.total_seconds()))
+    except BadSignature:
+        return None
+    user_id = session.get('user_id')
+    if user_id is None:
+        return None
+    found, user = auth_cache.peek(user_id)
+    if not found:
+        user = await asyncio.to_thread(auth_cache.get, user_id)
+    return user_id if user and user[1] else None
+
+async def _send_json(send, payload, status=200):
+    body = app.json.dumps(payload).encode('utf-8')
+    await send({
+        'type': 'http.response.start',
+        'status': status,
+        'headers': [(b'content-type', b'application/json'), (b'content-length', str(len(body)).encode())]
+    })
+    await send({'type': 'http.response.body', 'body': body})
+
+async def _receive_chunk(receive, writer):
+    """Write the request body through writer; False if it is too long or the client disconnected"""
+    pending = []
+    size = 0
+    while True:
+        message = await receive()
+        if message['type'] == 'http.disconnect':
+            return False
+        chunk = message.get('body', b'')
+        if len(chunk) > writer.remaining - size:
+            return False
+        pending.append(chunk)
+        size += len(chunk)
+        more = message.get('more_body')
+        if size >= CHUNK_WRITE_SIZE or (size and not more):
+            await asyncio.to_thread(writer.write, b''.join(pending))
+            pending = []
+            size = 0
+        if not more:
+            return True
+
+async def _status(send, task_id):
+    await _send_json(send, processing_status.get(task_id, {'status': 'not_found', 'message': 'Task not found'}))
+
+async def _chunk(receive, send, headers, user_id, upload_id, index):
+    content_length = int(headers['content-length']) if headers.get('content-length', '').isdigit() else None
+    writer, error = await asyncio.to_thread(open_chunk, user_id, upload_id, index, content_length)
+    if not writer:
+        await _send_json(send, *error)
+        return
+    try:
+        complete = await _receive_chunk(receive, writer)
+    except OSError as e:
+        await _send_json(send, *await asyncio.to_thread(writer.error, e))
+        return
+    if not complete:
+        await asyncio.to_thread(writer.close)
+        await _send_json(send, {'error': f'Chunk {index} was truncated'}, 400)
+        return
+    payload, code = await asyncio.to_thread(writer.finish, headers.get('x-chunk-sha256'))
+    await _send_json(send, payload, code)
+
+async def _download(send, task_id, shard):
+    output_file, download_name, error = download_target(task_id, shard)
+    if error:
+        await _send_json(send, *error)
+        return
+    f = await asyncio.to_thread(open, output_file, 'rb')
+    try:
+        size = os.fstat(f.fileno()).st_size
+        await send({
+            'type': 'http.response.start',
+            'status': 200,
+            'headers': [
+                (b'content-type', b'text/csv; charset=utf-8'),
+                (b'content-length', str(size).encode()),
+                (b'content-disposition', f'attachment; filename={download_name}'.encode('latin-1'))
+            ]
+        })
+        while True:
+            block = await asyncio.to_thread(f.read, DOWNLOAD_BLOCK_SIZE)
+            if not block:
+                break
+            await send({'type': 'http.response.body', 'body': block, 'more_body': True})
+        await send({'type': 'http.response.body', 'body': b''})
+    finally:
+        await asyncio.to_thread(f.close)
+
+async def _lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            await asyncio.to_thread(init_db)
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+async def application(scope, receive, send):
+    if scope['type'] == 'lifespan':
+        await _lifespan(receive, send)
+        return
+
+    if scope['type'] == 'http':
+        path = scope['path']
+        method = scope['method']
+        status = _STATUS.match(path) if method == 'GET' else None
+        chunk = _CHUNK.match(path) if method == 'PUT' else None
+        download = _DOWNLOAD.match(path) if method == 'GET' else None
+        if status or chunk or download:
+            headers = _headers(scope)
+            # Unauthenticated requests fall through to Flask for the usual redirect
+            user_id = await _session_user(headers)
+            if user_id is not None:
+                if status:
+                    await _status(send, status.group(1))
+                elif chunk:
+                    await _chunk(receive, send, headers, user_id, chunk.group(1), int(chunk.group(2)))
+                else:
+                    shard = download.group(2)
+                    await _download(send, download.group(1), int(shard) if shard is not None else None)
+                return
+
+    await wsgi(scope, receive, send)
@@ -0,0 +1,181 @@
+"""
+Headless entry point for the duplicate invoice check.
+
+Examples:
+    python duplicate_check_cli.py exports/*.gz --output-dir processed --jobs 8
+    python duplicate_check_cli.py north.gz --stdout > processed_north.csv
+    python duplicate_check_cli.py north.gz --output-dir review --group-columns --clusters --window-days 30 --cluster concat1 --duplicates-only
+"""
+import argparse
+import json
+import os
+import sys
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor
+
+from duplicate_engine import (
+    FULL_NORMALIZATION, RULES, parse_tolerance, process_invoice_file, validate_filters, validate_normalization,
+    validate_rules
+)
+from incremental import process_invoice_delta
+from input_codecs import processed_filename
+
+def output_path_for(input_path, output_dir):
+    """processed_<name>.csv in output_dir, matching the web app naming"""
+    return os.path.join(output_dir, processed_filename(os.path.basename(input_path)))
+
+def run_one(input_path, output_path, filters=None, history_path=None, state_path=None, reference_path=None,
+            reference_rules=None, layout=None, normalization=None):
+    """Process one file ('-' writes to stdout); returns a JSON-serializable result (never raises)"""
+    start = time.perf_counter()
+    result = {'input_file': input_path, 'output_file': output_path}
+    try:
+        if state_path:
+            if output_path == '-':
+                sys.stdout.reconfigure(newline='')
+                output_path = sys.stdout
+            result['summary'] = process_invoice_delta(input_path, output_path, state_path, filters=filters,
+                                                      normalization=normalization)
+        elif output_path == '-':
+            sys.stdout.reconfigure(newline='')
+            result['summary'] = process_invoice_file(input_path, sys.stdout, filters=filters,
+                                                     history_path=history_path, reference_path=reference_path,
+                                                     reference_rules=reference_rules, layout=layout,
+                                                     normalization=normalization)
+            sys.stdout.flush()
+        else:
+            result['summary'] = process_invoice_file(input_path, output_path, filters=filters,
+                                                     history_path=history_path, reference_path=reference_path,
+                                                     reference_rules=reference_rules, layout=layout,
+                                                     normalization=normalization)
+        result['status'] = 'completed'
+    except Exception as e:
+        result['status'] = 'error'
+        result['error'] = str(e)
+        result['traceback'] = traceback.format_exc()
+    result['seconds'] = round(time.perf_counter() - start, 3)
+    return result
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Pierian P2P duplicate invoice check (headless)')
+    parser.add_argument('inputs', nargs='+', help='CSV input files (gzip, zstd, xz, bz2 or uncompressed)')
+    target = parser.add_mutually_exclusive_group(required=True)
+    target.add_argument('--output-dir', help='directory for processed CSV files')
+    target.add_argument('--stdout', action='store_true',
+                        help='write the processed CSV to stdout (single input only); summary goes to stderr')
+    parser.add_argument('--jobs', '-j', type=int, default=os.cpu_count() or 1,
+                        help='number of files processed in parallel (default: number of cores; '
+                             'always 1 with --history)')
+    parser.add_argument('--summary', help='also write the JSON summary to this file')
+    parser.add_argument('--filters', help='JSON file with the row exclusion filters (default: cancelled, DROPSHIP, SCR)')
+    parser.add_argument('--normalization',
+                        help="JSON file with the key field normalization steps, or 'full' for all steps on "
+                             "header_po and primary_vendor_code (default: none)")
+    parser.add_argument('--history', help='key history database: check against and record keys of earlier runs')
+    parser.add_argument('--state', help='incremental state file: only check rows that are new since the last run '
+                                        'with this state (single input only)')
+    parser.add_argument('--reference', help='reference file (e.g. paid-invoices register) to check the inputs against')
+    parser.add_argument('--reference-rules', default=','.join(RULES),
+                        help='comma-separated CONCAT rules compared with the reference (default: all)')
+    parser.add_argument('--group-columns', action='store_true',
+                        help='add a group ID and group size column per CONCAT rule')
+    parser.add_argument('--clusters', action='store_true',
+                        help='add a cluster ID and confidence column linking duplicates across all CONCAT rules')
+    parser.add_argument('--window-days', type=int, metavar='DAYS',
+                        help='time-window rule: mark rows of one vendor with the same amount within DAYS days')
+    parser.add_argument('--amount-tolerance', metavar='AMOUNT',
+                        help="tolerance rule: CONCAT keys match with amounts within AMOUNT ('5') or a percentage ('1%%')")
+    parser.add_argument('--cluster', choices=RULES,
+                        help='order rows so that each duplicate group of this rule is contiguous')
+    parser.add_argument('--duplicates-only', action='store_true',
+                        help='write only rows marked Duplicate by at least one CONCAT rule')
+    args = parser.parse_args(argv)
+    if args.stdout and len(args.inputs) != 1:
+        parser.error('--stdout accepts exactly one input file')
+    if args.output_dir:
+        outputs = {}
+        for path in args.inputs:
+            name = processed_filename(os.path.basename(path))
+            if name in outputs:
+                parser.error(f'{outputs[name]} and {path} would both be written to {name}; '
+                             'rename one or process them in separate runs')
+            outputs[name] = path
+    if args.state and len(args.inputs) != 1:
+        parser.error('--state accepts exactly one input file')
+    if args.state and args.reference:
+        parser.error('--state cannot be combined with --reference')
+    if args.state and (args.group_columns or args.clusters or args.window_days is not None
+                       or args.amount_tolerance is not None or args.cluster or args.duplicates_only):
+        parser.error('--state cannot be combined with --group-columns, --clusters, --window-days, '
+                     '--amount-tolerance, --cluster or --duplicates-only')
+    if args.window_days is not None and args.window_days < 0:
+        parser.error('--window-days must be 0 or more')
+    if args.amount_tolerance is not None:
+        try:
+            parse_tolerance(args.amount_tolerance)
+        except ValueError as e:
+            parser.error(f'--amount-tolerance: {e}')
+    args.layout = {'group_columns': args.group_columns, 'clusters': args.clusters,
+                   'window_days': args.window_days, 'amount_tolerance': args.amount_tolerance,
+                   'cluster_rule': args.cluster, 'duplicates_only': args.duplicates_only}
+    try:
+        args.reference_rules = validate_rules(args.reference_rules.split(','))
+    except ValueError as e:
+        parser.error(f'--reference-rules: {e}')
+    if args.jobs < 1:
+        parser.error('--jobs must be at least 1')
+    if args.filters:
+        try:
+            with open(args.filters, encoding='utf-8') as f:
+                args.filters = validate_filters(json.load(f))
+        except (OSError, ValueError) as e:
+            parser.error(f'--filters: {e}')
+    if args.normalization == 'full':
+        args.normalization = FULL_NORMALIZATION
+    elif args.normalization:
+        try:
+            with open(args.normalization, encoding='utf-8') as f:
+                args.normalization = validate_normalization(json.load(f))
+        except (OSError, ValueError) as e:
+            parser.error(f'--normalization: {e}')
+    return args
+
+def main(argv=None):
+    args = parse_args(argv)
+    start = time.perf_counter()
+
+    if args.stdout:
+        results = [run_one(args.inputs[0], '-', args.filters, args.history, args.state,
+                           args.reference, args.reference_rules, args.layout, args.normalization)]
+    else:
+        os.makedirs(args.output_dir, exist_ok=True)
+        paths = [(p, output_path_for(p, args.output_dir)) for p in args.inputs]
+        # The key history is a single SQLite database that each run reads and
+        # then adds to, so history runs go one at a time, in input order
+        jobs = 1 if args.history else min(args.jobs, len(paths))
+        if jobs == 1:
+            results = [run_one(i, o, args.filters, args.history, args.state, args.reference, args.reference_rules,
+                               args.layout, args.normalization)
+                       for i, o in paths]
+        else:
+            with ProcessPoolExecutor(max_workers=jobs) as pool:
+                results = list(pool.map(run_one, *zip(*paths), [args.filters] * len(paths),
+                                        [args.history] * len(paths), [args.state] * len(paths),
+                                        [args.reference] * len(paths), [args.reference_rules] * len(paths),
+                                        [args.layout] * len(paths), [args.normalization] * len(paths)))
+
+    report = {
+        'files': results,
+        'failed': sum(1 for r in results if r['status'] != 'completed'),
+        'total_seconds': round(time.perf_counter() - start, 3)
+    }
+    text = json.dumps(report, indent=2)
+    print(text, file=sys.stderr if args.stdout else sys.stdout)
+    if args.summary:
+        with open(args.summary, 'w', encoding='utf-8') as f:
+            f.write(text)
+    return 1 if report['failed'] else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,1728 @@
+"""Duplicate invoice check engine (no Flask dependency)"""
+import csv
+import hashlib
+import heapq
+import io
+import math
+import os
+import pickle
+import re
+import tempfile
+import unicodedata
+from array import array
+from concurrent.futures import ProcessPoolExecutor
+from datetime import date, datetime
+from functools import lru_cache, partial
+from itertools import chain, count, islice, repeat
+from operator import attrgetter, itemgetter
+
+from input_codecs import decompress_stream, open_input
+
+# Required columns for output
+REQUIRED_COLUMNS = [
+    'invoice_creation_date', 'payee_name', 'primary_vendor_code',
+    'barcode', 'invoice_status', 'header_po', 'invoice_no',
+    'invoice_date', 'invoice_source_name', 'invoice_quantity',
+    'invoice_amount'
+]
+
+CONCAT1 = 'CONCAT 1(Header PO + Invoice Date + Invoice Amount)'
+CONCAT2 = 'CONCAT 2(Primary Vendor Code + Invoice Year + Invoice Amount)'
+CONCAT3 = 'CONCAT 3(Header PO + Invoice Amount)'
+
+OUTPUT_COLUMNS = [
+    'invoice_source_name', 'primary_vendor_code', 'payee_name',
+    'invoice_status', 'invoice_creation_date', 'barcode',
+    'header_po', 'invoice_no', 'invoice_date', 'invoice_year',
+    'invoice_quantity', 'invoice_amount', 'invoice_amount_after_removing_decimal',
+    CONCAT1, f'{CONCAT1} Remarks',
+    CONCAT2, f'{CONCAT2} Remarks',
+    CONCAT3, f'{CONCAT3} Remarks'
+]
+
+# Output columns added when uploads are checked against the key history or a reference file
+HISTORY_COLUMN = 'History Remarks'
+REFERENCE_COLUMN = 'Reference Remarks'
+
+# Output column added by the window_days layout option (see TimeWindows)
+WINDOW_COLUMN = 'Time Window Remarks'
+
+# Output column added by the amount_tolerance layout option (see AmountTolerance)
+TOLERANCE_COLUMN = 'Amount Tolerance Remarks'
+
+# Annotation columns whose values mark a row as a duplicate; empty or
+# REMARKS[0] means no match
+REMARK_COLUMNS = (HISTORY_COLUMN, REFERENCE_COLUMN, WINDOW_COLUMN, TOLERANCE_COLUMN)
+
+# Output columns added by the group_columns layout option: group ID and
+# group size per CONCAT rule
+GROUP_COLUMNS = [
+    'CONCAT 1 Group ID', 'CONCAT 1 Group Size',
+    'CONCAT 2 Group ID', 'CONCAT 2 Group Size',
+    'CONCAT 3 Group ID', 'CONCAT 3 Group Size'
+]
+
+# Output columns added by the clusters layout option (see KeyClusters)
+CLUSTER_COLUMNS = ['Cluster ID', 'Cluster Confidence']
+
+# Weight of a match under each CONCAT rule in the cluster confidence of a
+# row; the weights of the rules that flag the row are combined as
+# 1 - (1 - w1) * (1 - w2) ...
+CLUSTER_RULE_WEIGHTS = (0.9, 0.5, 0.7)
+
+# Output layout options (see validate_layout)
+LAYOUT_OPTIONS = ('group_columns', 'clusters', 'window_days', 'amount_tolerance', 'cluster_rule', 'duplicates_only')
+
+# Format version of the key counts saved by a dry run (count_invoice_data)
+COUNTS_VERSION = 1
+
+# Exclusion filters, applied to the raw CSV record before a row is built. Each
+# filter drops rows whose column value equals one of 'equals' or ends with
+# one of 'endswith' (case-insensitive); the first matching filter is counted
+# in summary['filtered'].
+DEFAULT_FILTERS = [
+    {'name': 'cancelled', 'column': 'invoice_status', 'equals': ['cancelled']},
+    {'name': 'dropship', 'column': 'invoice_source_name', 'equals': ['DROPSHIP']},
+    {'name': 'scr', 'column': 'invoice_no', 'endswith': ['SCR']},
+]
+
+# Key field normalization (see validate_normalization): fields of the CONCAT
+# keys that can be normalized and the steps, always applied in this order
+NORMALIZED_FIELDS = ('header_po', 'primary_vendor_code')
+NORMALIZATION_STEPS = ('nfkc', 'strip', 'casefold', 'leading_zeros', 'punctuation', 'whitespace')
+
+# Every step on every normalized field
+FULL_NORMALIZATION = {field: list(NORMALIZATION_STEPS) for field in NORMALIZED_FIELDS}
+
+# Distinct values memoized per normalized high-cardinality field (header_po)
+NORMALIZE_CACHE_SIZE = 65536
+
+# Distinct values memoized for parsed invoice dates and for each equals filter
+# (columns that may have many distinct values, so the caches are bounded)
+VALUE_CACHE_SIZE = 65536
+
+# Input columns in InvoiceRow constructor order
+_ROW_FIELDS = (
+    'invoice_source_name', 'primary_vendor_code', 'payee_name',
+    'invoice_status', 'invoice_creation_date', 'barcode',
+    'header_po', 'invoice_no', 'invoice_date', 'invoice_quantity', 'invoice_amount'
+)
+
+# Remarks are kept as bit flags on each row: bit 0 CONCAT 1, bit 1 CONCAT 2, bit 2 CONCAT 3
+DUPLICATE_FLAGS = (1, 2, 4)
+REMARKS = ('Non Duplicate', 'Duplicate')
+
+class InvoiceRow:
+    """
+    One processed row with a fixed layout.
+
+    Output values come from output_values() in OUTPUT_COLUMNS order,
+    followed by the values of optional extra columns (extra); the remarks
+    are derived from flags. Rows also support row[column] and
+    row.get(column) with OUTPUT_COLUMNS names, and as_dict().
+    """
+    __slots__ = (
+        'invoice_source_name', 'primary_vendor_code', 'payee_name',
+        'invoice_status', 'invoice_creation_date', 'barcode',
+        'header_po', 'invoice_no', 'invoice_date', 'invoice_year',
+        'invoice_quantity', 'invoice_amount', 'invoice_amount_after_removing_decimal',
+        'concat1', 'concat2', 'concat3', 'flags', 'extra'
+    )
+
+    def __init__(self, invoice_source_name, primary_vendor_code, payee_name,
+                 invoice_status, invoice_creation_date, barcode,
+                 header_po, invoice_no, invoice_date, invoice_quantity, invoice_amount):
+        self.invoice_source_name = invoice_source_name
+        self.primary_vendor_code = primary_vendor_code
+        self.payee_name = payee_name
+        self.invoice_status = invoice_status
+        self.invoice_creation_date = invoice_creation_date
+        self.barcode = barcode
+        self.header_po = header_po
+        self.invoice_no = invoice_no
+        self.invoice_date = invoice_date
+        self.invoice_year = ''
+        self.invoice_quantity = invoice_quantity
+        self.invoice_amount = invoice_amount
+        self.invoice_amount_after_removing_decimal = ''
+        self.concat1 = ''
+        self.concat2 = ''
+        self.concat3 = ''
+        self.flags = 0
+        self.extra = ()
+
+    def output_values(self):
+        flags = self.flags
+        return (
+            self.invoice_source_name, self.primary_vendor_code, self.payee_name,
+            self.invoice_status, self.invoice_creation_date, self.barcode,
+            self.header_po, self.invoice_no, self.invoice_date, self.invoice_year,
+            self.invoice_quantity, self.invoice_amount, self.invoice_amount_after_removing_decimal,
+            self.concat1, REMARKS[flags & 1],
+            self.concat2, REMARKS[(flags >> 1) & 1],
+            self.concat3, REMARKS[(flags >> 2) & 1]
+        ) + self.extra
+
+    def as_dict(self):
+        return dict(zip(OUTPUT_COLUMNS, self.output_values()))
+
+    def __getitem__(self, column):
+        return self.output_values()[_OUTPUT_INDEX[column]]
+
+    def get(self, column, default=None):
+        index = _OUTPUT_INDEX.get(column)
+        return default if index is None else self.output_values()[index]
+
+    def __repr__(self):
+        return f'InvoiceRow({self.as_dict()!r})'
+
+_OUTPUT_INDEX = {col: i for i, col in enumerate(OUTPUT_COLUMNS)}
+
+class ValueDictionary(dict):
+    """
+    Dictionary encoding for a low-cardinality column.
+
+    d[value] returns function(value), computed once per distinct value; the
+    default function returns the first instance seen, so every row shares
+    one copy of each distinct string.
+    """
+
+    def __init__(self, function=None):
+        super().__init__()
+        self.function = function
+
+    def __missing__(self, value):
+        result = self[value] = self.function(value) if self.function else value
+        return result
+
+def _no_progress(message, progress):
+    pass
+
+# Input is decoded in blocks of about READ_BLOCK_SIZE bytes; a line that is
+# not valid in the input encoding is decoded as FALLBACK_ENCODING (Latin-1
+# maps every byte, so it never fails)
+READ_BLOCK_SIZE = 1024 * 1024
+FALLBACK_ENCODING = 'latin-1'
+
+def read_records(stream, encoding='utf-8'):
+    """
+    Yield raw CSV records (lists) from a binary stream, the header first.
+
+    Blocks without quotes or bare carriage returns are split with
+    str.split; the csv module only parses blocks that need it.
+    """
+    binary = decompress_stream(stream)
+    if not _ascii_compatible(encoding):
+        text = io.TextIOWrapper(binary, encoding=encoding, newline='')
+        try:
+            yield from csv.reader(text)
+        finally:
+            text.detach()
+        return
+
+    blocks = _text_blocks(binary, encoding)
+    for text in blocks:
+        if '\r' in text and '"' not in text:
+            text = text.replace('\r\n', '\n')
+        if '"' in text or '\r' in text:
+            # Quoted fields may hold commas and line breaks: full csv
+            # semantics. strict raises if a quoted field is still open at
+            # the end of the block (or a quote is misplaced); parsed counts
+            # the records produced until then.
+            parsed = count()
+            try:
+                yield from map(itemgetter(0), zip(csv.reader(io.StringIO(text, newline=''), strict=True), parsed))
+            except csv.Error:
+                yield from _open_records(text, blocks, next(parsed))
+        else:
+            lines = text.split('\n')
+            if not lines[-1]:
+                lines.pop()
+            if '\n\n' in text or not lines[0]:
+                # Blank lines are empty records, as in csv.reader
+                for line in lines:
+                    yield line.split(',') if line else []
+            else:
+                yield from map(str.split, lines, repeat(','))
+
+def _ascii_compatible(encoding):
+    """True if commas, quotes and line breaks are single ASCII bytes in encoding"""
+    return ',"\r\n'.encode(encoding) == b',"\r\n'
+
+def _text_blocks(binary, encoding):
+    """Decoded blocks of a binary stream, each ending with a complete line"""
+    rest = b''
+    while True:
+        block = binary.read(READ_BLOCK_SIZE)
+        if not block:
+            break
+        end = block.rfind(b'\n') + 1
+        if not end:
+            rest += block
+            continue
+        yield _decode(rest + block[:end], encoding)
+        rest = block[end:]
+    if rest:
+        yield _decode(rest, encoding)
+
+def _decode(data, encoding):
+    try:
+        return data.decode(encoding)
+    except UnicodeDecodeError:
+        return ''.join(_decode_line(line, encoding) for line in data.splitlines(keepends=True))
+
+def _decode_line(line, encoding):
+    try:
+        return line.decode(encoding)
+    except UnicodeDecodeError:
+        return line.decode(FALLBACK_ENCODING)
+
+def _open_records(text, blocks, skip):
+    """
+    Records of text after the first skip, parsed by the csv module without
+    strict and continued into the following blocks until the record open
+    at the end of text is complete.
+    """
+    # Split like a text stream with newline='': at \r, \n and \r\n
+    lines = io.StringIO(text, newline='').readlines()
+    line_count = len(lines)
+
+    def following_lines():
+        nonlocal line_count
+        for following in blocks:
+            following = io.StringIO(following, newline='').readlines()
+            line_count += len(following)
+            yield from following
+
+    reader = csv.reader(chain(lines, following_lines()))
+    for record in islice(reader, skip, None):
+        yield record
+        if reader.line_num >= line_count:
+            return
+
+def read_header(path):
+    """Return the CSV header of a file as a list of column names"""
+    with open_input(path) as stream:
+        records = read_records(stream)
+        try:
+            return next(records, [])
+        finally:
+            records.close()
+
+def validate_filters(filters):
+    """Raise ValueError unless filters is a list of filter dicts (see DEFAULT_FILTERS)"""
+    if not isinstance(filters, list):
+        raise ValueError('Filters must be a list')
+    names = set()
+    for spec in filters:
+        if not isinstance(spec, dict) or not spec.get('name') or not spec.get('column'):
+            raise ValueError('Each filter needs a name and a column')
+        if spec['name'] in names:
+            raise ValueError(f"Duplicate filter name '{spec['name']}'")
+        names.add(spec['name'])
+        kinds = [kind for kind in ('equals', 'endswith') if kind in spec]
+        if len(kinds) != 1:
+            raise ValueError(f"Filter '{spec['name']}' needs exactly one of equals or endswith")
+        values = spec[kinds[0]]
+        if not isinstance(values, list) or not values or not all(isinstance(v, str) and v for v in values):
+            raise ValueError(f"Filter '{spec['name']}' {kinds[0]} must be a list of non-empty strings")
+    return filters
+
+def validate_normalization(normalization):
+    """
+    Raise ValueError unless normalization is None or a dict of
+    NORMALIZED_FIELDS -> list of NORMALIZATION_STEPS; returns it.
+
+    nfkc: Unicode NFKC (full-width and compatibility forms to plain ones)
+    strip: remove surrounding whitespace
+    casefold: case-insensitive form (lower case, ß -> ss, ...)
+    leading_zeros: remove the leading zeros of each number (PO-0001 -> PO-1)
+    punctuation: remove punctuation and symbols (anything but letters,
+        digits and whitespace)
+    whitespace: remove all whitespace
+    """
+    if normalization is None:
+        return None
+    if not isinstance(normalization, dict):
+        raise ValueError('Normalization must be a dict of field -> list of steps')
+    for field, steps in normalization.items():
+        if field not in NORMALIZED_FIELDS:
+            raise ValueError(f"Cannot normalize '{field}'; fields are {', '.join(NORMALIZED_FIELDS)}")
+        if not isinstance(steps, list) or any(step not in NORMALIZATION_STEPS for step in steps):
+            raise ValueError(f"Normalization of '{field}' must be a list of {', '.join(NORMALIZATION_STEPS)}")
+    return normalization
+
+def compile_normalizer(steps):
+    """
+    normalize(value) for a list of NORMALIZATION_STEPS, or None if there
+    are none. NFKC, strip and casefold are str methods; leading zeros,
+    punctuation and whitespace are removed by one precompiled regex in a
+    single pass.
+    """
+    functions = []
+    if 'nfkc' in steps:
+        functions.append(partial(unicodedata.normalize, 'NFKC'))
+    if 'strip' in steps:
+        functions.append(str.strip)
+    if 'casefold' in steps:
+        functions.append(str.casefold)
+    removals = []
+    if 'leading_zeros' in steps:
+        removals.append(r'(?<!\d)0+(?=\d)')
+    if 'punctuation' in steps:
+        removals.append(r'[^\w\s]|_')
+    if 'whitespace' in steps:
+        removals.append(r'\s+')
+    if removals:
+        functions.append(partial(re.compile('|'.join(removals)).sub, ''))
+    if not functions:
+        return None
+    if len(functions) == 1:
+        return functions[0]
+
+    def normalize(value):
+        for function in functions:
+            value = function(value)
+        return value
+    return normalize
+
+def _normalizers(normalization):
+    """Field -> normalize(value) for the fields normalization changes"""
+    normalizers = {}
+    for field, steps in (validate_normalization(normalization) or {}).items():
+        normalize = compile_normalizer(steps)
+        if normalize:
+            normalizers[field] = normalize
+    return normalizers
+
+def _compile_filter(spec):
+    """test(value) for a filter; equals tests are memoized per distinct value (up to VALUE_CACHE_SIZE)"""
+    if 'equals' in spec:
+        values = {value.casefold() for value in spec['equals']}
+        return lru_cache(VALUE_CACHE_SIZE)(lambda value: (value or '').casefold() in values)
+    suffixes = tuple(value.casefold() for value in spec['endswith'])
+    width = max(map(len, suffixes))
+    # casefold never shortens a character, so only the last width characters matter
+    return lambda value: (value or '')[-width:].casefold().endswith(suffixes)
+
+def prepare_rows(rows, stats, progress=_no_progress, filters=None, normalization=None):
+    """
+    Apply the filters and transformations to input rows (dicts keyed by
+    the input CSV headers); see prepare_records.
+    """
+    filters = DEFAULT_FILTERS if filters is None else validate_filters(filters)
+    columns = list(REQUIRED_COLUMNS)
+    columns += [spec['column'] for spec in filters if spec['column'] not in columns]
+
+    def records():
+        yield columns
+        for row in rows:
+            yield [row.get(col, '') for col in columns]
+
+    return prepare_records(records(), stats, progress, filters, normalization)
+
+def prepare_records(records, stats, progress=_no_progress, filters=None, normalization=None):
+    """
+    Apply the filters and transformations to raw CSV records, the header
+    record first.
+
+    The filters (default DEFAULT_FILTERS) only look at their own column of
+    the raw record, so dropped rows are never built. Yields an InvoiceRow
+    with the transformed amount and date, the invoice year and the CONCAT
+    keys, built from the normalized key fields (see
+    validate_normalization), for every row that passes. stats['total_input_lines'] and
+    stats['lines_processed'] are incremented as rows are read, and
+    stats['filtered'] counts dropped rows per filter.
+    """
+    filters = DEFAULT_FILTERS if filters is None else validate_filters(filters)
+    filtered = stats.setdefault('filtered', {})
+    for spec in filters:
+        filtered.setdefault(spec['name'], 0)
+
+    records = iter(records)
+    header = next(records, None)
+    if header is None:
+        return
+    positions = {col: i for i, col in enumerate(header)}
+    # Columns missing from the header read an empty value appended at the end
+    blank = len(header)
+    needed = list(_ROW_FIELDS) + [spec['column'] for spec in filters]
+    width = blank + 1 if any(col not in positions for col in needed) else blank
+    fields = itemgetter(*[positions.get(col, blank) for col in _ROW_FIELDS])
+    tests = [(spec['name'], positions.get(spec['column'], blank), _compile_filter(spec)) for spec in filters]
+
+    # Shared instances for the low-cardinality columns (source, vendor,
+    # payee, status; rows with one invoice_date share its year), and parsed
+    # dates through a bounded cache. Vendor codes are normalized once per
+    # distinct value; PO numbers through a bounded cache.
+    normalizers = _normalizers(normalization)
+    normalize_po = normalizers.get('header_po')
+    normalize_vendor = normalizers.get('primary_vendor_code')
+    if normalize_po:
+        normalize_po = lru_cache(NORMALIZE_CACHE_SIZE)(normalize_po)
+    if normalize_vendor:
+        normalize_vendor = ValueDictionary(normalize_vendor).__getitem__
+    source_names = ValueDictionary()
+    vendors = ValueDictionary()
+    payees = ValueDictionary()
+    statuses = ValueDictionary()
+    dates = lru_cache(VALUE_CACHE_SIZE)(_parse_invoice_date)
+
+    for record in records:
+        if not record:
+            continue  # blank line, skipped like csv.DictReader does
+        stats['total_input_lines'] += 1
+
+        # Update progress periodically
+        total_input_lines = stats['total_input_lines']
+        if total_input_lines % 50000 == 0:
+            percent = 30 + min((total_input_lines / max(total_input_lines + 100000, 1)) * 40, 40)
+            progress(f'Processed {total_input_lines:,} input lines...', int(percent))
+
+        if len(record) < width:
+            record += [''] * (width - len(record))
+        elif width > blank:
+            record[blank] = ''
+
+        # Filter logic: by default exclude cancelled, Dropship, and SCR invoices
+        for name, position, test in tests:
+            if test(record[position]):
+                filtered[name] += 1
+                break
+        else:
+            stats['lines_processed'] += 1
+
+            (invoice_source, vendor, payee, invoice_status, created, barcode,
+             header_po, invoice_no, invoice_date, quantity, amount) = fields(record)
+            yield transform_row(InvoiceRow(
+                source_names[invoice_source], vendors[vendor], payees[payee],
+                statuses[invoice_status], created, barcode,
+                header_po, invoice_no, invoice_date, quantity, amount
+            ), dates, normalize_po, normalize_vendor)
+
+def _parse_invoice_date(date_str):
+    """(trimmed date, invoice year) for a raw invoice_date value"""
+    trimmed_date = trim_date_format(date_str)
+    return trimmed_date, extract_year_from_date(trimmed_date)
+
+def transform_row(row, dates=None, normalize_po=None, normalize_vendor=None):
+    """
+    Set the transformed amount, trimmed date, invoice year and CONCAT keys
+    on an InvoiceRow. dates is an optional cached _parse_invoice_date;
+    normalize_po and normalize_vendor, if given, normalize header_po and
+    primary_vendor_code in the keys only, so the row keeps the raw values.
+    """
+    # Transform amount
+    try:
+        amount = float(row.invoice_amount or '0')
+        amount_after_decimal = int(amount // 10)
+        row.invoice_amount_after_removing_decimal = str(amount_after_decimal)
+    except (ValueError, TypeError):
+        row.invoice_amount_after_removing_decimal = '0'
+
+    # Trim time portion from invoice_date and extract year
+    if dates is None:
+        trimmed_date, year = _parse_invoice_date(row.invoice_date)
+    else:
+        trimmed_date, year = dates(row.invoice_date)
+
+    # Update the invoice_date to the trimmed format (YYYY-MM-DD)
+    row.invoice_date = trimmed_date
+
+    # Add invoice_year as a separate column
+    row.invoice_year = year
+
+    # Create CONCAT keys (using trimmed date)
+    header_po = row.header_po
+    vendor = row.primary_vendor_code
+    if normalize_po:
+        header_po = normalize_po(header_po)
+    if normalize_vendor:
+        vendor = normalize_vendor(vendor)
+    amount_str = row.invoice_amount_after_removing_decimal
+
+    row.concat1 = f"{header_po}{trimmed_date}{amount_str}"
+    row.concat2 = f"{vendor}{year}{amount_str}"
+    row.concat3 = f"{header_po}{amount_str}"
+    return row
+
+def count_keys(rows):
+    """Count occurrences of each CONCAT key; returns (concat1, concat2, concat3) count dicts"""
+    concat1_counts = {}
+    concat2_counts = {}
+    concat3_counts = {}
+
+    for row in rows:
+        concat1 = row.concat1
+        concat2 = row.concat2
+        concat3 = row.concat3
+
+        concat1_counts[concat1] = concat1_counts.get(concat1, 0) + 1
+        concat2_counts[concat2] = concat2_counts.get(concat2, 0) + 1
+        concat3_counts[concat3] = concat3_counts.get(concat3, 0) + 1
+
+    return concat1_counts, concat2_counts, concat3_counts
+
+def merge_counts(target, counts):
+    """Add each count dict in counts into the matching dict in target"""
+    for target_counts, shard_counts in zip(target, counts):
+        for key, count in shard_counts.items():
+            target_counts[key] = target_counts.get(key, 0) + count
+    return target
+
+def add_remarks(row, counts):
+    """Set the Duplicate flag bits of row for each CONCAT rule"""
+    concat1_counts, concat2_counts, concat3_counts = counts
+    row.flags = (
+        (concat1_counts[row.concat1] > 1) |
+        (concat2_counts[row.concat2] > 1) << 1 |
+        (concat3_counts[row.concat3] > 1) << 2
+    )
+    return row
+
+def build_summary(stats, counts):
+    concat1_counts, concat2_counts, concat3_counts = counts
+    return {
+        'total_input_lines': stats['total_input_lines'],
+        'lines_processed': stats['lines_processed'],
+        'concat1_duplicates': _duplicate_rows(concat1_counts),
+        'concat2_duplicates': _duplicate_rows(concat2_counts),
+        'concat3_duplicates': _duplicate_rows(concat3_counts),
+        'filtered': dict(stats.get('filtered', {}))
+    }
+
+def merge_stats(target, stats):
+    """Add line counts and per-filter drop counts from stats into target"""
+    target['total_input_lines'] += stats['total_input_lines']
+    target['lines_processed'] += stats['lines_processed']
+    filtered = target.setdefault('filtered', {})
+    for name, count in stats.get('filtered', {}).items():
+        filtered[name] = filtered.get(name, 0) + count
+    return target
+
+def _duplicate_rows(counts):
+    """Number of rows whose key occurs more than once"""
+    return sum(count for count in counts.values() if count > 1)
+
+RULES = ('concat1', 'concat2', 'concat3')
+RULE_LABELS = ('CONCAT 1', 'CONCAT 2', 'CONCAT 3')
+
+def history_statistics(counts, matches):
+    """Rows per CONCAT rule whose key was already seen in an earlier upload"""
+    return {rule: sum(rule_counts[key] for key in rule_matches)
+            for rule, rule_counts, rule_matches in zip(RULES, counts, matches)}
+
+def add_history_remarks(row, matches):
+    """Append the History Remarks value: each rule whose key was seen before, with the upload it was first seen in"""
+    remarks = []
+    for label, rule_matches, key in zip(RULE_LABELS, matches, (row.concat1, row.concat2, row.concat3)):
+        seen = rule_matches.get(key)
+        if seen:
+            remarks.append(f'{label}: {seen}')
+    row.extra += ('; '.join(remarks),)
+    return row
+
+def validate_rules(rules):
+    """Raise ValueError unless rules is a non-empty list of RULES names"""
+    rules = list(rules)
+    if not rules or any(rule not in RULES for rule in rules):
+        raise ValueError(f"Rules must be one or more of {', '.join(RULES)}")
+    return rules
+
+def build_reference(input_path, rules=None, filters=None, normalization=None):
+    """
+    Build side of the reference join: the CONCAT keys of a reference file
+    (e.g. the paid-invoices register), one set per rule in rules (default
+    all) and None for the others. Memory grows with the reference keys only.
+    """
+    rules = RULES if rules is None else validate_rules(rules)
+    reference = tuple(set() if rule in rules else None for rule in RULES)
+    stats = {'total_input_lines': 0, 'lines_processed': 0}
+    with open_input(input_path) as stream:
+        for row in prepare_records(read_records(stream), stats, filters=filters, normalization=normalization):
+            for rule_keys, key in zip(reference, (row.concat1, row.concat2, row.concat3)):
+                if rule_keys is not None:
+                    rule_keys.add(key)
+    return reference
+
+def reference_statistics(input_path, counts, reference):
+    """Reference keys and rows of counts matching the reference, per compared rule"""
+    result = {'file': os.path.basename(input_path), 'keys': {}, 'rows': {}}
+    for rule, rule_counts, rule_keys in zip(RULES, counts, reference):
+        if rule_keys is not None:
+            result['keys'][rule] = len(rule_keys)
+            result['rows'][rule] = sum(count for key, count in rule_counts.items() if key in rule_keys)
+    return result
+
+def add_reference_remarks(row, reference):
+    """Probe side of the reference join: append the Reference Remarks value"""
+    labels = [label for label, rule_keys, key in zip(RULE_LABELS, reference, (row.concat1, row.concat2, row.concat3))
+              if rule_keys is not None and key in rule_keys]
+    row.extra += (f"Duplicate of reference ({', '.join(labels)})" if labels else REMARKS[0],)
+    return row
+
+def group_statistics(counts):
+    """Duplicate group count and group size distribution ({size: groups}) per CONCAT rule"""
+    result = {}
+    for rule, rule_counts in zip(RULES, counts):
+        sizes = {}
+        for count in rule_counts.values():
+            if count > 1:
+                sizes[count] = sizes.get(count, 0) + 1
+        result[rule] = {
+            'duplicate_groups': sum(sizes.values()),
+            'group_sizes': {str(size): sizes[size] for size in sorted(sizes)}
+        }
+    return result
+
+class DuplicateAnalytics:
+    """
+    Streaming aggregates over rows that already carry remarks: amount at
+    risk, duplicate amount per vendor and duplicate rows per invoice year.
+    """
+
+    def __init__(self):
+        self.rows_any_duplicate = 0
+        self.amount_at_risk = 0.0
+        self.rule_amounts = [0.0, 0.0, 0.0]
+        self.vendor_amounts = {}
+        self.year_counts = {}
+
+    def add(self, row):
+        flags = row.flags
+        if not flags:
+            return row
+        try:
+            amount = float(row.invoice_amount or 0)
+        except (ValueError, TypeError):
+            amount = 0.0
+
+        self.rows_any_duplicate += 1
+        self.amount_at_risk += amount
+        vendor = row.primary_vendor_code
+        self.vendor_amounts[vendor] = self.vendor_amounts.get(vendor, 0.0) + amount
+        year_counts = self.year_counts.get(row.invoice_year)
+        if year_counts is None:
+            year_counts = self.year_counts[row.invoice_year] = [0, 0, 0]
+        for i, flag in enumerate(DUPLICATE_FLAGS):
+            if flags & flag:
+                self.rule_amounts[i] += amount
+                year_counts[i] += 1
+        return row
+
+    def merge(self, other):
+        self.rows_any_duplicate += other.rows_any_duplicate
+        self.amount_at_risk += other.amount_at_risk
+        self.rule_amounts = [a + b for a, b in zip(self.rule_amounts, other.rule_amounts)]
+        for vendor, amount in other.vendor_amounts.items():
+            self.vendor_amounts[vendor] = self.vendor_amounts.get(vendor, 0.0) + amount
+        for year, year_counts in other.year_counts.items():
+            mine = self.year_counts.setdefault(year, [0, 0, 0])
+            for i, count in enumerate(year_counts):
+                mine[i] += count
+        return self
+
+    def as_dict(self, counts, top_vendors=10):
+        groups = group_statistics(counts)
+        for rule, amount in zip(RULES, self.rule_amounts):
+            groups[rule]['duplicate_amount'] = round(amount, 2)
+        top = heapq.nlargest(top_vendors, self.vendor_amounts.items(), key=lambda item: item[1])
+        return {
+            'rules': groups,
+            'rows_any_duplicate': self.rows_any_duplicate,
+            'amount_at_risk': round(self.amount_at_risk, 2),
+            'top_vendors': [{'primary_vendor_code': vendor, 'duplicate_amount': round(amount, 2)}
+                            for vendor, amount in top],
+            'duplicates_by_year': {year: dict(zip(RULES, year_counts))
+                                   for year, year_counts in sorted(self.year_counts.items())}
+        }
+
+class DuplicateCheck:
+    """
+    Duplicate check over an iterable of input rows.
+
+    Iterating yields the processed rows as InvoiceRow records (remarks
+    included). rows are dicts, or raw CSV records (header first) when raw
+    is true; filters and normalization work as in prepare_records. The
+    input is consumed on first use of the iterator or of summary; a
+    DuplicateCheck can be iterated once. summary['analytics'] is filled in
+    once all rows have been iterated.
+    """
+
+    def __init__(self, rows, progress=None, filters=None, raw=False, normalization=None):
+        self._rows = rows
+        self._progress = progress or _no_progress
+        self._filters = filters
+        self._normalization = normalization
+        self._raw = raw
+        self._processed_rows = None
+        self._counts = None
+        self._summary = None
+
+    @property
+    def summary(self):
+        """Dict of line and duplicate counts"""
+        if self._summary is None:
+            self._prepare()
+        return self._summary
+
+    @property
+    def counts(self):
+        """(concat1, concat2, concat3) key count dicts"""
+        if self._summary is None:
+            self._prepare()
+        return self._counts
+
+    def __iter__(self):
+        if self._summary is None:
+            self._prepare()
+        if self._processed_rows is None:
+            raise RuntimeError('DuplicateCheck rows have already been consumed')
+        processed_rows, self._processed_rows = self._processed_rows, None
+        counts = self._counts
+        analytics = DuplicateAnalytics()
+
+        for row in processed_rows:
+            yield analytics.add(add_remarks(row, counts))
+
+        self._summary['analytics'] = analytics.as_dict(counts)
+
+    def key_clusters(self):
+        """KeyClusters over the processed rows; call before iterating"""
+        return self._scan(KeyClusters(self.counts))
+
+    def time_windows(self, days):
+        """TimeWindows over the processed rows; call before iterating"""
+        return self._scan(TimeWindows(days, self.counts))
+
+    def amount_tolerance(self, tolerance):
+        """AmountTolerance over the processed rows; call before iterating"""
+        return self._scan(AmountTolerance(tolerance))
+
+    def _scan(self, scanner):
+        """Pass the processed rows to scanner.add() and return scanner.finish()"""
+        if self._summary is None:
+            self._prepare()
+        if self._processed_rows is None:
+            raise RuntimeError('DuplicateCheck rows have already been consumed')
+        for row in self._processed_rows:
+            scanner.add(row)
+        return scanner.finish()
+
+    def _prepare(self):
+        progress = self._progress
+        progress('Applying filters and processing data...', 30)
+
+        stats = {'total_input_lines': 0, 'lines_processed': 0}
+        prepare = prepare_records if self._raw else prepare_rows
+        processed_rows = list(prepare(self._rows, stats, progress, self._filters, self._normalization))
+
+        progress('Detecting duplicates...', 85)
+        self._counts = count_keys(processed_rows)
+        self._processed_rows = processed_rows
+        self._summary = build_summary(stats, self._counts)
+
+def check_duplicates(rows, progress=None, filters=None, normalization=None):
+    """
+    Run the duplicate check over rows, an iterable of dicts or a binary
+    stream of (optionally compressed) CSV. progress(message, percent) is called
+    as the stages advance. filters replaces DEFAULT_FILTERS; normalization
+    normalizes key fields (see validate_normalization). Returns a
+    DuplicateCheck.
+    """
+    if hasattr(rows, 'read'):
+        return DuplicateCheck(read_records(rows), progress, filters, raw=True, normalization=normalization)
+    return DuplicateCheck(rows, progress, filters, normalization=normalization)
+
+def write_output(rows, output_csv, header=True, extra_columns=(), order=None):
+    """
+    Write processed InvoiceRows to a path or text file object.
+
+    extra_columns names the values rows carry in extra. order is an
+    optional function(rows) returning their output values in the order to
+    write (see cluster_rows); by default rows are written as they come.
+    Nothing is written when there are no rows. Returns True if rows were
+    written.
+    """
+    rows = iter(rows)
+    first_row = next(rows, None)
+    if first_row is None:
+        return False
+    rows = chain([first_row], rows)
+    values = order(rows) if order else map(InvoiceRow.output_values, rows)
+
+    if isinstance(output_csv, str):
+        with open(output_csv, 'w', newline='', encoding='utf-8') as f:
+            _write_rows(f, values, header, extra_columns)
+    else:
+        _write_rows(output_csv, values, header, extra_columns)
+    return True
+
+def _write_rows(f, values, header, extra_columns=()):
+    writer = csv.writer(f)
+    if header:
+        writer.writerow(OUTPUT_COLUMNS + list(extra_columns))
+    writer.writerows(values)
+
+def validate_layout(layout):
+    """
+    Raise ValueError unless layout is a dict of output layout options;
+    returns it ({} for None).
+
+    group_columns: add GROUP_COLUMNS (stable group ID and group size per rule)
+    clusters: add CLUSTER_COLUMNS (cluster across all rules, see KeyClusters)
+    window_days: a number of days; add WINDOW_COLUMN (same vendor and
+        amount within that many days, see TimeWindows)
+    amount_tolerance: an amount ('5') or percentage ('1%'); add
+        TOLERANCE_COLUMN (CONCAT rules with amounts that close, see
+        AmountTolerance)
+    cluster_rule: a RULES name; write the rows of each duplicate group of
+        that rule next to each other (see cluster_rows)
+    duplicates_only: write only rows marked Duplicate by at least one
+        CONCAT rule or remarks column (REMARK_COLUMNS)
+    """
+    if layout is None:
+        return {}
+    if not isinstance(layout, dict):
+        raise ValueError('Layout must be a dict')
+    unknown = [option for option in layout if option not in LAYOUT_OPTIONS]
+    if unknown:
+        raise ValueError(f"Unknown layout options: {', '.join(unknown)}")
+    if layout.get('cluster_rule') not in (None, *RULES):
+        raise ValueError(f"cluster_rule must be one of {', '.join(RULES)}")
+    days = layout.get('window_days')
+    if days is not None and (isinstance(days, bool) or not isinstance(days, int) or days < 0):
+        raise ValueError('window_days must be a whole number of days, 0 or more')
+    if layout.get('amount_tolerance') is not None:
+        parse_tolerance(layout['amount_tolerance'])
+    return layout
+
+def group_id(key):
+    """Stable ID of the duplicate group of a CONCAT key: the same key gets the same ID in every run"""
+    return hashlib.blake2b(key.encode('utf-8', 'surrogatepass'), digest_size=8).hexdigest()
+
+def add_group_columns(row, counts):
+    """Append the GROUP_COLUMNS values; rows whose key is unique get group size 1 and no group ID"""
+    values = ()
+    for rule_counts, key in zip(counts, (row.concat1, row.concat2, row.concat3)):
+        size = rule_counts[key]
+        values += (group_id(key) if size > 1 else '', size)
+    row.extra += values
+    return row
+
+class KeyClusters:
+    """
+    Connected components of duplicate rows across the three CONCAT rules.
+
+    Two rows are in one cluster if they share a duplicate key under any
+    rule, directly or through other rows. The union-find runs over the
+    duplicate keys rather than the rows: add(row) links the duplicate keys
+    of one row, so memory grows with the number of duplicate keys. Parents
+    and component sizes are kept in arrays indexed by key number, with
+    union by size and path halving.
+
+    After finish(), cluster_id(row) is the group ID (see group_id) of the
+    cluster's first key, by rule and then key order, so a cluster keeps
+    its ID as long as that key stays in it. Rows without duplicate keys
+    have no cluster.
+    """
+
+    def __init__(self, counts):
+        self.nodes = tuple({} for _ in RULES)
+        node = 0
+        for rule_nodes, rule_counts in zip(self.nodes, counts):
+            for key, count in rule_counts.items():
+                if count > 1:
+                    rule_nodes[key] = node
+                    node += 1
+        self.parent = array('q', range(node))
+        self.size = array('q', [1]) * node
+        self.ids = None
+
+    def find(self, node):
+        parent = self.parent
+        while parent[node] != node:
+            parent[node] = parent[parent[node]]
+            node = parent[node]
+        return node
+
+    def union(self, a, b):
+        a = self.find(a)
+        b = self.find(b)
+        if a == b:
+            return
+        if self.size[a] < self.size[b]:
+            a, b = b, a
+        self.parent[b] = a
+        self.size[a] += self.size[b]
+
+    def add(self, row):
+        concat1_nodes, concat2_nodes, concat3_nodes = self.nodes
+        node1 = concat1_nodes.get(row.concat1)
+        node2 = concat2_nodes.get(row.concat2)
+        node3 = concat3_nodes.get(row.concat3)
+        first = node1 if node1 is not None else node2
+        if first is not None and node2 is not None and node2 != first:
+            self.union(first, node2)
+        if first is None:
+            first = node3
+        elif node3 is not None:
+            self.union(first, node3)
+        return row
+
+    def finish(self):
+        """Point every key at its root and name the clusters"""
+        parent = self.parent
+        for node in range(len(parent)):
+            parent[node] = self.find(node)
+        self.size = None
+        first = {}
+        rules = {}
+        for rule, rule_nodes in enumerate(self.nodes):
+            for key, node in rule_nodes.items():
+                root = parent[node]
+                rules.setdefault(root, set()).add(rule)
+                current = first.get(root)
+                if current is None or (rule, key) < current:
+                    first[root] = (rule, key)
+        self.ids = {root: group_id(key) for root, (rule, key) in first.items()}
+        self.statistics = {
+            'clusters': len(self.ids),
+            'clusters_spanning_rules': sum(1 for found in rules.values() if len(found) > 1)
+        }
+        return self
+
+    def cluster_id(self, row):
+        """Cluster of a row that carries remarks (row.flags)"""
+        flags = row.flags
+        if flags & 1:
+            node = self.nodes[0][row.concat1]
+        elif flags & 2:
+            node = self.nodes[1][row.concat2]
+        elif flags & 4:
+            node = self.nodes[2][row.concat3]
+        else:
+            return ''
+        return self.ids[self.parent[node]]
+
+_CONFIDENCE = tuple(
+    round(1 - math.prod(1 - weight for i, weight in enumerate(CLUSTER_RULE_WEIGHTS) if flags & DUPLICATE_FLAGS[i]), 3)
+    for flags in range(8)
+)
+
+def add_cluster_id(row, clusters):
+    """Append the Cluster ID value (see KeyClusters)"""
+    row.extra += (clusters.cluster_id(row),)
+    return row
+
+def add_cluster_confidence(row):
+    """Append the Cluster Confidence value: CLUSTER_RULE_WEIGHTS combined over the rules that flag row"""
+    row.extra += (_CONFIDENCE[row.flags],)
+    return row
+
+class TimeWindows:
+    """
+    Time-window rule: rows of one vendor with the same amount (as
+    invoice_amount_after_removing_decimal) dated at most days apart.
+
+    CONCAT 2 compares calendar years, so it misses a repeat on 31 Dec and
+    2 Jan and flags invoices months apart in one year; this rule does
+    neither. add(row) counts rows per (vendor, amount, day). finish() sorts
+    these keys, so each vendor and amount has its days in order, and marks
+    every day whose nearest neighbouring day is within the window, or that
+    has several rows: O(k log k) for k distinct keys, with no pairwise
+    comparison of rows. Rows without a recognisable invoice_date never match.
+    """
+
+    def __init__(self, days, counts):
+        self.days = days
+        self.counts = {}
+        self.matches = None
+        self._concat2_counts = counts[1]
+        self._days = ValueDictionary(invoice_day)
+
+    def add(self, row):
+        day = self._days[row.invoice_date]
+        if day is not None:
+            key = (_key_vendor(row), row.invoice_amount_after_removing_decimal, day)
+            self.counts[key] = self.counts.get(key, 0) + 1
+        return row
+
+    def finish(self):
+        """Find the matching keys and drop the counts"""
+        counts = self.counts
+        matches = set()
+        groups = 0
+        group_rows = 0
+        previous = None
+        for key in sorted(counts):
+            if previous is not None and previous[:2] == key[:2] and key[2] - previous[2] <= self.days:
+                matches.add(previous)
+                matches.add(key)
+                group_rows += counts[key]
+            else:
+                groups += group_rows > 1
+                group_rows = counts[key]
+                if group_rows > 1:
+                    matches.add(key)
+            previous = key
+        groups += group_rows > 1
+
+        concat2_counts = self._concat2_counts
+        self.statistics = {
+            'days': self.days,
+            'duplicates': sum(counts[key] for key in matches),
+            'windows': groups,
+            'missed_by_concat2': sum(
+                counts[key] for key in matches
+                if concat2_counts.get(f'{key[0]}{date.fromordinal(key[2]).year}{key[1]}', 0) < 2
+            )
+        }
+        self.matches = matches
+        self.counts = None
+        self._concat2_counts = None
+        return self
+
+    def match(self, row):
+        day = self._days[row.invoice_date]
+        return day is not None and (_key_vendor(row), row.invoice_amount_after_removing_decimal, day) in self.matches
+
+def _key_vendor(row):
+    """primary_vendor_code as in the CONCAT 2 key (normalized if key normalization is on)"""
+    return row.concat2[:len(row.concat2) - len(row.invoice_year) - len(row.invoice_amount_after_removing_decimal)]
+
+def add_window_remarks(row, windows):
+    """Append the Time Window Remarks value (see TimeWindows)"""
+    row.extra += (REMARKS[windows.match(row)],)
+    return row
+
+def parse_tolerance(tolerance):
+    """(value, percent) for an amount tolerance: a number ('5', 5) or a percentage ('1%'); raises ValueError"""
+    text = str(tolerance).strip()
+    percent = text.endswith('%')
+    try:
+        value = float(text[:-1] if percent else text)
+    except ValueError:
+        raise ValueError(f"Amount tolerance must be a number or a percentage such as '1%', not {tolerance!r}")
+    if not math.isfinite(value) or value < 0:
+        raise ValueError('Amount tolerance must be 0 or more')
+    return value, percent
+
+# Slack for floating point error when comparing amounts with the tolerance
+_TOLERANCE_EPSILON = 1e-9
+
+class AmountTolerance:
+    """
+    Tolerance variant of the CONCAT rules: the other key fields are equal
+    and the invoice amounts differ by at most the tolerance, an absolute
+    amount or a percentage of the smaller amount.
+
+    The CONCAT keys compare amount // 10, so 1,239.99 and 1,240.01 never
+    match. Here amounts are put in buckets one tolerance wide (for a
+    percentage, on a log scale), so matching amounts are at most two
+    buckets apart (two when they differ by exactly the tolerance and the
+    floating-point division rounds one down and the other up, e.g. 0.3 and
+    0.4 at 0.1). add(row) keeps a hash index of (key fields, bucket) ->
+    [rows, lowest amount, highest amount]. finish() joins each bucket with
+    buckets k-2 to k+2: its rows match if it holds several, or if the
+    amount nearest to its single row in another bucket (that bucket's
+    highest or lowest) is within the tolerance. This is linear in
+    the number of buckets, however many rows a key has, and the index is
+    then reduced to the set of matching buckets. Non-numeric amounts never
+    match.
+    """
+
+    def __init__(self, tolerance):
+        self.tolerance = tolerance
+        self.value, self.percent = parse_tolerance(tolerance)
+        self._step = math.log1p(self.value / 100) if self.percent else self.value
+        self.index = tuple({} for _ in RULES)
+        self.matches = None
+
+    @staticmethod
+    def _bases(row):
+        """Each CONCAT key without the amount: its key fields, normalized if key normalization is on"""
+        cut = -len(row.invoice_amount_after_removing_decimal)
+        return row.concat1[:cut], row.concat2[:cut], row.concat3[:cut]
+
+    def _bucket(self, amount):
+        """(sign, k): buckets (sign, k - 2) to (sign, k + 2) are the neighbours"""
+        if not self._step:
+            return amount, 0
+        if not self.percent:
+            return 0, math.floor(amount / self._step)
+        if not amount:
+            return 0, 0
+        return (1 if amount > 0 else -1), math.floor(math.log(abs(amount)) / self._step)
+
+    def _within(self, a, b):
+        if self.percent:
+            if (a < 0) != (b < 0):
+                return False
+            low, high = sorted((abs(a), abs(b)))
+            return high - low <= low * self.value / 100 + _TOLERANCE_EPSILON
+        return abs(a - b) <= self.value + _TOLERANCE_EPSILON
+
+    def add(self, row):
+        amount = _amount(row)
+        if amount is not None:
+            bucket = self._bucket(amount)
+            for rule_index, base in zip(self.index, self._bases(row)):
+                entry = rule_index.get((base, bucket))
+                if entry is None:
+                    rule_index[(base, bucket)] = [1, amount, amount]
+                else:
+                    entry[0] += 1
+                    if amount < entry[1]:
+                        entry[1] = amount
+                    elif amount > entry[2]:
+                        entry[2] = amount
+        return row
+
+    def _near(self, rule_index, base, bucket, amount):
+        """True if a row in a bucket near amount's own one is within the tolerance"""
+        sign, k = bucket
+        for neighbour in ((sign, k - 1), (sign, k + 1), (sign, k - 2), (sign, k + 2)):
+            entry = rule_index.get((base, neighbour))
+            if entry and (self._within(amount, entry[1]) or self._within(amount, entry[2])):
+                return True
+        return False
+
+    def finish(self):
+        """Find the matching buckets, count their rows per rule and drop the index"""
+        rows = {}
+        matches = []
+        for rule, rule_index in zip(RULES, self.index):
+            rule_matches = set()
+            matched = 0
+            for key, (count, low, high) in rule_index.items():
+                if count > 1 or self._near(rule_index, key[0], key[1], low):
+                    rule_matches.add(key)
+                    matched += count
+            rows[rule] = matched
+            matches.append(rule_matches)
+        self.statistics = {'tolerance': str(self.tolerance), 'rows': rows}
+        self.matches = tuple(matches)
+        self.index = None
+        return self
+
+    def match(self, row):
+        """RULE_LABELS of the rules under which row matches another row within the tolerance"""
+        amount = _amount(row)
+        if amount is None:
+            return []
+        bucket = self._bucket(amount)
+        return [label for label, rule_matches, base in zip(RULE_LABELS, self.matches, self._bases(row))
+                if (base, bucket) in rule_matches]
+
+def _amount(row):
+    """invoice_amount as a float, or None if it is not a finite number"""
+    try:
+        amount = float(row.invoice_amount or '0')
+    except (ValueError, TypeError):
+        return None
+    return amount if math.isfinite(amount) else None
+
+def add_tolerance_remarks(row, tolerance):
+    """Append the Amount Tolerance Remarks value (see AmountTolerance)"""
+    labels = tolerance.match(row)
+    row.extra += (f"Duplicate within {tolerance.tolerance} ({', '.join(labels)})" if labels else REMARKS[0],)
+    return row
+
+# Rows held in memory per sorted run of cluster_rows, and rows per pickled
+# batch in its temporary files
+SORT_RUN_ROWS = 250000
+SPILL_BATCH_ROWS = 1000
+
+def cluster_rows(rows, counts, rule, run_rows=SORT_RUN_ROWS):
+    """
+    Output values of rows, ordered so that each duplicate group of rule (a
+    RULES name) is contiguous.
+
+    Duplicate groups come first, largest first (ties by key), each with its
+    rows in input order; rows with a unique key follow in input order.
+    This is an external sort: duplicate rows are sorted in runs of at most
+    run_rows that are spilled to temporary files and merged, and unique
+    rows are spilled as they arrive, so memory stays bounded.
+    """
+    rule_counts = counts[RULES.index(rule)]
+    key_of = attrgetter(rule)
+    runs = []
+    run = []
+    singles = tempfile.TemporaryFile()
+    batch = []
+    try:
+        for position, row in enumerate(rows):
+            key = key_of(row)
+            size = rule_counts[key]
+            if size > 1:
+                run.append((-size, key, position, row.output_values()))
+                if len(run) >= run_rows:
+                    runs.append(_spill_run(run))
+                    run = []
+            else:
+                batch.append(row.output_values())
+                if len(batch) >= SPILL_BATCH_ROWS:
+                    pickle.dump(batch, singles, protocol=pickle.HIGHEST_PROTOCOL)
+                    batch = []
+
+        if runs:
+            if run:
+                runs.append(_spill_run(run))
+                run = []
+            merged = heapq.merge(*map(_read_spill, runs))
+        else:
+            run.sort()
+            merged = run
+        for item in merged:
+            yield item[3]
+
+        yield from _read_spill(singles)
+        yield from batch
+    finally:
+        for spill in runs:
+            spill.close()
+        singles.close()
+
+def _spill_run(run):
+    """Sort run and write it to a temporary file"""
+    run.sort()
+    f = tempfile.TemporaryFile()
+    for start in range(0, len(run), SPILL_BATCH_ROWS):
+        pickle.dump(run[start:start + SPILL_BATCH_ROWS], f, protocol=pickle.HIGHEST_PROTOCOL)
+    return f
+
+def _read_spill(f):
+    f.seek(0)
+    while True:
+        try:
+            batch = pickle.load(f)
+        except EOFError:
+            return
+        yield from batch
+
+def is_duplicate(row, remarks=()):
+    """True if a CONCAT rule or one of the annotation values at the remarks positions of row.extra marks row"""
+    return bool(row.flags) or any(row.extra[i] not in ('', REMARKS[0]) for i in remarks)
+
+def _output_rows(rows, counts, annotations, layout):
+    """
+    Processed rows with the duplicates-only filter, the annotation columns
+    and the group columns of layout applied; returns (rows, extra columns,
+    order for write_output).
+    """
+    for column, annotate in annotations:
+        rows = map(annotate, rows)
+    if layout.get('duplicates_only'):
+        remarks = [i for i, (column, annotate) in enumerate(annotations) if column in REMARK_COLUMNS]
+        rows = filter(partial(is_duplicate, remarks=remarks), rows)
+    extra_columns = [column for column, annotate in annotations]
+    if layout.get('group_columns'):
+        rows = map(partial(add_group_columns, counts=counts), rows)
+        extra_columns += GROUP_COLUMNS
+    order = partial(cluster_rows, counts=counts, rule=layout['cluster_rule']) if layout.get('cluster_rule') else None
+    return rows, extra_columns, order
+
+def process_invoice_file(input_gz_path, output_csv, progress=None, index_path=None, filters=None,
+                         history_path=None, history_source=None, reference_path=None, reference_rules=None,
+                         layout=None, normalization=None):
+    """
+    Filter, build CONCAT patterns and mark duplicates for one CSV file
+    (gzip, zstd, xz, bz2 or uncompressed).
+
+    output_csv is a path or a text file object. progress(message, percent)
+    is called as the stages advance. When index_path is given, a queryable
+    result index (see result_index) is built while the output is written.
+    filters replaces DEFAULT_FILTERS. When history_path is given, keys are
+    checked against the key history (see key_history) and recorded under
+    history_source (default: the input file name) in one step, and a
+    History Remarks column is added. When reference_path is given, rows are
+    also matched against that file's keys for reference_rules (default all
+    rules) and a Reference Remarks column is added. layout sets the output
+    layout options (see validate_layout). normalization normalizes the key
+    fields of the input and reference rows (see validate_normalization).
+    Returns the summary dict.
+    """
+    progress = progress or _no_progress
+    layout = validate_layout(layout)
+    validate_normalization(normalization)
+    progress('Reading and processing CSV file...', 10)
+
+    with open_input(input_gz_path) as stream:
+        result = check_duplicates(stream, progress, filters, normalization)
+        summary = result.summary
+
+    history = _check_history(history_path, result.counts, history_source or os.path.basename(input_gz_path),
+                             [input_gz_path], progress)
+    clusters = None
+    if layout.get('clusters'):
+        progress('Clustering duplicates across rules...', 87)
+        clusters = result.key_clusters()
+    windows = None
+    if layout.get('window_days') is not None:
+        progress('Checking time windows...', 87)
+        windows = result.time_windows(layout['window_days'])
+    tolerance = None
+    if layout.get('amount_tolerance') is not None:
+        progress('Matching amounts within tolerance...', 87)
+        tolerance = result.amount_tolerance(layout['amount_tolerance'])
+    annotations = _annotations(result.counts, summary, history, reference_path, reference_rules, filters, progress,
+                               clusters, windows, tolerance, normalization)
+    rows, extra_columns, order = _output_rows(result, result.counts, annotations, layout)
+
+    progress('Saving processed file...', 95)
+    index = _open_index(index_path)
+    write_output(index.tee(rows) if index else rows, output_csv, extra_columns=extra_columns, order=order)
+    if index:
+        progress('Building result index...', 98)
+        index.close()
+    return summary
+
+def _annotations(counts, summary, history, reference_path, reference_rules, filters, progress, clusters=None,
+                 windows=None, tolerance=None, normalization=None):
+    """
+    Extra output columns for the key history and reference checks, the
+    KeyClusters clusters, the TimeWindows rule and the AmountTolerance
+    rule, as (column, function(row)) pairs; adds their statistics to summary.
+    history is the key history matches (see _check_history) or None.
+    """
+    annotations = []
+    if history is not None:
+        summary['history'] = history_statistics(counts, history)
+        annotations.append((HISTORY_COLUMN, partial(add_history_remarks, matches=history)))
+    if reference_path:
+        progress('Reading reference file...', 90)
+        reference = build_reference(reference_path, reference_rules, filters, normalization)
+        summary['reference'] = reference_statistics(reference_path, counts, reference)
+        annotations.append((REFERENCE_COLUMN, partial(add_reference_remarks, reference=reference)))
+    if clusters:
+        summary['clusters'] = clusters.statistics
+        annotations.append((CLUSTER_COLUMNS[0], partial(add_cluster_id, clusters=clusters)))
+        annotations.append((CLUSTER_COLUMNS[1], add_cluster_confidence))
+    if windows:
+        summary['time_window'] = windows.statistics
+        annotations.append((WINDOW_COLUMN, partial(add_window_remarks, windows=windows)))
+    if tolerance:
+        summary['amount_tolerance'] = tolerance.statistics
+        annotations.append((TOLERANCE_COLUMN, partial(add_tolerance_remarks, tolerance=tolerance)))
+    return annotations
+
+def _open_index(index_path):
+    if not index_path:
+        return None
+    from result_index import ResultIndexWriter
+    return ResultIndexWriter(index_path)
+
+def _check_history(history_path, counts, source, input_paths, progress):
+    """Key history matches of counts, whose keys are recorded under source in the same step; None without a history"""
+    if not history_path:
+        return None
+    from key_history import KeyHistory, upload_fingerprint
+    progress('Checking key history...', 88)
+    history = KeyHistory(history_path)
+    try:
+        return history.check_and_record(counts, source, upload_fingerprint(input_paths))
+    finally:
+        history.close()
+
+def count_shard(input_path, filters=None, normalization=None):
+    """Read one shard and count its CONCAT keys; returns (stats, counts). Runs in worker processes."""
+    stats = {'total_input_lines': 0, 'lines_processed': 0}
+    with open_input(input_path) as stream:
+        counts = count_keys(prepare_records(read_records(stream), stats, filters=filters,
+                                            normalization=normalization))
+    return stats, counts
+
+def write_shard(input_path, output_csv, counts, header=True, index=None, analytics=None, filters=None,
+                annotations=(), layout=None, normalization=None):
+    """
+    Re-read one shard and write it with remarks from the merged counts, the
+    extra columns of annotations ((column, function(row)) pairs) and the
+    output layout options of layout; returns True if rows were written.
+    """
+    analytics = analytics or DuplicateAnalytics()
+    rows, extra_columns, order = _output_rows(_shard_rows(input_path, counts, analytics, filters, normalization),
+                                              counts, annotations, validate_layout(layout))
+    return write_output(index.tee(rows) if index else rows, output_csv, header, extra_columns, order)
+
+def _shard_rows(input_path, counts, analytics, filters, normalization=None):
+    """Re-read one shard; yields its rows with remarks from counts, added to analytics"""
+    stats = {'total_input_lines': 0, 'lines_processed': 0}
+    with open_input(input_path) as stream:
+        for row in prepare_records(read_records(stream), stats, filters=filters, normalization=normalization):
+            yield analytics.add(add_remarks(row, counts))
+
+def _write_shard_job(input_path, output_csv, counts, filters=None, annotations=(), layout=None, normalization=None):
+    """write_shard for worker processes; returns the shard's DuplicateAnalytics"""
+    analytics = DuplicateAnalytics()
+    write_shard(input_path, output_csv, counts, analytics=analytics, filters=filters, annotations=annotations,
+                layout=layout, normalization=normalization)
+    return analytics
+
+def _map(function, jobs, *iterables):
+    if jobs == 1:
+        return list(map(function, *iterables))
+    with ProcessPoolExecutor(max_workers=jobs) as pool:
+        return list(pool.map(function, *iterables))
+
+def process_invoice_shards(input_paths, output_csv, jobs=None, progress=None, index_path=None, filters=None,
+                           history_path=None, history_source=None, reference_path=None, reference_rules=None,
+                           layout=None, normalization=None):
+    """
+    Treat several CSV files with the same header as one dataset.
+
+    Shards are counted in parallel (jobs worker processes, default one per
+    shard up to the number of cores) and their key counts merged, so
+    duplicates are found across shards. output_csv is a single path or text
+    file object for one combined output, or a list of paths with one output
+    per shard. index_path builds a result index for the combined output.
+    filters replaces DEFAULT_FILTERS; history_path, history_source,
+    reference_path, reference_rules, layout and normalization work as in
+    process_invoice_file (default history source: the shard file names);
+    a clustered layout orders the combined output across shards.
+    Returns the combined summary with a 'shards' breakdown.
+    """
+    progress = progress or _no_progress
+    layout = validate_layout(layout)
+    input_paths = list(input_paths)
+    jobs = jobs or min(len(input_paths), os.cpu_count() or 1)
+    stats, counts, shards = _count_shards(input_paths, jobs, progress, filters, normalization)
+    return _write_shards(input_paths, output_csv, stats, counts, shards, jobs, progress, index_path, filters,
+                         history_path, history_source, reference_path, reference_rules, layout, normalization)
+
+def _count_shards(input_paths, jobs, progress, filters, normalization=None):
+    """Count pass of process_invoice_shards; returns (stats, counts, per-shard stats)"""
+    if not input_paths:
+        raise ValueError('No input files')
+    if filters is not None:
+        validate_filters(filters)
+    validate_normalization(normalization)
+
+    progress('Checking shard headers...', 5)
+    header = read_header(input_paths[0])
+    for path in input_paths[1:]:
+        if read_header(path) != header:
+            raise ValueError(f'Header of {os.path.basename(path)} does not match {os.path.basename(input_paths[0])}')
+
+    progress(f'Reading and counting {len(input_paths)} shards...', 10)
+    stats = {'total_input_lines': 0, 'lines_processed': 0}
+    counts = ({}, {}, {})
+    shards = []
+    shard_results = _map(count_shard, jobs, input_paths, [filters] * len(input_paths),
+                         [normalization] * len(input_paths))
+    for done, (path, (shard_stats, shard_counts)) in enumerate(zip(input_paths, shard_results), 1):
+        merge_stats(stats, shard_stats)
+        merge_counts(counts, shard_counts)
+        shards.append(dict(shard_stats, file=os.path.basename(path)))
+        progress(f'Counted shard {done} of {len(input_paths)}...', 10 + int(70 * done / len(input_paths)))
+    return stats, counts, shards
+
+def _write_shards(input_paths, output_csv, stats, counts, shards, jobs, progress, index_path, filters,
+                  history_path, history_source, reference_path, reference_rules, layout, normalization=None):
+    """Write pass of process_invoice_shards from merged counts; returns the summary"""
+    summary = build_summary(stats, counts)
+    clusters = KeyClusters(counts) if layout.get('clusters') else None
+    windows = TimeWindows(layout['window_days'], counts) if layout.get('window_days') is not None else None
+    tolerance = AmountTolerance(layout['amount_tolerance']) if layout.get('amount_tolerance') is not None else None
+    scanners = [scanner for scanner in (clusters, windows, tolerance) if scanner]
+    if scanners:
+        progress('Reading rows again for clusters, time windows and amount tolerance...', 82)
+        _scan_shards(input_paths, filters, scanners, normalization)
+    history = _check_history(history_path, counts,
+                             history_source or ', '.join(os.path.basename(path) for path in input_paths),
+                             input_paths, progress)
+    annotations = _annotations(counts, summary, history, reference_path, reference_rules, filters, progress,
+                               clusters, windows, tolerance, normalization)
+
+    progress('Saving processed file...', 85)
+    analytics = DuplicateAnalytics()
+    if isinstance(output_csv, (list, tuple)):
+        if len(output_csv) != len(input_paths):
+            raise ValueError('One output path is required per shard')
+        for shard_analytics in _map(_write_shard_job, min(jobs, len(input_paths)),
+                                    input_paths, output_csv, [counts] * len(input_paths),
+                                    [filters] * len(input_paths), [annotations] * len(input_paths),
+                                    [layout] * len(input_paths), [normalization] * len(input_paths)):
+            analytics.merge(shard_analytics)
+    else:
+        index = _open_index(index_path)
+        if isinstance(output_csv, str):
+            with open(output_csv, 'w', newline='', encoding='utf-8') as f:
+                _write_combined(input_paths, f, counts, index, analytics, filters, annotations, layout,
+                                normalization)
+        else:
+            _write_combined(input_paths, output_csv, counts, index, analytics, filters, annotations, layout,
+                            normalization)
+        if index:
+            progress('Building result index...', 95)
+            index.close()
+
+    summary['shards'] = shards
+    summary['analytics'] = analytics.as_dict(counts)
+    return summary
+
+def _scan_shards(input_paths, filters, scanners, normalization=None):
+    """Pass the rows of all shards (one more read of each) to each scanner's add(), then finish them"""
+    stats = {'total_input_lines': 0, 'lines_processed': 0}
+    for path in input_paths:
+        with open_input(path) as stream:
+            for row in prepare_records(read_records(stream), stats, filters=filters, normalization=normalization):
+                for scanner in scanners:
+                    scanner.add(row)
+    for scanner in scanners:
+        scanner.finish()
+
+def count_invoice_data(input_paths, counts_path=None, jobs=None, progress=None, filters=None, key_limit=None,
+                       normalization=None):
+    """
+    Dry run: count the CONCAT keys of one file or several shards (a list of
+    paths, as in process_invoice_shards) without writing any output.
+
+    The summary has the usual duplicate statistics plus, per rule, the
+    number of duplicate keys (duplicate_key_counts) and the keys with
+    their row counts, most frequent first (duplicate_keys, at most
+    key_limit per rule). When counts_path is given, the counts are saved
+    there so materialize_output can write the output without counting again,
+    with the same filters and normalization.
+    """
+    progress = progress or _no_progress
+    input_paths = [input_paths] if isinstance(input_paths, str) else list(input_paths)
+    jobs = jobs or min(len(input_paths), os.cpu_count() or 1)
+    stats, counts, shards = _count_shards(input_paths, jobs, progress, filters, normalization)
+
+    summary = build_summary(stats, counts)
+    summary['duplicate_key_counts'] = {rule: sum(1 for count in rule_counts.values() if count > 1)
+                                       for rule, rule_counts in zip(RULES, counts)}
+    summary['duplicate_keys'] = duplicate_keys(counts, key_limit)
+    if len(input_paths) > 1:
+        summary['shards'] = shards
+
+    if counts_path:
+        progress('Saving key counts...', 90)
+        _save_counts(counts_path, {
+            'version': COUNTS_VERSION,
+            'inputs': [_file_signature(path) for path in input_paths],
+            'filters': filters,
+            'normalization': normalization,
+            'stats': stats,
+            'counts': counts,
+            'shards': shards
+        })
+    return summary
+
+def duplicate_keys(counts, limit=None):
+    """Per rule, [key, row count] of each key occurring more than once, most frequent first (at most limit)"""
+    result = {}
+    for rule, rule_counts in zip(RULES, counts):
+        keys = ((key, count) for key, count in rule_counts.items() if count > 1)
+        if limit is None:
+            keys = sorted(keys, key=lambda item: (-item[1], item[0]))
+        else:
+            keys = heapq.nsmallest(limit, keys, key=lambda item: (-item[1], item[0]))
+        result[rule] = [list(item) for item in keys]
+    return result
+
+def materialize_output(counts_path, output_csv, jobs=None, progress=None, index_path=None, history_path=None,
+                       history_source=None, reference_path=None, reference_rules=None, layout=None):
+    """
+    Write the output of a dry run (count_invoice_data) from its saved
+    counts; the input files are read once more, but not counted again.
+
+    output_csv, index_path, history, reference and layout options work as
+    in process_invoice_shards. Raises ValueError if an input file changed
+    since the dry run. Returns the full summary.
+    """
+    progress = progress or _no_progress
+    layout = validate_layout(layout)
+    progress('Loading key counts...', 5)
+    saved = _load_counts(counts_path)
+    input_paths = []
+    for path, size, mtime in saved['inputs']:
+        if _file_signature(path) != (path, size, mtime):
+            raise ValueError(f'{os.path.basename(path)} changed or was removed since the dry run')
+        input_paths.append(path)
+
+    jobs = jobs or min(len(input_paths), os.cpu_count() or 1)
+    summary = _write_shards(input_paths, output_csv, saved['stats'], saved['counts'], saved['shards'], jobs,
+                            progress, index_path, saved['filters'], history_path, history_source,
+                            reference_path, reference_rules, layout, saved.get('normalization'))
+    if len(input_paths) == 1:
+        del summary['shards']
+    return summary
+
+def _file_signature(path):
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return path, None, None
+    return path, stat.st_size, stat.st_mtime_ns
+
+def _save_counts(counts_path, saved):
+    temp_path = f'{counts_path}.tmp'
+    with open(temp_path, 'wb') as f:
+        pickle.dump(saved, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(temp_path, counts_path)
+
+def _load_counts(counts_path):
+    try:
+        with open(counts_path, 'rb') as f:
+            saved = pickle.load(f)
+    except FileNotFoundError:
+        raise ValueError('No saved key counts for this dry run')
+    if saved.get('version') != COUNTS_VERSION:
+        raise ValueError(f'Key counts {counts_path} were written by an incompatible version')
+    return saved
+
+def _write_combined(input_paths, f, counts, index=None, analytics=None, filters=None, annotations=(), layout=None,
+                    normalization=None):
+    """Write the shards as one output; the header comes once, before the first row"""
+    analytics = analytics or DuplicateAnalytics()
+    rows = chain.from_iterable(_shard_rows(path, counts, analytics, filters, normalization) for path in input_paths)
+    rows, extra_columns, order = _output_rows(rows, counts, annotations, layout or {})
+    write_output(index.tee(rows) if index else rows, f, extra_columns=extra_columns, order=order)
+
+# invoice_date formats, tried in order
+DATE_FORMATS = ('%Y-%m-%d', '%m/%d/%Y', '%d/%m/%Y', '%Y-%m-%d %H:%M:%S')
+
+def extract_year_from_date(date_str):
+    """Extract year from date string"""
+    if not date_str:
+        return ''
+
+    try:
+        # Handle ISO format like "2022-07-09T00:00:00.000Z"
+        if 'T' in date_str:
+            date_str = date_str.split('T')[0]  # Extract date part before 'T'
+
+        for fmt in DATE_FORMATS:
+            try:
+                date_obj = datetime.strptime(date_str, fmt)
+                return str(date_obj.year)
+            except ValueError:
+                continue
+        return ''
+    except:
+        return ''
+
+def invoice_day(date_str):
+    """Day number (date.toordinal()) of a trimmed invoice_date, or None if it is not a recognisable date"""
+    for fmt in DATE_FORMATS:
+        try:
+            return datetime.strptime(date_str, fmt).toordinal()
+        except (ValueError, TypeError):
+            continue
+    return None
+
+def trim_date_format(date_str):
+    """Trim time portion from ISO date format, keep only YYYY-MM-DD"""
+    if not date_str:
+        return ''
+
+    try:
+        # Handle ISO format like "2022-07-09T00:00:00.000Z"
+        if 'T' in date_str:
+            date_str = date_str.split('T')[0]  # Extract date part before 'T'
+
+        return date_str
+    except:
+        return date_str
@@ -0,0 +1,180 @@
+"""Incremental (delta) duplicate check for feeds that are re-exported with new rows appended"""
+import hashlib
+import os
+import pickle
+
+from duplicate_engine import (
+    DEFAULT_FILTERS, DuplicateAnalytics, _no_progress, add_remarks, build_summary,
+    count_keys, merge_counts, prepare_records, read_records, validate_filters, validate_normalization, write_output
+)
+from input_codecs import open_input
+
+STATE_VERSION = 1
+
+# Extra output column: 'new' for rows first seen in this run, 'reflagged' for
+# rows of earlier runs whose key went from unique to duplicate
+DELTA_COLUMN = 'Delta Status'
+
+def record_fingerprint(record):
+    """Stable 64-bit fingerprint of a raw CSV record"""
+    data = '\x1f'.join(record).encode('utf-8', 'surrogatepass')
+    return int.from_bytes(hashlib.blake2b(data, digest_size=8).digest(), 'big', signed=True)
+
+def load_state(state_path):
+    """State saved by the previous run, or None for a first run"""
+    if not os.path.exists(state_path):
+        return None
+    with open(state_path, 'rb') as f:
+        state = pickle.load(f)
+    if state.get('version') != STATE_VERSION:
+        raise ValueError(f'Incremental state {state_path} was written by an incompatible version')
+    return state
+
+def save_state(state_path, state):
+    """Write state atomically, so an interrupted run leaves the previous state intact"""
+    temp_path = f'{state_path}.tmp'
+    with open(temp_path, 'wb') as f:
+        pickle.dump(state, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(temp_path, state_path)
+
+def _new_records(records, seen, fingerprints, current):
+    """
+    Records not processed by an earlier run.
+
+    seen is a multiset (fingerprint -> count) of earlier records; each
+    earlier occurrence is consumed once, so exact duplicate rows appended
+    to the feed still count as new. current[0] holds the fingerprint of the
+    record handed out last.
+    """
+    for record in records:
+        if not record:
+            continue
+        fingerprint = record_fingerprint(record)
+        previous = seen.get(fingerprint)
+        if previous:
+            seen[fingerprint] = previous - 1
+            continue
+        fingerprints[fingerprint] = fingerprints.get(fingerprint, 0) + 1
+        current[0] = fingerprint
+        yield record
+
+def process_invoice_delta(input_path, output_csv, state_path, progress=None, filters=None, normalization=None):
+    """
+    Check only the rows of input_path that were not in the previous run.
+
+    Key counts, the fingerprints of all earlier rows and, for each key that
+    occurs once, the fingerprint of its row are kept in state_path. The
+    output holds the new rows plus earlier rows whose key went from unique
+    to duplicate, with a Delta Status column. The duplicate counts in the
+    summary cover all rows to date; line counts cover this run. filters
+    and normalization must stay the same across the runs of a state.
+    """
+    progress = progress or _no_progress
+    filters = DEFAULT_FILTERS if filters is None else validate_filters(filters)
+    validate_normalization(normalization)
+
+    progress('Loading previous run...', 5)
+    state = load_state(state_path)
+    if state is None:
+        state = {
+            'version': STATE_VERSION,
+            'filters': filters,
+            'normalization': normalization,
+            'header': None,
+            'counts': ({}, {}, {}),
+            'singles': ({}, {}, {}),
+            'fingerprints': {},
+            'runs': 0
+        }
+    elif state['filters'] != filters:
+        raise ValueError('Filters differ from the previous run; use a new incremental state')
+    elif state.get('normalization') != normalization:
+        raise ValueError('Key normalization differs from the previous run; use a new incremental state')
+    previous_counts = [dict(rule_counts) for rule_counts in state['counts']]
+    previous_rows = sum(state['fingerprints'].values())
+
+    # Pass 1: find and process the new rows. prepare_records pulls one record
+    # at a time, so when it yields a row, current[0] is that row's fingerprint.
+    progress('Reading new rows...', 10)
+    stats = {'total_input_lines': 0, 'lines_processed': 0}
+    seen = dict(state['fingerprints'])
+    fingerprints = state['fingerprints']
+    current = [None]
+    new_rows = []
+    row_fingerprints = []
+    with open_input(input_path) as stream:
+        records = read_records(stream)
+        header = next(records, None)
+        if header is None:
+            raise ValueError('File appears to be empty')
+        if state['header'] not in (None, header):
+            raise ValueError('Header differs from the previous run; use a new incremental state')
+        state['header'] = header
+        for row in prepare_records(_header_first(header, _new_records(records, seen, fingerprints, current)),
+                                   stats, progress, filters, normalization):
+            new_rows.append(row)
+            row_fingerprints.append(current[0])
+
+    progress('Updating key counts...', 60)
+    counts = merge_counts(state['counts'], count_keys(new_rows))
+    reflag = set()
+    for rule, (rule_counts, old_counts, singles) in enumerate(zip(counts, previous_counts, state['singles'])):
+        for row, fingerprint in zip(new_rows, row_fingerprints):
+            key = (row.concat1, row.concat2, row.concat3)[rule]
+            if rule_counts[key] == 1:
+                singles[key] = fingerprint
+            elif old_counts.get(key) == 1 and key in singles:
+                reflag.add(singles.pop(key))
+
+    progress('Saving processed file...', 70)
+    analytics = DuplicateAnalytics()
+    rows = [_delta_row(analytics.add(add_remarks(row, counts)), 'new') for row in new_rows]
+    if reflag:
+        rows += _reflagged_rows(input_path, header, reflag, counts, filters, normalization, analytics)
+    write_output(rows, output_csv, extra_columns=(DELTA_COLUMN,))
+
+    state['runs'] += 1
+    progress('Saving incremental state...', 95)
+    save_state(state_path, state)
+
+    summary = build_summary(stats, counts)
+    summary['incremental'] = {
+        'run': state['runs'],
+        'previous_rows': previous_rows,
+        'new_rows': stats['total_input_lines'],
+        'reflagged_rows': len(rows) - len(new_rows)
+    }
+    summary['analytics'] = analytics.as_dict(counts)
+    return summary
+
+def _header_first(header, records):
+    yield header
+    yield from records
+
+def _delta_row(row, status):
+    row.extra += (status,)
+    return row
+
+def _reflagged_rows(input_path, header, reflag, counts, filters, normalization, analytics):
+    """Pass 2: rebuild the earlier rows whose fingerprint is in reflag"""
+    stats = {'total_input_lines': 0, 'lines_processed': 0}
+    with open_input(input_path) as stream:
+        records = read_records(stream)
+        try:
+            next(records, None)
+            return [_delta_row(analytics.add(add_remarks(row, counts)), 'reflagged')
+                    for row in prepare_records(_header_first(header, _matching_records(records, set(reflag))),
+                                               stats, filters=filters, normalization=normalization)]
+        finally:
+            records.close()
+
+def _matching_records(records, remaining):
+    """First record for each fingerprint in remaining (a later identical record is a new row)"""
+    for record in records:
+        if not remaining:
+            return
+        if record:
+            fingerprint = record_fingerprint(record)
+            if fingerprint in remaining:
+                remaining.discard(fingerprint)
+                yield record
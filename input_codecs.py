@@ -0,0 +1,132 @@
+"""Input codec detection for the duplicate engine (gzip, zstd, xz, bz2, plain CSV)"""
+import bz2
+import io
+import lzma
+import mmap
+import os
+
+# Accelerated gzip backends (ISA-L, zlib-ng) are used when installed
+try:
+    from isal import igzip as _gzip
+    GZIP_BACKEND = 'isal'
+except ImportError:
+    try:
+        from zlib_ng import gzip_ng as _gzip
+        GZIP_BACKEND = 'zlib-ng'
+    except ImportError:
+        import gzip as _gzip
+        GZIP_BACKEND = 'gzip'
+
+try:
+    from compression import zstd as _zstd
+except ImportError:
+    _zstd = None
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+READ_BUFFER_SIZE = 1024 * 1024
+
+# File extensions accepted for upload and stripped from output names
+INPUT_EXTENSIONS = ('.gz', '.zst', '.zstd', '.xz', '.bz2', '.csv')
+COMPRESSED_EXTENSIONS = ('.gz', '.zst', '.zstd', '.xz', '.bz2')
+
+def _open_gzip(stream):
+    return _gzip.open(stream, 'rb')
+
+def _open_zstd(stream):
+    if _zstd is not None:
+        return _zstd.open(stream, 'rb')
+    if zstandard is None:
+        raise ValueError('zstd input requires the zstandard package (pip install zstandard)')
+    reader = zstandard.ZstdDecompressor().stream_reader(stream, read_across_frames=True)
+    return io.BufferedReader(reader, READ_BUFFER_SIZE)
+
+def _open_xz(stream):
+    return lzma.open(stream, 'rb')
+
+def _open_bz2(stream):
+    return bz2.open(stream, 'rb')
+
+# (name, magic bytes, opener); checked in order, first match wins
+CODECS = [
+    ('gzip', b'\x1f\x8b', _open_gzip),
+    ('zstd', b'\x28\xb5\x2f\xfd', _open_zstd),
+    ('xz', b'\xfd7zXZ\x00', _open_xz),
+    ('bz2', b'BZh', _open_bz2),
+]
+
+def register_codec(name, magic, opener):
+    """Add a codec; opener(binary_stream) returns a decompressed binary stream"""
+    CODECS.insert(0, (name, magic, opener))
+
+def _buffered(stream):
+    if not hasattr(stream, 'peek'):
+        stream = io.BufferedReader(stream, READ_BUFFER_SIZE)
+    return stream
+
+def detect_codec(stream):
+    """Name of the codec matching the stream's magic bytes, or 'csv' for plain text"""
+    head = stream.peek(8)
+    for name, magic, _ in CODECS:
+        if head.startswith(magic):
+            return name
+    return 'csv'
+
+def decompress_stream(stream):
+    """Return a decompressed binary stream for a (possibly compressed) binary stream"""
+    stream = _buffered(stream)
+    codec = detect_codec(stream)
+    for name, _, opener in CODECS:
+        if name == codec:
+            return opener(stream)
+    return stream
+
+class _MmapReader(io.RawIOBase):
+    """Raw reader over a memory-mapped file"""
+
+    def __init__(self, f):
+        self._file = f
+        self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if hasattr(self._map, 'madvise') and hasattr(mmap, 'MADV_SEQUENTIAL'):
+            self._map.madvise(mmap.MADV_SEQUENTIAL)
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        data = self._map.read(len(b))
+        b[:len(data)] = data
+        return len(data)
+
+    def close(self):
+        if not self.closed:
+            self._map.close()
+            self._file.close()
+        super().close()
+
+def open_input(path):
+    """
+    Open an input file as a binary stream.
+
+    Uncompressed files are memory-mapped; compressed ones are read through a
+    large buffer. Decompression happens later in decompress_stream.
+    """
+    f = open(path, 'rb', buffering=READ_BUFFER_SIZE)
+    try:
+        if os.fstat(f.fileno()).st_size and detect_codec(f) == 'csv':
+            return io.BufferedReader(_MmapReader(f), READ_BUFFER_SIZE)
+    except (OSError, ValueError):
+        pass
+    return f
+
+def is_supported_filename(filename):
+    return filename.lower().endswith(INPUT_EXTENSIONS)
+
+def processed_filename(filename):
+    """processed_<name>.csv for an input file name"""
+    root, ext = os.path.splitext(filename)
+    if ext.lower() in COMPRESSED_EXTENSIONS:
+        filename = f"{root}.csv"
+    return f"processed_{filename}"
@@ -1,64 +1,348 @@
-from flask import Flask, request, jsonify, render_template_string, redirect, url_for, session, flash, send_file
-import csv
-import gzip
+from flask import Flask, Response, request, jsonify, render_template, redirect, url_for, session, flash, send_file
+from jinja2 import DictLoader
 import os
 import uuid
 import threading
 from werkzeug.utils import secure_filename
 from datetime import datetime
 import traceback
-import base64
 import sqlite3
 import hashlib
+import time
+import queue
+import multiprocessing
+import multiprocessing.connection
+from collections import OrderedDict
+from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 from functools import wraps
+from duplicate_engine import (
+    RULES, count_invoice_data, materialize_output, process_invoice_file, process_invoice_shards, read_header
+)
+from incremental import process_invoice_delta
+from preview import preview_invoice_file
+from input_codecs import INPUT_EXTENSIONS, is_supported_filename, processed_filename
+from result_index import query_results
 
 app = Flask(__name__)
 app.config['SECRET_KEY'] = 'your-secret-key-here-change-this'
 app.config['MAX_CONTENT_LENGTH'] = 2 * 1024 * 1024 * 1024  # 2GB max file size
 
+# Retention of finished tasks (status entries + files on disk)
+app.config['RESULT_TTL_SECONDS'] = int(os.environ.get('RESULT_TTL_SECONDS', 24 * 60 * 60))
+app.config['RESULT_MAX_TASKS'] = int(os.environ.get('RESULT_MAX_TASKS', 50))
+app.config['RESULT_DISK_QUOTA_BYTES'] = int(os.environ.get('RESULT_DISK_QUOTA_BYTES', 20 * 1024 * 1024 * 1024))
+app.config['RETENTION_SWEEP_INTERVAL_SECONDS'] = int(os.environ.get('RETENTION_SWEEP_INTERVAL_SECONDS', 60))
+
+# Queryable per-task result index (SQLite) built while the output is written
+app.config['BUILD_RESULT_INDEX'] = True
+
+# Persistent index of CONCAT keys from earlier uploads ('' disables the cross-period check)
+app.config['KEY_HISTORY_DATABASE'] = os.environ.get('KEY_HISTORY_DATABASE', 'key_history.db')
+
+# CONCAT rules compared against an uploaded reference file (None = all three)
+app.config['REFERENCE_RULES'] = None
+
+# Row exclusion filters (None = duplicate_engine.DEFAULT_FILTERS: cancelled, DROPSHIP, SCR)
+app.config['ROW_FILTERS'] = None
+
+# Key field normalization before the CONCAT keys are built (None = off), e.g.
+# duplicate_engine.FULL_NORMALIZATION or {'header_po': ['strip', 'casefold', 'punctuation']}
+app.config['KEY_NORMALIZATION'] = None
+
+# Group ID and group size columns per CONCAT rule in the output (not in incremental runs)
+app.config['OUTPUT_GROUP_COLUMNS'] = False
+
+# Cluster ID and confidence columns linking duplicates across all three CONCAT rules
+app.config['OUTPUT_CLUSTERS'] = False
+
+# Time-window rule: same vendor and amount within this many days (None = off)
+app.config['TIME_WINDOW_DAYS'] = None
+
+# Amount tolerance rule: CONCAT keys with amounts within this amount ('5') or
+# percentage ('1%') of each other (None = off)
+app.config['AMOUNT_TOLERANCE'] = None
+
+# Duplicate keys per CONCAT rule listed in a dry-run summary (most frequent first)
+app.config['DRY_RUN_KEY_LIMIT'] = 1000
+
+# Quick preview of a chunked upload: decompressed bytes read and share of keys sampled
+app.config['PREVIEW_MAX_BYTES'] = 32 * 1024 * 1024
+app.config['PREVIEW_SAMPLE_RATE'] = 1.0
+
+# Worker processes running processing tasks (at most this many tasks run at once)
+app.config['PROCESSING_WORKERS'] = int(os.environ.get('PROCESSING_WORKERS', os.cpu_count() or 1))
+
+# User database
+app.config['DATABASE'] = 'users.db'
+app.config['DB_POOL_SIZE'] = 8
+app.config['AUTH_CACHE_TTL_SECONDS'] = 30
+
+# Chunked (resumable) uploads
+app.config['UPLOAD_CHUNK_SIZE'] = 8 * 1024 * 1024  # 8MB per chunk
+app.config['MAX_CHUNKED_UPLOAD_BYTES'] = 100 * 1024 * 1024 * 1024  # 100GB per file
+
 # Store processing status and results
 processing_status = {}
+# Chunked upload sessions: upload_id -> {'path', 'filename', 'size', 'chunk_size', 'received', 'user_id'}
+upload_sessions = {}
+upload_sessions_lock = threading.Lock()
+# Dry runs awaiting materialization: task_id -> {'input_paths', 'filenames', 'output_mode', 'reference_path',
+# 'counts_path', 'paths'}
+dry_runs = {}
 UPLOAD_FOLDER = 'uploads'
 PROCESSED_FOLDER = 'processed'
+STATE_FOLDER = 'incremental_state'  # key counts and row fingerprints per incremental dataset
+
+# One incremental run per dataset at a time
+dataset_locks = {}
+dataset_locks_lock = threading.Lock()
 
 # Create directories if they don't exist
 os.makedirs(UPLOAD_FOLDER, exist_ok=True)
 os.makedirs(PROCESSED_FOLDER, exist_ok=True)
 
+class RetentionManager:
+    """
+    Evict finished tasks by TTL, task count and disk quota, least recently downloaded first.
+
+    Tasks still processing are never evicted; unfinished chunked uploads only
+    expire by TTL.
+    """
+
+    def __init__(self, status_store, ttl_seconds, max_tasks, disk_quota_bytes, sweep_interval_seconds, on_evict=None):
+        self.status_store = status_store
+        self.on_evict = on_evict
+        self.ttl_seconds = ttl_seconds
+        self.max_tasks = max_tasks
+        self.disk_quota_bytes = disk_quota_bytes
+        self.sweep_interval_seconds = sweep_interval_seconds
+        # task_id -> {'paths': [...], 'last_access': timestamp}, oldest access first
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def register(self, task_id, *paths):
+        """Track the files belonging to a task"""
+        with self._lock:
+            self._entries[task_id] = {'paths': [p for p in paths if p], 'last_access': time.time()}
+            self._entries.move_to_end(task_id)
+
+    def touch(self, task_id):
+        """Mark a task as recently used (completed or downloaded)"""
+        with self._lock:
+            entry = self._entries.get(task_id)
+            if entry is not None:
+                entry['last_access'] = time.time()
+                self._entries.move_to_end(task_id)
+
+    def forget(self, task_id):
+        """Stop tracking a task without deleting its files"""
+        with self._lock:
+            self._entries.pop(task_id, None)
+
+    def _state(self, task_id):
+        status = self.status_store.get(task_id)
+        return status.get('status') if status else None
+
+    def _evict(self, task_id):
+        entry = self._entries.pop(task_id)
+        self.status_store.pop(task_id, None)
+        if self.on_evict:
+            self.on_evict(task_id)
+        for path in entry['paths']:
+            try:
+                if os.path.isfile(path):
+                    os.remove(path)
+            except OSError as e:
+                print(f"Warning: Could not remove {path}: {e}")
+        print(f"Evicted task {task_id}")
+
+    def sweep(self):
+        """Apply TTL, task-count and disk-quota limits; returns evicted task ids"""
+        evicted = []
+        with self._lock:
+            now = time.time()
+            # Expired tasks first
+            for task_id in list(self._entries):
+                if (self._state(task_id) != 'processing' and
+                        now - self._entries[task_id]['last_access'] > self.ttl_seconds):
+                    self._evict(task_id)
+                    evicted.append(task_id)
+
+            candidates = [task_id for task_id in self._entries
+                          if self._state(task_id) not in ('processing', 'uploading')]
+
+            # Then least recently used until the task count fits
+            while candidates and len(self._entries) > self.max_tasks:
+                task_id = candidates.pop(0)
+                self._evict(task_id)
+                evicted.append(task_id)
+
+            # Then least recently used until the disk usage fits
+            sizes = {}
+            for task_id, entry in self._entries.items():
+                sizes[task_id] = sum(os.path.getsize(p) for p in entry['paths'] if os.path.isfile(p))
+            total_size = sum(sizes.values())
+            while candidates and total_size > self.disk_quota_bytes:
+                task_id = candidates.pop(0)
+                total_size -= sizes[task_id]
+                self._evict(task_id)
+                evicted.append(task_id)
+        return evicted
+
+    def _run(self):
+        while True:
+            time.sleep(self.sweep_interval_seconds)
+            try:
+                self.sweep()
+            except Exception as e:
+                print(f"Warning: Retention sweep failed: {e}")
+
+    def start(self):
+        """Start the background sweeper (once)"""
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, daemon=True)
+                self._thread.start()
+
+def discard_task_state(task_id):
+    """Drop the in-memory upload session or dry run of an evicted task"""
+    with upload_sessions_lock:
+        upload_sessions.pop(task_id, None)
+    dry_runs.pop(task_id, None)
+
+retention = RetentionManager(
+    processing_status,
+    ttl_seconds=app.config['RESULT_TTL_SECONDS'],
+    max_tasks=app.config['RESULT_MAX_TASKS'],
+    disk_quota_bytes=app.config['RESULT_DISK_QUOTA_BYTES'],
+    sweep_interval_seconds=app.config['RETENTION_SWEEP_INTERVAL_SECONDS'],
+    on_evict=discard_task_state
+)
+
 # Database setup
+class ConnectionPool:
+    """
+    Reusable SQLite connections in WAL mode.
+
+    A request thread takes a connection for the duration of a request
+    (``with db_pool.connection() as conn``), so statements stay compiled in
+    the connection's statement cache. The pool is shared rather than
+    per-thread: requests run on WSGI pool and asyncio.to_thread workers
+    whose threads come and go, and a per-thread connection would be opened
+    in each of them and never closed. At most size idle connections are
+    kept.
+    """
+
+    def __init__(self, database, size):
+        self.database = database
+        self._idle = queue.LifoQueue(maxsize=size)
+
+    def _connect(self):
+        conn = sqlite3.connect(self.database, check_same_thread=False, cached_statements=128)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        conn.execute('PRAGMA busy_timeout=5000')
+        return conn
+
+    def acquire(self):
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            return self._connect()
+
+    def release(self, conn):
+        if conn.in_transaction:
+            conn.rollback()
+        try:
+            self._idle.put_nowait(conn)
+        except queue.Full:
+            conn.close()
+
+    @contextmanager
+    def connection(self):
+        """A pooled connection, released (and rolled back if left in a transaction) on exit"""
+        conn = self.acquire()
+        try:
+            yield conn
+        finally:
+            self.release(conn)
+
+db_pool = ConnectionPool(app.config['DATABASE'], app.config['DB_POOL_SIZE'])
+
+# Queries used on every request
+SQL_USER_AUTH = 'SELECT role, is_active FROM users WHERE id = ?'
+SQL_USER_LOGIN = 'SELECT id, username, password_hash, role, is_active FROM users WHERE email = ?'
+
+class AuthCache:
+    """Short-lived in-process cache of user id -> (role, is_active)"""
+
+    def __init__(self, ttl_seconds):
+        self.ttl_seconds = ttl_seconds
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def get(self, user_id):
+        """(role, is_active) for a user, or None if the user does not exist"""
+        now = time.time()
+        entry = self._entries.get(user_id)
+        if entry and entry[0] > now:
+            return entry[1]
+
+        with db_pool.connection() as conn:
+            user = conn.execute(SQL_USER_AUTH, (user_id,)).fetchone()
+        value = (user[0], bool(user[1])) if user else None
+        with self._lock:
+            self._entries[user_id] = (now + self.ttl_seconds, value)
+        return value
+
+    def peek(self, user_id):
+        """(True, value) if the cached entry is fresh, else (False, None); never queries the database"""
+        entry = self._entries.get(user_id)
+        if entry and entry[0] > time.time():
+            return True, entry[1]
+        return False, None
+
+    def invalidate(self, user_id):
+        with self._lock:
+            self._entries.pop(user_id, None)
+
+auth_cache = AuthCache(app.config['AUTH_CACHE_TTL_SECONDS'])
+
 def init_db():
     """Initialize the database with admin and user tables"""
-    conn = sqlite3.connect('users.db')
-    cursor = conn.cursor()
-
-    # Create users table
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS users (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            username TEXT UNIQUE NOT NULL,
-            email TEXT UNIQUE NOT NULL,
-            password_hash TEXT NOT NULL,
-            role TEXT NOT NULL DEFAULT 'user',
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            is_active BOOLEAN DEFAULT 1
-        )
-    ''')
-
-    # Create default admin user if not exists
-    admin_email = 'admin@pierian.co.in'
-    admin_username = 'admin'
-    admin_password = 'admin123'  # Default password - should be changed
-    admin_hash = hashlib.sha256(admin_password.encode()).hexdigest()
+    with db_pool.connection() as conn:
+        cursor = conn.cursor()
 
-    cursor.execute('SELECT id FROM users WHERE email = ?', (admin_email,))
-    if not cursor.fetchone():
+        # Create users table
         cursor.execute('''
-            INSERT INTO users (username, email, password_hash, role)
-            VALUES (?, ?, ?, ?)
-        ''', (admin_username, admin_email, admin_hash, 'admin'))
+            CREATE TABLE IF NOT EXISTS users (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                username TEXT UNIQUE NOT NULL,
+                email TEXT UNIQUE NOT NULL,
+                password_hash TEXT NOT NULL,
+                role TEXT NOT NULL DEFAULT 'user',
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                is_active BOOLEAN DEFAULT 1
+            )
+        ''')
+
+        # Create default admin user if not exists
+        admin_email = 'admin@pierian.co.in'
+        admin_username = 'admin'
+        admin_password = 'admin123'  # Default password - should be changed
+        admin_hash = hashlib.sha256(admin_password.encode()).hexdigest()
 
-    conn.commit()
-    conn.close()
+        cursor.execute('SELECT id FROM users WHERE email = ?', (admin_email,))
+        if not cursor.fetchone():
+            cursor.execute('''
+                INSERT INTO users (username, email, password_hash, role)
+                VALUES (?, ?, ?, ?)
+            ''', (admin_username, admin_email, admin_hash, 'admin'))
+
+        conn.commit()
 
 def hash_password(password):
     """Hash password using SHA256"""
@@ -69,11 +353,17 @@ def verify_password(password, hashed):
     return hashlib.sha256(password.encode()).hexdigest() == hashed
 
 def login_required(f):
-    """Decorator to require login"""
+    """Decorator to require login by an active user"""
     @wraps(f)
     def decorated_function(*args, **kwargs):
         if 'user_id' not in session:
             return redirect(url_for('login'))
+
+        user = auth_cache.get(session['user_id'])
+        if not user or not user[1]:
+            session.clear()
+            return redirect(url_for('login'))
+
         return f(*args, **kwargs)
     return decorated_function
 
@@ -84,54 +374,131 @@ def admin_required(f):
         if 'user_id' not in session:
             return redirect(url_for('login'))
 
-        conn = sqlite3.connect('users.db')
-        cursor = conn.cursor()
-        cursor.execute('SELECT role FROM users WHERE id = ?', (session['user_id'],))
-        user = cursor.fetchone()
-        conn.close()
+        user = auth_cache.get(session['user_id'])
 
-        if not user or user[0] != 'admin':
+        if not user or user[0] != 'admin' or not user[1]:
             flash('Admin access required', 'error')
             return redirect(url_for('login'))
 
         return f(*args, **kwargs)
     return decorated_function
 
-def get_logo_base64():
-    """Convert logo to base64 for embedding in HTML"""
+def remove_files(paths):
+    """Delete files, ignoring ones that are already gone"""
+    for path in paths:
+        try:
+            if os.path.exists(path):
+                os.remove(path)
+        except OSError as e:
+            print(f"Warning: Could not remove {path}: {e}")
+
+def load_logo():
+    """Read the logo PNG once at startup"""
     try:
-        # Try current directory first
-        logo_path = 'image (3).png'
-        if os.path.exists(logo_path):
-            with open(logo_path, 'rb') as f:
-                logo_data = f.read()
-                return base64.b64encode(logo_data).decode('utf-8')
-
-        # Fallback to Image directory
-        logo_path = os.path.join('Image', 'image (3).png')
-        if os.path.exists(logo_path):
-            with open(logo_path, 'rb') as f:
-                logo_data = f.read()
-                return base64.b64encode(logo_data).decode('utf-8')
+        # Try current directory first, then the Image directory
+        for logo_path in ('image (3).png', os.path.join('Image', 'image (3).png')):
+            if os.path.exists(logo_path):
+                with open(logo_path, 'rb') as f:
+                    return f.read()
     except Exception as e:
         print(f"Could not load logo: {e}")
     return None
 
-def preprocess_invoice_data_browse(input_gz_path, output_csv_path, task_id):
+# Static assets served from memory: name -> (body, mimetype, etag)
+STATIC_ASSETS = {}
+
+def register_asset(name, body, mimetype):
+    if isinstance(body, str):
+        body = body.encode('utf-8')
+    STATIC_ASSETS[name] = (body, mimetype, hashlib.sha256(body).hexdigest()[:16])
+
+def asset_url(name):
+    """Versioned URL of a static asset, safe to cache forever"""
+    return url_for('static_asset', name=name, v=STATIC_ASSETS[name][2])
+
+def logo_url():
+    return asset_url('logo.png') if 'logo.png' in STATIC_ASSETS else None
+
+# Processing pool: tasks run in worker processes; their progress comes back
+# through one queue and is applied to processing_status by a relay thread
+processing_pool = None
+processing_pool_lock = threading.Lock()
+_worker_progress = None  # progress queue, set in each worker process
+
+def _exit_with_parent(parent):
+    multiprocessing.connection.wait([parent.sentinel])
+    os._exit(1)
+
+def _init_processing_worker(progress_queue):
+    global _worker_progress
+    _worker_progress = progress_queue
+    # The server may exit without shutting the pool down (e.g. killed by a signal)
+    threading.Thread(target=_exit_with_parent, args=(multiprocessing.parent_process(),), daemon=True).start()
+
+def _run_processing_job(task_id, function, args, kwargs):
+    """Runs in a worker process: function(*args, **kwargs) reporting progress for task_id"""
+    def progress(message, percent):
+        _worker_progress.put((task_id, message, percent))
+    return function(*args, progress=progress, **kwargs)
+
+def _relay_progress(progress_queue):
+    while True:
+        task_id, message, percent = progress_queue.get()
+        status = processing_status.get(task_id)
+        if status is not None and status.get('status') == 'processing':
+            status['message'] = message
+            status['progress'] = percent
+
+def run_in_worker(task_id, function, *args, **kwargs):
+    """
+    Run an engine function in the processing pool and return its result.
+
+    The calling thread only waits, so CPU-bound processing never competes
+    with request handling in the server process.
+    """
+    global processing_pool
+    with processing_pool_lock:
+        if processing_pool is None:
+            # Spawned, not forked: workers must not inherit the server's sockets and threads
+            context = multiprocessing.get_context('spawn')
+            progress_queue = context.Queue()
+            threading.Thread(target=_relay_progress, args=(progress_queue,), daemon=True).start()
+            processing_pool = ProcessPoolExecutor(app.config['PROCESSING_WORKERS'], mp_context=context,
+                                                  initializer=_init_processing_worker,
+                                                  initargs=(progress_queue,))
+        pool = processing_pool
+    try:
+        return pool.submit(_run_processing_job, task_id, function, args, kwargs).result()
+    except BrokenProcessPool:
+        # A worker died (e.g. out of memory): start a fresh pool for later tasks
+        with processing_pool_lock:
+            if processing_pool is pool:
+                processing_pool = None
+        raise
+
+def preprocess_invoice_data_browse(input_gz_path, output_csv_path, task_id, index_path=None, history_source=None,
+                                   state_path=None, reference_path=None, counts_path=None, dry_run=False,
+                                   layout=None):
     """
     Process CSV with browse interface requirements
+
+    input_gz_path may be a list of shard paths forming one dataset; then
+    output_csv_path is either one combined output path or a list with one
+    output path per shard. index_path builds the result index used by
+    /results for single or combined outputs. Keys are checked against and
+    recorded in the key history under history_source (the uploaded file names).
+    With state_path, only the rows that are new since the previous run of
+    that incremental dataset are checked (see incremental). reference_path
+    adds the check against a reference file (Reference Remarks).
+    With dry_run, only the key counts are computed and saved to counts_path
+    (no output file); a later call with counts_path and an output path
+    writes the output from the saved counts. layout holds the output
+    layout options (group columns, clustered order, duplicates only).
     """
     try:
         print(f"=== STARTING PROCESSING FOR TASK {task_id} ===")
         print(f"Input file: {input_gz_path}")
         print(f"Output file: {output_csv_path}")
-        # Required columns for output
-        required_columns = [
-            'invoice_creation_date', 'payee_name', 'primary_vendor_code',
-            'barcode', 'invoice_status', 'header_po', 'invoice_no',
-            'invoice_date', 'invoice_source_name', 'invoice_quantity',
-            'invoice_amount'
-        ]
 
         processing_status[task_id] = {
             'status': 'processing',
@@ -140,158 +507,37 @@ def preprocess_invoice_data_browse(input_gz_path, output_csv_path, task_id):
             'start_time': datetime.now()
         }
 
-        processed_rows = []
-        total_input_lines = 0
-        lines_processed = 0
-
-        # Read CSV from gzipped file
-        with gzip.open(input_gz_path, 'rt', encoding='utf-8') as f:
-            reader = csv.DictReader(f)
-            headers = reader.fieldnames
-
-            processing_status[task_id]['message'] = 'Applying filters and processing data...'
-            processing_status[task_id]['progress'] = 30
-
-            for i, row in enumerate(reader):
-                total_input_lines += 1
-
-                # Apply 3 filters
-                invoice_status = (row.get('invoice_status', '') or '').lower()
-                invoice_source = (row.get('invoice_source_name', '') or '').upper()
-                invoice_no = (row.get('invoice_no', '') or '').upper()
-
-                # Filter logic: exclude cancelled, Dropship, and SCR invoices
-                if (invoice_status == 'cancelled' or
-                    invoice_source == 'DROPSHIP' or
-                    invoice_no.endswith('SCR')):
-                    continue
-
-                lines_processed += 1
-
-                # Select only required columns
-                filtered_row = {}
-                for col in required_columns:
-                    filtered_row[col] = row.get(col, '')
-
-                processed_rows.append(filtered_row)
-
-                # Update progress periodically
-                if total_input_lines % 50000 == 0:
-                    progress = 30 + min((total_input_lines / max(total_input_lines + 100000, 1)) * 40, 40)
-                    processing_status[task_id]['message'] = f'Processed {total_input_lines:,} input lines...'
-                    processing_status[task_id]['progress'] = int(progress)
-
-        processing_status[task_id]['message'] = 'Applying transformations and creating CONCAT patterns...'
-        processing_status[task_id]['progress'] = 75
-
-        # Apply transformations
-        for row in processed_rows:
-            # Transform amount
-            try:
-                amount = float(row.get('invoice_amount', '0') or '0')
-                amount_after_decimal = int(amount // 10)
-                row['invoice_amount_after_removing_decimal'] = str(amount_after_decimal)
-            except (ValueError, TypeError):
-                row['invoice_amount_after_removing_decimal'] = '0'
-
-            # Trim time portion from invoice_date and extract year
-            original_date = row.get('invoice_date', '')
-            trimmed_date = trim_date_format(original_date)
-            year = extract_year_from_date(trimmed_date)
-
-            # Update the invoice_date to the trimmed format (YYYY-MM-DD)
-            row['invoice_date'] = trimmed_date
-
-            # Add invoice_year as a separate column
-            row['invoice_year'] = year
-
-            # Create CONCAT columns with new names (using trimmed date)
-            header_po = row.get('header_po', '')
-            invoice_date = trimmed_date  # Use trimmed date format (YYYY-MM-DD)
-            primary_vendor = row.get('primary_vendor_code', '')
-            amount_str = row['invoice_amount_after_removing_decimal']
-
-            row['CONCAT 1(Header PO + Invoice Date + Invoice Amount)'] = f"{header_po}{invoice_date}{amount_str}"
-            row['CONCAT 2(Primary Vendor Code + Invoice Year + Invoice Amount)'] = f"{primary_vendor}{year}{amount_str}"
-            row['CONCAT 3(Header PO + Invoice Amount)'] = f"{header_po}{amount_str}"
-
-        processing_status[task_id]['message'] = 'Detecting duplicates...'
-        processing_status[task_id]['progress'] = 85
-
-        # Count duplicates and add remarks
-        concat1_counts = {}
-        concat2_counts = {}
-        concat3_counts = {}
-
-        for row in processed_rows:
-            concat1 = row['CONCAT 1(Header PO + Invoice Date + Invoice Amount)']
-            concat2 = row['CONCAT 2(Primary Vendor Code + Invoice Year + Invoice Amount)']
-            concat3 = row['CONCAT 3(Header PO + Invoice Amount)']
-
-            concat1_counts[concat1] = concat1_counts.get(concat1, 0) + 1
-            concat2_counts[concat2] = concat2_counts.get(concat2, 0) + 1
-            concat3_counts[concat3] = concat3_counts.get(concat3, 0) + 1
-
-        # Add remarks and count duplicates
-        concat1_duplicates = 0
-        concat2_duplicates = 0
-        concat3_duplicates = 0
-
-        for row in processed_rows:
-            # CONCAT 1 remarks
-            if concat1_counts[row['CONCAT 1(Header PO + Invoice Date + Invoice Amount)']] > 1:
-                row['CONCAT 1(Header PO + Invoice Date + Invoice Amount) Remarks'] = 'Duplicate'
-                concat1_duplicates += 1
-            else:
-                row['CONCAT 1(Header PO + Invoice Date + Invoice Amount) Remarks'] = 'Non Duplicate'
-
-            # CONCAT 2 remarks
-            if concat2_counts[row['CONCAT 2(Primary Vendor Code + Invoice Year + Invoice Amount)']] > 1:
-                row['CONCAT 2(Primary Vendor Code + Invoice Year + Invoice Amount) Remarks'] = 'Duplicate'
-                concat2_duplicates += 1
-            else:
-                row['CONCAT 2(Primary Vendor Code + Invoice Year + Invoice Amount) Remarks'] = 'Non Duplicate'
-
-            # CONCAT 3 remarks
-            if concat3_counts[row['CONCAT 3(Header PO + Invoice Amount)']] > 1:
-                row['CONCAT 3(Header PO + Invoice Amount) Remarks'] = 'Duplicate'
-                concat3_duplicates += 1
-            else:
-                row['CONCAT 3(Header PO + Invoice Amount) Remarks'] = 'Non Duplicate'
-
-        processing_status[task_id]['message'] = 'Saving processed file...'
-        processing_status[task_id]['progress'] = 95
-
-        # Write output CSV
-        output_columns = [
-            'invoice_source_name', 'primary_vendor_code', 'payee_name',
-            'invoice_status', 'invoice_creation_date', 'barcode',
-            'header_po', 'invoice_no', 'invoice_date', 'invoice_year',
-            'invoice_quantity', 'invoice_amount', 'invoice_amount_after_removing_decimal',
-            'CONCAT 1(Header PO + Invoice Date + Invoice Amount)', 'CONCAT 1(Header PO + Invoice Date + Invoice Amount) Remarks',
-            'CONCAT 2(Primary Vendor Code + Invoice Year + Invoice Amount)', 'CONCAT 2(Primary Vendor Code + Invoice Year + Invoice Amount) Remarks',
-            'CONCAT 3(Header PO + Invoice Amount)', 'CONCAT 3(Header PO + Invoice Amount) Remarks'
-        ]
-
-        if processed_rows:
-            first_row = processed_rows[0]
-            available_columns = [col for col in output_columns if col in first_row]
-
-            with open(output_csv_path, 'w', newline='', encoding='utf-8') as f:
-                writer = csv.DictWriter(f, fieldnames=available_columns)
-                writer.writeheader()
-                for row in processed_rows:
-                    filtered_row = {col: row.get(col, '') for col in available_columns}
-                    writer.writerow(filtered_row)
-
-        # Create summary
-        summary = {
-            'total_input_lines': total_input_lines,
-            'lines_processed': lines_processed,
-            'concat1_duplicates': concat1_duplicates,
-            'concat2_duplicates': concat2_duplicates,
-            'concat3_duplicates': concat3_duplicates
-        }
+        if dry_run:
+            summary = run_in_worker(task_id, count_invoice_data, input_gz_path, counts_path,
+                                    filters=app.config['ROW_FILTERS'],
+                                    key_limit=app.config['DRY_RUN_KEY_LIMIT'],
+                                    normalization=app.config['KEY_NORMALIZATION'])
+        elif counts_path:
+            summary = run_in_worker(task_id, materialize_output, counts_path, output_csv_path,
+                                    index_path=index_path, history_path=app.config['KEY_HISTORY_DATABASE'],
+                                    history_source=history_source, reference_path=reference_path,
+                                    reference_rules=app.config['REFERENCE_RULES'], layout=layout)
+        elif state_path:
+            with dataset_locks_lock:
+                dataset_lock = dataset_locks.setdefault(state_path, threading.Lock())
+            with dataset_lock:
+                summary = run_in_worker(task_id, process_invoice_delta, input_gz_path, output_csv_path, state_path,
+                                        filters=app.config['ROW_FILTERS'],
+                                        normalization=app.config['KEY_NORMALIZATION'])
+        elif isinstance(input_gz_path, list):
+            summary = run_in_worker(task_id, process_invoice_shards, input_gz_path, output_csv_path,
+                                    index_path=index_path, filters=app.config['ROW_FILTERS'],
+                                    history_path=app.config['KEY_HISTORY_DATABASE'],
+                                    history_source=history_source, reference_path=reference_path,
+                                    reference_rules=app.config['REFERENCE_RULES'], layout=layout,
+                                    normalization=app.config['KEY_NORMALIZATION'])
+        else:
+            summary = run_in_worker(task_id, process_invoice_file, input_gz_path, output_csv_path,
+                                    index_path=index_path, filters=app.config['ROW_FILTERS'],
+                                    history_path=app.config['KEY_HISTORY_DATABASE'],
+                                    history_source=history_source, reference_path=reference_path,
+                                    reference_rules=app.config['REFERENCE_RULES'], layout=layout,
+                                    normalization=app.config['KEY_NORMALIZATION'])
 
         # Calculate processing time
         end_time = datetime.now()
@@ -304,9 +550,17 @@ def preprocess_invoice_data_browse(input_gz_path, output_csv_path, task_id):
             'message': 'Processing completed successfully!',
             'progress': 100,
             'summary': summary,
-            'output_file': output_csv_path,
             'processing_time_mins': processing_time_mins
         }
+        if dry_run:
+            processing_status[task_id]['dry_run'] = True
+        elif isinstance(output_csv_path, list):
+            processing_status[task_id]['output_files'] = output_csv_path
+        else:
+            processing_status[task_id]['output_file'] = output_csv_path
+        if index_path and os.path.exists(index_path):
+            processing_status[task_id]['index_file'] = index_path
+        retention.touch(task_id)
 
     except Exception as e:
         error_msg = f"Error during processing: {str(e)}"
@@ -321,49 +575,8 @@ def preprocess_invoice_data_browse(input_gz_path, output_csv_path, task_id):
             'progress': 0
         }
 
-def extract_year_from_date(date_str):
-    """Extract year from date string"""
-    if not date_str:
-        return ''
-
-    try:
-        # Handle ISO format like "2022-07-09T00:00:00.000Z"
-        if 'T' in date_str:
-            date_str = date_str.split('T')[0]  # Extract date part before 'T'
-
-        for fmt in ['%Y-%m-%d', '%m/%d/%Y', '%d/%m/%Y', '%Y-%m-%d %H:%M:%S']:
-            try:
-                date_obj = datetime.strptime(date_str, fmt)
-                return str(date_obj.year)
-            except ValueError:
-                continue
-        return ''
-    except:
-        return ''
-
-def trim_date_format(date_str):
-    """Trim time portion from ISO date format, keep only YYYY-MM-DD"""
-    if not date_str:
-        return ''
-
-    try:
-        # Handle ISO format like "2022-07-09T00:00:00.000Z"
-        if 'T' in date_str:
-            date_str = date_str.split('T')[0]  # Extract date part before 'T'
-
-        return date_str
-    except:
-        return date_str
-
-# Landing page HTML template
-LANDING_PAGE_TEMPLATE = '''
-<!DOCTYPE html>
-<html lang="en">
-<head>
-    <meta charset="UTF-8">
-    <meta name="viewport" content="width=device-width, initial-scale=1.0">
-    <title>Pierian Services - Login</title>
-    <style>
+# Landing page styles
+LANDING_PAGE_CSS = '''
         * {
             margin: 0;
             padding: 0;
@@ -552,13 +765,23 @@ LANDING_PAGE_TEMPLATE = '''
         .admin-link a:hover {
             text-decoration: underline;
         }
-    </style>
+'''
+
+# Landing page HTML template
+LANDING_PAGE_TEMPLATE = '''
+<!DOCTYPE html>
+<html lang="en">
+<head>
+    <meta charset="UTF-8">
+    <meta name="viewport" content="width=device-width, initial-scale=1.0">
+    <title>Pierian Services - Login</title>
+    <link rel="stylesheet" href="{{ asset_url('landing.css') }}">
 </head>
 <body>
     <div class="login-container">
         <div class="logo-container">
-            {% if logo_data %}
-            <img src="data:image/png;base64,{{ logo_data }}" alt="Pierian Logo" class="logo-image">
+            {% if logo_url %}
+            <img src="{{ logo_url }}" alt="Pierian Logo" class="logo-image">
             {% else %}
             <div class="logo">pierian</div>
             {% endif %}
@@ -603,15 +826,8 @@ LANDING_PAGE_TEMPLATE = '''
 </html>
 '''
 
-# Admin panel HTML template
-ADMIN_PANEL_TEMPLATE = '''
-<!DOCTYPE html>
-<html lang="en">
-<head>
-    <meta charset="UTF-8">
-    <meta name="viewport" content="width=device-width, initial-scale=1.0">
-    <title>Admin Panel - Pierian Services</title>
-    <style>
+# Admin panel styles
+ADMIN_PANEL_CSS = '''
         * {
             margin: 0;
             padding: 0;
@@ -844,7 +1060,17 @@ ADMIN_PANEL_TEMPLATE = '''
                 text-align: center;
             }
         }
-    </style>
+'''
+
+# Admin panel HTML template
+ADMIN_PANEL_TEMPLATE = '''
+<!DOCTYPE html>
+<html lang="en">
+<head>
+    <meta charset="UTF-8">
+    <meta name="viewport" content="width=device-width, initial-scale=1.0">
+    <title>Admin Panel - Pierian Services</title>
+    <link rel="stylesheet" href="{{ asset_url('admin.css') }}">
 </head>
 <body>
     <div class="container">
@@ -941,15 +1167,8 @@ ADMIN_PANEL_TEMPLATE = '''
 </html>
 '''
 
-# Main application HTML template
-MAIN_APP_TEMPLATE = '''
-<!DOCTYPE html>
-<html lang="en">
-<head>
-    <meta charset="UTF-8">
-    <meta name="viewport" content="width=device-width, initial-scale=1.0">
-    <title>P2P Duplicate Invoice Check - Pierian</title>
-    <style>
+# Main application styles
+MAIN_APP_CSS = '''
         * { margin: 0; padding: 0; box-sizing: border-box; }
         body {
             font-family: 'Segoe UI', Tahoma, Geneva, Verdana, sans-serif;
@@ -1175,6 +1394,10 @@ MAIN_APP_TEMPLATE = '''
             background: linear-gradient(45deg, #e74c3c, #c82333);
         }
 
+        .preview-note { color: rgba(255, 255, 255, 0.8); text-align: center; margin-bottom: 15px; }
+        .preview-heading { color: #ffffff; margin-top: 15px; }
+        .preview-list { color: rgba(255, 255, 255, 0.9); margin: 10px 0 0 20px; font-size: 14px; }
+
         .error-section {
             background: rgba(255, 0, 0, 0.1); border: 1px solid rgba(255, 0, 0, 0.3);
             border-radius: 10px; padding: 20px; margin: 20px 0; color: #ff6b6b; display: none;
@@ -1265,142 +1488,11 @@ MAIN_APP_TEMPLATE = '''
                 font-size: 14px;
             }
         }
-    </style>
-</head>
-<body>
-    <div class="container">
-        <div class="main-header">
-            <div class="logo-section">
-                {% if logo_data %}
-                <div class="logo-container">
-                    <img src="data:image/png;base64,{{ logo_data }}" alt="Pierian Logo">
-                </div>
-                {% endif %}
-            </div>
-            <div class="header-content">
-                <h1>P2P Duplicate Invoice Check</h1>
-                <p>Upload, Process, and Download your invoice data with duplicate detection</p>
-            </div>
-            <div class="header-actions">
-                <div class="user-info">{{ session.username }}</div>
-                {% if session.role == 'admin' %}
-                <a href="{{ url_for('admin_panel') }}" class="header-btn admin-btn">Admin</a>
-                {% endif %}
-                <a href="{{ url_for('logout') }}" class="header-btn">Logout</a>
-            </div>
-        </div>
-
-        <div class="glossary-section" id="glossarySection">
-            <div class="glossary-title">
-                📚 Processing Glossary
-                <button class="toggle-btn" onclick="toggleGlossary()">Hide Details</button>
-            </div>
-            <div class="glossary-content">
-                <div class="glossary-item">
-                    <h4>📋 Filters Applied</h4>
-                    <p><strong>Cancelled Invoices:</strong> Excludes records where invoice_status contains "cancelled"<br>
-                    <strong>Dropship Exclusion:</strong> Excludes records where invoice_source_name = "DROPSHIP"<br>
-                    <strong>SCR Invoice Exclusion:</strong> Excludes records where invoice_no ends with "SCR"</p>
-                </div>
-                <div class="glossary-item">
-                    <h4>🔗 CONCAT 1</h4>
-                    <p><strong>Pattern:</strong> Header PO + Invoice Date + Invoice Amount<br>
-                    <strong>Purpose:</strong> Identifies duplicates based on purchase order, date, and amount combination</p>
-                </div>
-                <div class="glossary-item">
-                    <h4>🔗 CONCAT 2</h4>
-                    <p><strong>Pattern:</strong> Primary Vendor Code + Invoice Year + Invoice Amount<br>
-                    <strong>Purpose:</strong> Identifies duplicates based on vendor, year, and amount combination</p>
-                </div>
-                <div class="glossary-item">
-                    <h4>🔗 CONCAT 3</h4>
-                    <p><strong>Pattern:</strong> Header PO + Invoice Amount<br>
-                    <strong>Purpose:</strong> Identifies duplicates based on purchase order and amount combination</p>
-                </div>
-                <div class="glossary-item">
-                    <h4>💰 Amount Transformation</h4>
-                    <p><strong>Process:</strong> Converts invoice_amount to numeric, removes decimal places and rightmost digit<br>
-                    <strong>Example:</strong> 1234.56 becomes 123</p>
-                </div>
-                <div class="glossary-item">
-                    <h4>📊 Output File</h4>
-                    <p><strong>Format:</strong> CSV with original columns plus CONCAT patterns and duplicate remarks<br>
-                    <strong>Remarks:</strong> Each row marked as "Duplicate" or "Non Duplicate" for each pattern</p>
-                </div>
-            </div>
-        </div>
-
-        <div class="card">
-            <div class="browse-section">
-                <h3>📁 Select Input File</h3>
-                <p>Choose a .gz compressed CSV file to process</p>
-                <button class="browse-btn" onclick="document.getElementById('fileInput').click()">
-                    Browse Files
-                </button>
-                <input type="file" id="fileInput" class="file-input" accept=".gz">
-            </div>
-
-            <div class="selected-file" id="selectedFile">
-                <h4>✅ Selected File</h4>
-                <div id="fileName"></div>
-                <div id="fileSize"></div>
-            </div>
-
-            <button class="process-btn" id="processBtn" onclick="processFile()">
-                🚀 Process File
-            </button>
-
-            <div class="error-section" id="errorSection"></div>
-            <div class="success-section" id="successSection"></div>
-
-            <div class="progress-section" id="progressSection">
-                <h4>⏳ Processing...</h4>
-                <div class="progress-bar">
-                    <div class="progress-fill" id="progressFill"></div>
-                </div>
-                <div class="progress-text" id="progressText">Starting...</div>
-            </div>
-
-            <div class="summary-section" id="summarySection">
-                <div class="summary-title">📊 Processing Summary</div>
-                <div class="summary-grid">
-                    <div class="summary-item">
-                        <div class="summary-number" id="totalLines">0</div>
-                        <div class="summary-label">Total Input Lines</div>
-                    </div>
-                    <div class="summary-item">
-                        <div class="summary-number" id="processedLines">0</div>
-                        <div class="summary-label">Lines Processed</div>
-                    </div>
-                    <div class="summary-item">
-                        <div class="summary-number" id="concat1Dups">0</div>
-                        <div class="summary-label">CONCAT 1(Header PO + Invoice Date + Invoice Amount) Duplicates</div>
-                    </div>
-                    <div class="summary-item">
-                        <div class="summary-number" id="concat2Dups">0</div>
-                        <div class="summary-label">CONCAT 2(Primary Vendor Code + Invoice Year + Invoice Amount) Duplicates</div>
-                    </div>
-                    <div class="summary-item">
-                        <div class="summary-number" id="concat3Dups">0</div>
-                        <div class="summary-label">CONCAT 3(Header PO + Invoice Amount) Duplicates</div>
-                    </div>
-                </div>
-            </div>
-
-            <div class="download-section" id="downloadSection">
-                <h3>✅ Processing Complete!</h3>
-                <div class="time-display" id="processingTimeDisplay" style="display: none;">
-                    <span class="time-icon">⏱️</span>
-                    <span class="time-text">Processing completed in <strong id="processingTime">0</strong> minutes</span>
-                </div>
-                <p>Your processed CSV file is ready for download</p>
-                <a href="#" class="download-btn" id="downloadBtn">📥 Download Processed File</a>
-            </div>
-        </div>
-    </div>
+'''
 
-    <script>
-        let selectedFile = null;
+# Main application script
+MAIN_APP_JS = '''
+        let selectedFiles = [];
         let currentTaskId = null;
         let statusInterval = null;
 
@@ -1418,21 +1510,25 @@ MAIN_APP_TEMPLATE = '''
         }
 
         document.getElementById('fileInput').addEventListener('change', function(e) {
-            const file = e.target.files[0];
-            if (!file) return;
+            const files = Array.from(e.target.files);
+            if (!files.length) return;
 
-            if (!file.name.toLowerCase().endsWith('.gz')) {
-                showError('Please select a .gz file');
+            const extensions = ['.gz', '.zst', '.zstd', '.xz', '.bz2', '.csv'];
+            if (files.some(file => !extensions.some(ext => file.name.toLowerCase().endsWith(ext)))) {
+                showError('Please select .gz, .zst, .xz, .bz2 or .csv files only');
                 return;
             }
 
-            selectedFile = file;
+            selectedFiles = files;
 
             // Show selected file info
-            document.getElementById('fileName').textContent = 'File: ' + file.name;
-            document.getElementById('fileSize').textContent = 'Size: ' + (file.size / 1024 / 1024).toFixed(2) + ' MB';
+            const totalSize = files.reduce((sum, file) => sum + file.size, 0);
+            document.getElementById('fileName').textContent = (files.length === 1 ? 'File: ' : 'Files: ') + files.map(file => file.name).join(', ');
+            document.getElementById('fileSize').textContent = 'Size: ' + (totalSize / 1024 / 1024).toFixed(2) + ' MB';
+            document.getElementById('outputModeRow').style.display = files.length > 1 ? 'block' : 'none';
             document.getElementById('selectedFile').style.display = 'block';
             document.getElementById('processBtn').style.display = 'block';
+            document.getElementById('previewBtn').style.display = 'block';
 
             // Clear previous results when new file is selected
             clearPreviousResults();
@@ -1448,11 +1544,21 @@ MAIN_APP_TEMPLATE = '''
             document.getElementById('concat1Dups').textContent = '0';
             document.getElementById('concat2Dups').textContent = '0';
             document.getElementById('concat3Dups').textContent = '0';
+            document.getElementById('duplicateGroups').textContent = '0';
+            document.getElementById('amountAtRisk').textContent = '0';
+            document.getElementById('filteredLines').textContent = '0';
+            document.getElementById('duplicateClusters').textContent = '-';
+            document.getElementById('windowDups').textContent = '-';
+            document.getElementById('toleranceDups').textContent = '-';
+            document.getElementById('historyDups').textContent = '0';
+            document.getElementById('referenceDups').textContent = '-';
 
             // Hide download section and processing time
             document.getElementById('downloadSection').style.display = 'none';
             document.getElementById('processingTimeDisplay').style.display = 'none';
             document.getElementById('processingTime').textContent = '0';
+            document.getElementById('shardDownloads').innerHTML = '';
+            document.getElementById('previewSection').style.display = 'none';
 
             // Clear any existing task
             if (statusInterval) {
@@ -1462,47 +1568,230 @@ MAIN_APP_TEMPLATE = '''
             currentTaskId = null;
         }
 
-        function processFile() {
-            if (!selectedFile) {
-                showError('Please select a file first');
-                return;
-            }
-
-            const formData = new FormData();
-            formData.append('file', selectedFile);
+        const PARALLEL_CHUNKS = 4;
+        const PREVIEW_CHUNKS = 4;
+        const MAX_CHUNK_ATTEMPTS = 5;
 
+        async function postJson(url, body) {
+            const response = await fetch(url, {
+                method: 'POST',
+                headers: {'Content-Type': 'application/json'},
+                body: JSON.stringify(body)
+            });
+            const data = await response.json().catch(() => ({}));
+            if (!response.ok || data.error) {
+                throw new Error(data.error || `HTTP ${response.status}: ${response.statusText}`);
+            }
+            return data;
+        }
+
+        async function sha256Hex(buffer) {
+            // crypto.subtle is only available on https or localhost
+            if (!window.crypto || !window.crypto.subtle) return null;
+            const hash = await window.crypto.subtle.digest('SHA-256', buffer);
+            return Array.from(new Uint8Array(hash)).map(b => b.toString(16).padStart(2, '0')).join('');
+        }
+
+        function uploadKey(file) {
+            return `upload:${file.name}:${file.size}:${file.lastModified}`;
+        }
+
+        async function resumeOrInitUpload(file) {
+            // Resume an interrupted upload of the same file if the server still has it
+            const savedId = localStorage.getItem(uploadKey(file));
+            if (savedId) {
+                const response = await fetch(`/upload/${savedId}`);
+                if (response.ok) {
+                    const state = await response.json();
+                    return {
+                        uploadId: savedId,
+                        chunkSize: state.chunk_size,
+                        totalChunks: state.total_chunks,
+                        received: new Set(state.received_chunks)
+                    };
+                }
+                localStorage.removeItem(uploadKey(file));
+            }
+
+            const data = await postJson('/upload/init', {filename: file.name, size: file.size});
+            localStorage.setItem(uploadKey(file), data.upload_id);
+            return {
+                uploadId: data.upload_id,
+                chunkSize: data.chunk_size,
+                totalChunks: data.total_chunks,
+                received: new Set()
+            };
+        }
+
+        async function sendChunk(file, upload, index) {
+            const start = index * upload.chunkSize;
+            const buffer = await file.slice(start, start + upload.chunkSize).arrayBuffer();
+            const headers = {'Content-Type': 'application/octet-stream'};
+            const checksum = await sha256Hex(buffer);
+            if (checksum) headers['X-Chunk-SHA256'] = checksum;
+
+            for (let attempt = 1; ; attempt++) {
+                try {
+                    const response = await fetch(`/upload/${upload.uploadId}/chunk/${index}`, {
+                        method: 'PUT',
+                        headers: headers,
+                        body: buffer
+                    });
+                    if (response.ok) return;
+                    const data = await response.json().catch(() => ({}));
+                    throw new Error(data.error || `HTTP ${response.status}: ${response.statusText}`);
+                } catch (error) {
+                    if (attempt >= MAX_CHUNK_ATTEMPTS) throw error;
+                    await new Promise(resolve => setTimeout(resolve, 1000 * attempt));
+                }
+            }
+        }
+
+        async function uploadFiles(files, onProgress) {
+            const uploads = [];
+            for (const file of files) {
+                uploads.push(await resumeOrInitUpload(file));
+            }
+
+            const totalChunks = uploads.reduce((sum, upload) => sum + upload.totalChunks, 0);
+            let doneChunks = uploads.reduce((sum, upload) => sum + upload.received.size, 0);
+            const pending = [];
+            uploads.forEach((upload, fileIndex) => {
+                for (let index = 0; index < upload.totalChunks; index++) {
+                    if (!upload.received.has(index)) pending.push([fileIndex, index]);
+                }
+            });
+
+            async function worker() {
+                while (pending.length) {
+                    const [fileIndex, index] = pending.shift();
+                    await sendChunk(files[fileIndex], uploads[fileIndex], index);
+                    doneChunks++;
+                    onProgress(doneChunks, totalChunks);
+                }
+            }
+            await Promise.all(Array.from({length: PARALLEL_CHUNKS}, worker));
+            return uploads.map(upload => upload.uploadId);
+        }
+
+        function processFile() {
+            if (!selectedFiles.length) {
+                showError('Please select a file first');
+                return;
+            }
+
+            const files = selectedFiles;
+            const reference = document.getElementById('referenceInput').files[0];
+            const allFiles = reference ? files.concat([reference]) : files;
             document.getElementById('processBtn').disabled = true;
-            showProgress('Uploading file...', 5);
+            showProgress('Uploading file...', 0);
             hideMessages();
 
-            fetch('/upload', {
-                method: 'POST',
-                body: formData
-            })
-            .then(response => {
-                if (!response.ok) {
-                    throw new Error(`HTTP ${response.status}: ${response.statusText}`);
-                }
-                return response.json();
+            uploadFiles(allFiles, (done, total) => {
+                updateProgress(`Uploading file... ${done} of ${total} chunks`, Math.floor(100 * done / total));
             })
+            .then(uploadIds => postJson('/upload/finalize', {
+                upload_ids: reference ? uploadIds.slice(0, -1) : uploadIds,
+                reference_upload_id: reference ? uploadIds[uploadIds.length - 1] : null,
+                output_mode: document.getElementById('outputMode').value,
+                dataset: document.getElementById('datasetName').value.trim(),
+                dry_run: document.getElementById('dryRun').checked,
+                row_order: document.getElementById('rowOrder').value,
+                duplicates_only: document.getElementById('duplicatesOnly').checked
+            }))
             .then(data => {
-                if (data.error) {
-                    showError(data.error);
-                    document.getElementById('processBtn').disabled = false;
-                    hideProgress();
-                } else {
-                    currentTaskId = data.task_id;
-                    showSuccess('File uploaded successfully, processing started...');
-                    startStatusPolling();
-                }
+                allFiles.forEach(file => localStorage.removeItem(uploadKey(file)));
+                currentTaskId = data.task_id;
+                showSuccess('File uploaded successfully, processing started...');
+                startStatusPolling();
             })
             .catch(error => {
-                showError('Upload failed: ' + error.message);
+                showError('Upload failed: ' + error.message + ' (select the same file again to resume)');
                 document.getElementById('processBtn').disabled = false;
                 hideProgress();
             });
         }
 
+        async function previewFile() {
+            if (!selectedFiles.length) {
+                showError('Please select a file first');
+                return;
+            }
+
+            // Upload only the start of the first file; Process File resumes the same upload
+            const file = selectedFiles[0];
+            document.getElementById('previewBtn').disabled = true;
+            showProgress('Uploading the start of the file...', 0);
+            hideMessages();
+            try {
+                const upload = await resumeOrInitUpload(file);
+                const chunks = Math.min(PREVIEW_CHUNKS, upload.totalChunks);
+                for (let index = 0; index < chunks; index++) {
+                    if (!upload.received.has(index)) await sendChunk(file, upload, index);
+                    updateProgress('Uploading the start of the file...', Math.floor(100 * (index + 1) / chunks));
+                }
+                updateProgress('Estimating duplicates...', 100);
+                const response = await fetch(`/upload/${upload.uploadId}/preview`);
+                const data = await response.json().catch(() => ({}));
+                if (!response.ok || data.error) {
+                    throw new Error(data.error || `HTTP ${response.status}: ${response.statusText}`);
+                }
+                showPreview(data);
+            } catch (error) {
+                showError('Preview failed: ' + error.message);
+            } finally {
+                hideProgress();
+                document.getElementById('previewBtn').disabled = false;
+            }
+        }
+
+        function showPreview(preview) {
+            const percent = value => (100 * value).toFixed(1) + '%';
+            const scope = preview.complete ? 'the whole file' : `about ${percent(preview.fraction_read)} of the file`;
+            const sampled = preview.sample_rate < 1 ? `, ${percent(preview.sample_rate)} of keys` : '';
+            document.getElementById('previewNote').textContent =
+                `Read ${formatIndianNumber(preview.total_input_lines)} lines (${scope}${sampled}) in ${preview.seconds}s. ` +
+                'Whole-file estimates with 95% intervals; duplicates beyond the part read are not seen.';
+
+            const labels = {concat1: 'CONCAT 1', concat2: 'CONCAT 2', concat3: 'CONCAT 3'};
+            const rules = document.getElementById('previewRules');
+            const examples = document.getElementById('previewExamples');
+            rules.innerHTML = '';
+            examples.innerHTML = '';
+            Object.entries(preview.rules).forEach(([rule, estimate]) => {
+                const item = document.createElement('div');
+                item.className = 'summary-item';
+                const number = document.createElement('div');
+                number.className = 'summary-number';
+                number.textContent = percent(estimate.duplicate_rate);
+                const label = document.createElement('div');
+                label.className = 'summary-label';
+                const [low, high] = estimate.confidence_interval;
+                label.textContent = `${labels[rule]} duplicate rows (${percent(low)} - ${percent(high)}), ` +
+                    `~${formatIndianNumber(estimate.estimated_duplicate_rows)} rows in ` +
+                    `~${formatIndianNumber(estimate.estimated_duplicate_groups)} groups`;
+                item.appendChild(number);
+                item.appendChild(label);
+                rules.appendChild(item);
+
+                estimate.examples.forEach(example => {
+                    const line = document.createElement('li');
+                    line.textContent = `${labels[rule]} ${example.key} (${example.rows} rows): ` +
+                        example.sample_rows.map(row => `${row.invoice_no} ${row.invoice_amount}`).join(', ');
+                    examples.appendChild(line);
+                });
+            });
+
+            const problems = document.getElementById('previewProblems');
+            problems.innerHTML = '';
+            (preview.schema_problems.length ? preview.schema_problems : ['No schema problems found']).forEach(problem => {
+                const line = document.createElement('li');
+                line.textContent = problem;
+                problems.appendChild(line);
+            });
+            document.getElementById('previewSection').style.display = 'block';
+        }
+
         function startStatusPolling() {
             statusInterval = setInterval(checkStatus, 2000);
         }
@@ -1524,7 +1813,31 @@ MAIN_APP_TEMPLATE = '''
                         document.getElementById('processingTimeDisplay').style.display = 'flex';
                     }
 
-                    document.getElementById('downloadBtn').href = `/download/${currentTaskId}`;
+                    const downloadBtn = document.getElementById('downloadBtn');
+                    const shardDownloads = document.getElementById('shardDownloads');
+                    const materializeBtn = document.getElementById('materializeBtn');
+                    shardDownloads.innerHTML = '';
+                    materializeBtn.style.display = data.dry_run ? 'inline-block' : 'none';
+                    document.getElementById('downloadText').textContent = data.dry_run
+                        ? 'Dry run complete: the summary lists the duplicate keys. Write the output file when needed.'
+                        : 'Your processed CSV file is ready for download';
+                    if (data.dry_run) {
+                        downloadBtn.style.display = 'none';
+                    } else if (data.output_files) {
+                        downloadBtn.style.display = 'none';
+                        data.output_files.forEach((_, index) => {
+                            const link = document.createElement('a');
+                            link.className = 'download-btn';
+                            link.href = `/download/${currentTaskId}/${index}`;
+                            link.textContent = `📥 Download Part ${index + 1}`;
+                            shardDownloads.appendChild(link);
+                            shardDownloads.appendChild(document.createTextNode(' '));
+                        });
+                    } else {
+                        downloadBtn.style.display = 'inline-block';
+                        downloadBtn.href = `/download/${currentTaskId}`;
+                    }
+                    document.getElementById('summaryDownloadBtn').href = `/summary/${currentTaskId}`;
                     document.getElementById('downloadSection').style.display = 'block';
                     document.getElementById('processBtn').disabled = false;
                 } else if (data.status === 'error') {
@@ -1541,6 +1854,20 @@ MAIN_APP_TEMPLATE = '''
             });
         }
 
+        function materializeOutput() {
+            if (!currentTaskId) return;
+            document.getElementById('materializeBtn').style.display = 'none';
+            document.getElementById('downloadSection').style.display = 'none';
+            showProgress('Writing output file...', 0);
+            hideMessages();
+            postJson(`/materialize/${currentTaskId}`, {})
+            .then(() => startStatusPolling())
+            .catch(error => {
+                hideProgress();
+                showError('Could not write output: ' + error.message);
+            });
+        }
+
         function showProgress(message, progress) {
             document.getElementById('progressSection').style.display = 'block';
             updateProgress(message, progress);
@@ -1566,6 +1893,51 @@ MAIN_APP_TEMPLATE = '''
             document.getElementById('concat1Dups').textContent = formatIndianNumber(summary.concat1_duplicates);
             document.getElementById('concat2Dups').textContent = formatIndianNumber(summary.concat2_duplicates);
             document.getElementById('concat3Dups').textContent = formatIndianNumber(summary.concat3_duplicates);
+            if (summary.filtered) {
+                document.getElementById('filteredLines').textContent = Object.entries(summary.filtered)
+                    .map(([name, count]) => `${name}: ${formatIndianNumber(count)}`).join(' / ') || '0';
+            }
+
+            if (summary.history) {
+                document.getElementById('historyDups').textContent = ['concat1', 'concat2', 'concat3']
+                    .map(rule => formatIndianNumber(summary.history[rule])).join(' / ');
+            }
+
+            if (summary.reference) {
+                document.getElementById('referenceDups').textContent = Object.entries(summary.reference.rows)
+                    .map(([rule, count]) => `${rule}: ${formatIndianNumber(count)}`).join(' / ');
+            }
+
+            if (summary.duplicate_key_counts) {
+                document.getElementById('duplicateGroups').textContent = ['concat1', 'concat2', 'concat3']
+                    .map(rule => formatIndianNumber(summary.duplicate_key_counts[rule])).join(' / ');
+            }
+
+            if (summary.analytics) {
+                const rules = summary.analytics.rules;
+                document.getElementById('duplicateGroups').textContent = ['concat1', 'concat2', 'concat3']
+                    .map(rule => formatIndianNumber(rules[rule].duplicate_groups)).join(' / ');
+                document.getElementById('amountAtRisk').textContent = formatIndianNumber(summary.analytics.amount_at_risk);
+            }
+
+            if (summary.time_window) {
+                document.getElementById('windowDups').textContent =
+                    `${formatIndianNumber(summary.time_window.duplicates)} (${formatIndianNumber(summary.time_window.missed_by_concat2)} missed by CONCAT 2)`;
+                document.getElementById('windowLabel').textContent =
+                    `Same Vendor and Amount within ${summary.time_window.days} Days`;
+            }
+
+            if (summary.amount_tolerance) {
+                document.getElementById('toleranceDups').textContent = ['concat1', 'concat2', 'concat3']
+                    .map(rule => formatIndianNumber(summary.amount_tolerance.rows[rule])).join(' / ');
+                document.getElementById('toleranceLabel').textContent =
+                    `Duplicates within ${summary.amount_tolerance.tolerance} (CONCAT 1 / 2 / 3)`;
+            }
+
+            if (summary.clusters) {
+                document.getElementById('duplicateClusters').textContent =
+                    `${formatIndianNumber(summary.clusters.clusters)} (${formatIndianNumber(summary.clusters.clusters_spanning_rules)} across rules)`;
+            }
 
             document.getElementById('summarySection').style.display = 'block';
         }
@@ -1584,18 +1956,269 @@ MAIN_APP_TEMPLATE = '''
             document.getElementById('errorSection').style.display = 'none';
             document.getElementById('successSection').style.display = 'none';
         }
-    </script>
+'''
+
+# Main application HTML template
+MAIN_APP_TEMPLATE = '''
+<!DOCTYPE html>
+<html lang="en">
+<head>
+    <meta charset="UTF-8">
+    <meta name="viewport" content="width=device-width, initial-scale=1.0">
+    <title>P2P Duplicate Invoice Check - Pierian</title>
+    <link rel="stylesheet" href="{{ asset_url('main_app.css') }}">
+</head>
+<body>
+    <div class="container">
+        <div class="main-header">
+            <div class="logo-section">
+                {% if logo_url %}
+                <div class="logo-container">
+                    <img src="{{ logo_url }}" alt="Pierian Logo">
+                </div>
+                {% endif %}
+            </div>
+            <div class="header-content">
+                <h1>P2P Duplicate Invoice Check</h1>
+                <p>Upload, Process, and Download your invoice data with duplicate detection</p>
+            </div>
+            <div class="header-actions">
+                <div class="user-info">{{ session.username }}</div>
+                {% if session.role == 'admin' %}
+                <a href="{{ url_for('admin_panel') }}" class="header-btn admin-btn">Admin</a>
+                {% endif %}
+                <a href="{{ url_for('logout') }}" class="header-btn">Logout</a>
+            </div>
+        </div>
+
+        <div class="glossary-section" id="glossarySection">
+            <div class="glossary-title">
+                📚 Processing Glossary
+                <button class="toggle-btn" onclick="toggleGlossary()">Hide Details</button>
+            </div>
+            <div class="glossary-content">
+                <div class="glossary-item">
+                    <h4>📋 Filters Applied</h4>
+                    <p><strong>Cancelled Invoices:</strong> Excludes records where invoice_status contains "cancelled"<br>
+                    <strong>Dropship Exclusion:</strong> Excludes records where invoice_source_name = "DROPSHIP"<br>
+                    <strong>SCR Invoice Exclusion:</strong> Excludes records where invoice_no ends with "SCR"</p>
+                </div>
+                <div class="glossary-item">
+                    <h4>🔗 CONCAT 1</h4>
+                    <p><strong>Pattern:</strong> Header PO + Invoice Date + Invoice Amount<br>
+                    <strong>Purpose:</strong> Identifies duplicates based on purchase order, date, and amount combination</p>
+                </div>
+                <div class="glossary-item">
+                    <h4>🔗 CONCAT 2</h4>
+                    <p><strong>Pattern:</strong> Primary Vendor Code + Invoice Year + Invoice Amount<br>
+                    <strong>Purpose:</strong> Identifies duplicates based on vendor, year, and amount combination</p>
+                </div>
+                <div class="glossary-item">
+                    <h4>🔗 CONCAT 3</h4>
+                    <p><strong>Pattern:</strong> Header PO + Invoice Amount<br>
+                    <strong>Purpose:</strong> Identifies duplicates based on purchase order and amount combination</p>
+                </div>
+                <div class="glossary-item">
+                    <h4>💰 Amount Transformation</h4>
+                    <p><strong>Process:</strong> Converts invoice_amount to numeric, removes decimal places and rightmost digit<br>
+                    <strong>Example:</strong> 1234.56 becomes 123</p>
+                </div>
+                <div class="glossary-item">
+                    <h4>📊 Output File</h4>
+                    <p><strong>Format:</strong> CSV with original columns plus CONCAT patterns and duplicate remarks<br>
+                    <strong>Remarks:</strong> Each row marked as "Duplicate" or "Non Duplicate" for each pattern</p>
+                </div>
+            </div>
+        </div>
+
+        <div class="card">
+            <div class="browse-section">
+                <h3>📁 Select Input File</h3>
+                <p>Choose a CSV file (.gz, .zst, .xz, .bz2 or plain .csv) to process (select several parts of one export to check them as one dataset)</p>
+                <button class="browse-btn" onclick="document.getElementById('fileInput').click()">
+                    Browse Files
+                </button>
+                <input type="file" id="fileInput" class="file-input" accept=".gz,.zst,.zstd,.xz,.bz2,.csv" multiple>
+            </div>
+
+            <div class="selected-file" id="selectedFile">
+                <h4>✅ Selected File</h4>
+                <div id="fileName"></div>
+                <div id="fileSize"></div>
+                <div id="outputModeRow" style="display: none; margin-top: 10px;">
+                    <label for="outputMode">Output: </label>
+                    <select id="outputMode">
+                        <option value="combined">One combined file</option>
+                        <option value="per_shard">One file per part</option>
+                    </select>
+                </div>
+                <div style="margin-top: 10px;">
+                    <label for="datasetName">Incremental dataset (optional): </label>
+                    <input type="text" id="datasetName" placeholder="e.g. daily_ap_feed">
+                </div>
+                <div style="margin-top: 10px;">
+                    <label for="referenceInput">Reference file to check against (optional): </label>
+                    <input type="file" id="referenceInput" accept=".gz,.zst,.zstd,.xz,.bz2,.csv">
+                </div>
+                <div style="margin-top: 10px;">
+                    <label for="rowOrder">Row order: </label>
+                    <select id="rowOrder">
+                        <option value="input">As in the input file</option>
+                        <option value="concat1">Duplicate groups together (CONCAT 1)</option>
+                        <option value="concat2">Duplicate groups together (CONCAT 2)</option>
+                        <option value="concat3">Duplicate groups together (CONCAT 3)</option>
+                    </select>
+                </div>
+                <div style="margin-top: 10px;">
+                    <label><input type="checkbox" id="duplicatesOnly"> Duplicates only (leave out rows no rule marks as Duplicate)</label>
+                </div>
+                <div style="margin-top: 10px;">
+                    <label><input type="checkbox" id="dryRun"> Summary only (dry run, the output file can be written later)</label>
+                </div>
+            </div>
+
+            <button class="process-btn" id="previewBtn" onclick="previewFile()">
+                🔍 Quick Preview
+            </button>
+            <button class="process-btn" id="processBtn" onclick="processFile()">
+                🚀 Process File
+            </button>
+
+            <div class="error-section" id="errorSection"></div>
+            <div class="success-section" id="successSection"></div>
+
+            <div class="progress-section" id="progressSection">
+                <h4>⏳ Processing...</h4>
+                <div class="progress-bar">
+                    <div class="progress-fill" id="progressFill"></div>
+                </div>
+                <div class="progress-text" id="progressText">Starting...</div>
+            </div>
+
+            <div class="summary-section" id="previewSection">
+                <div class="summary-title">🔍 Quick Preview</div>
+                <p class="preview-note" id="previewNote"></p>
+                <div class="summary-grid" id="previewRules"></div>
+                <h4 class="preview-heading">Schema checks</h4>
+                <ul class="preview-list" id="previewProblems"></ul>
+                <h4 class="preview-heading">Example duplicate groups</h4>
+                <ul class="preview-list" id="previewExamples"></ul>
+            </div>
+
+            <div class="summary-section" id="summarySection">
+                <div class="summary-title">📊 Processing Summary</div>
+                <div class="summary-grid">
+                    <div class="summary-item">
+                        <div class="summary-number" id="totalLines">0</div>
+                        <div class="summary-label">Total Input Lines</div>
+                    </div>
+                    <div class="summary-item">
+                        <div class="summary-number" id="processedLines">0</div>
+                        <div class="summary-label">Lines Processed</div>
+                    </div>
+                    <div class="summary-item">
+                        <div class="summary-number" id="filteredLines">0</div>
+                        <div class="summary-label">Rows Filtered Out (per filter)</div>
+                    </div>
+                    <div class="summary-item">
+                        <div class="summary-number" id="concat1Dups">0</div>
+                        <div class="summary-label">CONCAT 1(Header PO + Invoice Date + Invoice Amount) Duplicates</div>
+                    </div>
+                    <div class="summary-item">
+                        <div class="summary-number" id="concat2Dups">0</div>
+                        <div class="summary-label">CONCAT 2(Primary Vendor Code + Invoice Year + Invoice Amount) Duplicates</div>
+                    </div>
+                    <div class="summary-item">
+                        <div class="summary-number" id="concat3Dups">0</div>
+                        <div class="summary-label">CONCAT 3(Header PO + Invoice Amount) Duplicates</div>
+                    </div>
+                    <div class="summary-item">
+                        <div class="summary-number" id="duplicateGroups">0</div>
+                        <div class="summary-label">Duplicate Groups (CONCAT 1 / 2 / 3)</div>
+                    </div>
+                    <div class="summary-item">
+                        <div class="summary-number" id="amountAtRisk">0</div>
+                        <div class="summary-label">Amount at Risk (any CONCAT duplicate)</div>
+                    </div>
+                    <div class="summary-item">
+                        <div class="summary-number" id="windowDups">-</div>
+                        <div class="summary-label" id="windowLabel">Same Vendor and Amount within N Days</div>
+                    </div>
+                    <div class="summary-item">
+                        <div class="summary-number" id="toleranceDups">-</div>
+                        <div class="summary-label" id="toleranceLabel">Duplicates within Amount Tolerance (CONCAT 1 / 2 / 3)</div>
+                    </div>
+                    <div class="summary-item">
+                        <div class="summary-number" id="duplicateClusters">-</div>
+                        <div class="summary-label">Duplicate Clusters (all CONCAT rules)</div>
+                    </div>
+                    <div class="summary-item">
+                        <div class="summary-number" id="historyDups">0</div>
+                        <div class="summary-label">Seen in Earlier Uploads (CONCAT 1 / 2 / 3)</div>
+                    </div>
+                    <div class="summary-item">
+                        <div class="summary-number" id="referenceDups">-</div>
+                        <div class="summary-label">Duplicates of Reference File</div>
+                    </div>
+                </div>
+            </div>
+
+            <div class="download-section" id="downloadSection">
+                <h3>✅ Processing Complete!</h3>
+                <div class="time-display" id="processingTimeDisplay" style="display: none;">
+                    <span class="time-icon">⏱️</span>
+                    <span class="time-text">Processing completed in <strong id="processingTime">0</strong> minutes</span>
+                </div>
+                <p id="downloadText">Your processed CSV file is ready for download</p>
+                <a href="#" class="download-btn" id="downloadBtn">📥 Download Processed File</a>
+                <a href="#" class="download-btn" id="materializeBtn" style="display: none;" onclick="materializeOutput(); return false;">📝 Write Output File</a>
+                <div id="shardDownloads"></div>
+                <a href="#" class="download-btn" id="summaryDownloadBtn">📄 Download Summary (JSON)</a>
+            </div>
+        </div>
+    </div>
+
+    <script src="{{ asset_url('main_app.js') }}"></script>
 </body>
 </html>
 '''
 
+# Templates are compiled once at startup and served through render_template
+app.jinja_loader = DictLoader({
+    'landing.html': LANDING_PAGE_TEMPLATE,
+    'admin.html': ADMIN_PANEL_TEMPLATE,
+    'main_app.html': MAIN_APP_TEMPLATE
+})
+app.jinja_env.globals['asset_url'] = asset_url
+for template_name in app.jinja_loader.list_templates():
+    app.jinja_env.get_template(template_name)
+
+register_asset('landing.css', LANDING_PAGE_CSS, 'text/css')
+register_asset('admin.css', ADMIN_PANEL_CSS, 'text/css')
+register_asset('main_app.css', MAIN_APP_CSS, 'text/css')
+register_asset('main_app.js', MAIN_APP_JS, 'application/javascript')
+logo = load_logo()
+if logo:
+    register_asset('logo.png', logo, 'image/png')
+
 # Routes
 
+@app.route('/assets/<name>')
+def static_asset(name):
+    """Static CSS/JS/logo with long-lived cache headers and ETag revalidation"""
+    asset = STATIC_ASSETS.get(name)
+    if not asset:
+        return jsonify({'error': 'Not found'}), 404
+    body, mimetype, etag = asset
+    response = Response(body, mimetype=mimetype)
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'public, max-age=31536000, immutable'
+    return response.make_conditional(request)
+
 @app.route('/')
 def login():
     """Landing page with login form"""
-    logo_data = get_logo_base64()
-    return render_template_string(LANDING_PAGE_TEMPLATE, messages=session.pop('_flashes', []), logo_data=logo_data)
+    return render_template('landing.html', messages=session.pop('_flashes', []), logo_url=logo_url())
 
 @app.route('/', methods=['POST'])
 def login_post():
@@ -1607,11 +2230,8 @@ def login_post():
         flash('Please fill in all fields', 'error')
         return redirect(url_for('login'))
 
-    conn = sqlite3.connect('users.db')
-    cursor = conn.cursor()
-    cursor.execute('SELECT id, username, password_hash, role, is_active FROM users WHERE email = ?', (email,))
-    user = cursor.fetchone()
-    conn.close()
+    with db_pool.connection() as conn:
+        user = conn.execute(SQL_USER_LOGIN, (email,)).fetchone()
 
     if user and verify_password(password, user[2]) and user[4]:  # user[4] is is_active
         session['user_id'] = user[0]
@@ -1630,17 +2250,16 @@ def login_post():
 @admin_required
 def admin_panel():
     """Admin panel for user management"""
-    conn = sqlite3.connect('users.db')
-    cursor = conn.cursor()
+    with db_pool.connection() as conn:
+        cursor = conn.cursor()
 
-    # Get current user info
-    cursor.execute('SELECT id, username, email, role FROM users WHERE id = ?', (session['user_id'],))
-    current_user = cursor.fetchone()
+        # Get current user info
+        cursor.execute('SELECT id, username, email, role FROM users WHERE id = ?', (session['user_id'],))
+        current_user = cursor.fetchone()
 
-    # Get all users
-    cursor.execute('SELECT id, username, email, role, is_active, created_at FROM users ORDER BY created_at DESC')
-    users = cursor.fetchall()
-    conn.close()
+        # Get all users
+        cursor.execute('SELECT id, username, email, role, is_active, created_at FROM users ORDER BY created_at DESC')
+        users = cursor.fetchall()
 
     # Convert to objects for template
     current_user_obj = type('User', (), {
@@ -1662,7 +2281,7 @@ def admin_panel():
         })()
         users_list.append(user_obj)
 
-    return render_template_string(ADMIN_PANEL_TEMPLATE,
+    return render_template('admin.html',
                                 current_user=current_user_obj,
                                 users=users_list,
                                 messages=session.pop('_flashes', []))
@@ -1684,53 +2303,51 @@ def create_user():
         flash('Invalid role selected', 'error')
         return redirect(url_for('admin_panel'))
 
-    conn = sqlite3.connect('users.db')
-    cursor = conn.cursor()
+    with db_pool.connection() as conn:
+        cursor = conn.cursor()
 
-    # Check if username or email already exists
-    cursor.execute('SELECT id FROM users WHERE username = ? OR email = ?', (username, email))
-    if cursor.fetchone():
-        flash('Username or email already exists', 'error')
-        conn.close()
-        return redirect(url_for('admin_panel'))
+        # Check if username or email already exists
+        cursor.execute('SELECT id FROM users WHERE username = ? OR email = ?', (username, email))
+        if cursor.fetchone():
+            flash('Username or email already exists', 'error')
+            return redirect(url_for('admin_panel'))
 
-    # Create new user
-    password_hash = hash_password(password)
-    try:
-        cursor.execute('''
-            INSERT INTO users (username, email, password_hash, role)
-            VALUES (?, ?, ?, ?)
-        ''', (username, email, password_hash, role))
-        conn.commit()
-        flash(f'User {username} created successfully', 'success')
-    except Exception as e:
-        flash(f'Error creating user: {str(e)}', 'error')
+        # Create new user
+        password_hash = hash_password(password)
+        try:
+            cursor.execute('''
+                INSERT INTO users (username, email, password_hash, role)
+                VALUES (?, ?, ?, ?)
+            ''', (username, email, password_hash, role))
+            conn.commit()
+            flash(f'User {username} created successfully', 'success')
+        except Exception as e:
+            flash(f'Error creating user: {str(e)}', 'error')
 
-    conn.close()
     return redirect(url_for('admin_panel'))
 
 @app.route('/admin/toggle_user/<int:user_id>', methods=['POST'])
 @admin_required
 def toggle_user_status(user_id):
     """Toggle user active status"""
-    conn = sqlite3.connect('users.db')
-    cursor = conn.cursor()
+    with db_pool.connection() as conn:
+        cursor = conn.cursor()
 
-    # Get current status
-    cursor.execute('SELECT is_active, username FROM users WHERE id = ?', (user_id,))
-    user = cursor.fetchone()
+        # Get current status
+        cursor.execute('SELECT is_active, username FROM users WHERE id = ?', (user_id,))
+        user = cursor.fetchone()
 
-    if user:
-        new_status = 0 if user[0] else 1
-        cursor.execute('UPDATE users SET is_active = ? WHERE id = ?', (new_status, user_id))
-        conn.commit()
+        if user:
+            new_status = 0 if user[0] else 1
+            cursor.execute('UPDATE users SET is_active = ? WHERE id = ?', (new_status, user_id))
+            conn.commit()
+            auth_cache.invalidate(user_id)
 
-        status_text = 'activated' if new_status else 'deactivated'
-        flash(f'User {user[1]} has been {status_text}', 'success')
-    else:
-        flash('User not found', 'error')
+            status_text = 'activated' if new_status else 'deactivated'
+            flash(f'User {user[1]} has been {status_text}', 'success')
+        else:
+            flash('User not found', 'error')
 
-    conn.close()
     return redirect(url_for('admin_panel'))
 
 @app.route('/admin/delete_user/<int:user_id>', methods=['POST'])
@@ -1741,20 +2358,20 @@ def delete_user(user_id):
         flash('Cannot delete your own account', 'error')
         return redirect(url_for('admin_panel'))
 
-    conn = sqlite3.connect('users.db')
-    cursor = conn.cursor()
+    with db_pool.connection() as conn:
+        cursor = conn.cursor()
 
-    cursor.execute('SELECT username FROM users WHERE id = ?', (user_id,))
-    user = cursor.fetchone()
+        cursor.execute('SELECT username FROM users WHERE id = ?', (user_id,))
+        user = cursor.fetchone()
 
-    if user:
-        cursor.execute('DELETE FROM users WHERE id = ?', (user_id,))
-        conn.commit()
-        flash(f'User {user[0]} has been deleted', 'success')
-    else:
-        flash('User not found', 'error')
+        if user:
+            cursor.execute('DELETE FROM users WHERE id = ?', (user_id,))
+            conn.commit()
+            auth_cache.invalidate(user_id)
+            flash(f'User {user[0]} has been deleted', 'success')
+        else:
+            flash('User not found', 'error')
 
-    conn.close()
     return redirect(url_for('admin_panel'))
 
 @app.route('/logout')
@@ -1768,8 +2385,156 @@ def logout():
 @login_required
 def main_app():
     """Main application page"""
-    logo_data = get_logo_base64()
-    return render_template_string(MAIN_APP_TEMPLATE, logo_data=logo_data, session=session)
+    return render_template('main_app.html', logo_url=logo_url(), session=session)
+
+def start_processing(task_id, input_paths, filenames, output_mode, dataset='', reference=None, dry_run=False,
+                     row_order='input', duplicates_only=False):
+    """
+    Validate saved input files and start background processing; returns the
+    upload response. A dataset name runs the incremental check for that
+    dataset; reference is a saved (path, filename) to check the input against.
+    A dry run only counts keys; its output is written later by /materialize.
+    row_order is 'input' or a CONCAT rule whose duplicate groups are written
+    contiguously; duplicates_only leaves the other rows out of the output.
+    """
+    reference_path, reference_name = reference or (None, None)
+    saved_paths = input_paths + ([reference_path] if reference_path else [])
+
+    state_path = None
+    if dataset and dry_run:
+        remove_files(saved_paths)
+        return jsonify({'error': 'A dry run cannot be combined with an incremental dataset'}), 400
+    if row_order not in ('input', *RULES):
+        remove_files(saved_paths)
+        return jsonify({'error': f"Row order must be input or one of {', '.join(RULES)}"}), 400
+    if dataset and (row_order != 'input' or duplicates_only):
+        remove_files(saved_paths)
+        return jsonify({'error': 'Incremental runs are written in input order with all new rows'}), 400
+    layout = {
+        'group_columns': app.config['OUTPUT_GROUP_COLUMNS'],
+        'clusters': app.config['OUTPUT_CLUSTERS'],
+        'window_days': app.config['TIME_WINDOW_DAYS'],
+        'amount_tolerance': app.config['AMOUNT_TOLERANCE'],
+        'cluster_rule': None if row_order == 'input' else row_order,
+        'duplicates_only': duplicates_only
+    }
+    if dataset:
+        if len(input_paths) != 1 or not secure_filename(dataset) or reference_path:
+            remove_files(saved_paths)
+            return jsonify({'error': 'Incremental mode needs one file, a valid dataset name and no reference file'}), 400
+        state_path = os.path.join(STATE_FOLDER, f"{secure_filename(dataset)}.state")
+
+    if reference_path:
+        try:
+            if not any(col.strip() for col in read_header(reference_path)):
+                raise ValueError('File appears to be empty or corrupted')
+        except Exception as e:
+            remove_files(saved_paths)
+            return jsonify({'error': f'Invalid or corrupted reference file {reference_name}: {str(e)}'}), 400
+
+    # Validate files can be opened and share one header
+    first_header = None
+    for input_path, filename in zip(input_paths, filenames):
+        try:
+            print("Validating input file...")
+            header = read_header(input_path)
+            if not any(col.strip() for col in header):
+                raise ValueError('File appears to be empty or corrupted')
+            print(f"File validation successful, header: {','.join(header)[:100]}...")
+        except Exception as e:
+            print(f"ERROR validating file: {e}")
+            # Clean up invalid files
+            remove_files(saved_paths)
+            print("Cleaned up invalid file")
+            return jsonify({'error': f'Invalid or corrupted input file {filename}: {str(e)}'}), 400
+
+        if first_header is None:
+            first_header = header
+        elif header != first_header:
+            remove_files(saved_paths)
+            return jsonify({'error': f'Header of {filename} does not match {filenames[0]}'}), 400
+
+    # Ensure processed directory exists
+    try:
+        os.makedirs(PROCESSED_FOLDER, exist_ok=True)
+        os.makedirs(STATE_FOLDER, exist_ok=True)
+        print(f"Processed folder ensured: {PROCESSED_FOLDER}")
+    except Exception as e:
+        print(f"ERROR creating processed folder: {e}")
+        return jsonify({'error': f'Server configuration error: {str(e)}'}), 500
+
+    # Generate output filenames
+    counts_path = None
+    try:
+        if dry_run:
+            counts_path = os.path.join(PROCESSED_FOLDER, f"{task_id}_counts.pkl")
+            output_path, index_path, output_paths = None, None, [counts_path]
+        else:
+            output_path, index_path, output_paths = output_paths_for(task_id, filenames, output_mode,
+                                                                     index=not state_path)
+        print(f"Output path: {output_path}")
+    except Exception as e:
+        print(f"ERROR generating output path: {e}")
+        return jsonify({'error': f'Path generation error: {str(e)}'}), 500
+
+    # Start processing in background
+    try:
+        print("Starting background processing...")
+        processing_status[task_id] = {
+            'status': 'processing',
+            'message': 'Starting...',
+            'progress': 5,
+            'start_time': datetime.now()
+        }
+        retention.register(task_id, *saved_paths, *output_paths)
+        retention.start()
+        if dry_run:
+            dry_runs[task_id] = {
+                'input_paths': input_paths,
+                'filenames': filenames,
+                'output_mode': output_mode,
+                'reference_path': reference_path,
+                'counts_path': counts_path,
+                'layout': layout,
+                'paths': saved_paths + output_paths
+            }
+        thread = threading.Thread(
+            target=preprocess_invoice_data_browse,
+            args=(input_paths[0] if len(input_paths) == 1 else input_paths, output_path, task_id, index_path,
+                  ', '.join(filenames), state_path, None if dry_run else reference_path, counts_path, dry_run,
+                  layout)
+        )
+        thread.daemon = True
+        thread.start()
+        print("Background thread started successfully")
+    except Exception as e:
+        print(f"ERROR starting background thread: {e}")
+        print(traceback.format_exc())
+        return jsonify({'error': f'Failed to start processing: {str(e)}'}), 500
+
+    print("Upload successful, returning response")
+    return jsonify({
+        'task_id': task_id,
+        'message': 'File uploaded successfully, processing started'
+    })
+
+def output_paths_for(task_id, filenames, output_mode, index=True):
+    """(output path or list of per-part paths, result index path or None, all paths) for a task"""
+    if len(filenames) == 1 or output_mode == 'combined':
+        output_path = os.path.join(PROCESSED_FOLDER, f"{task_id}_{processed_filename(filenames[0])}")
+        output_paths = [output_path]
+    else:
+        output_path = [
+            os.path.join(PROCESSED_FOLDER, f"{task_id}_{index}_{processed_filename(filename)}")
+            for index, filename in enumerate(filenames)
+        ]
+        output_paths = output_path
+
+    index_path = None
+    if app.config['BUILD_RESULT_INDEX'] and not isinstance(output_path, list) and index:
+        index_path = os.path.join(PROCESSED_FOLDER, f"{task_id}_results.sqlite")
+        output_paths = output_paths + [index_path]
+    return output_path, index_path, output_paths
 
 @app.route('/upload', methods=['POST'])
 @login_required
@@ -1784,35 +2549,28 @@ def upload_file():
             print("ERROR: No file in request")
             return jsonify({'error': 'No file provided'}), 400
 
-        file = request.files['file']
-        print(f"File received: {file.filename}")
-        print(f"File size: {file.content_length}")
+        # Several files form one logical dataset (shards with the same header)
+        files = request.files.getlist('file')
+        for file in files:
+            print(f"File received: {file.filename}")
+            print(f"File size: {file.content_length}")
 
-        if file.filename == '':
-            print("ERROR: Empty filename")
-            return jsonify({'error': 'No file selected'}), 400
+            if file.filename == '':
+                print("ERROR: Empty filename")
+                return jsonify({'error': 'No file selected'}), 400
 
-        if not file.filename.lower().endswith('.gz'):
-            print(f"ERROR: Invalid file extension: {file.filename}")
-            return jsonify({'error': 'File must be a .gz file'}), 400
+            if not is_supported_filename(file.filename):
+                print(f"ERROR: Invalid file extension: {file.filename}")
+                return jsonify({'error': f"File must be one of: {', '.join(INPUT_EXTENSIONS)}"}), 400
 
-        # Clean up previous uploads
-        try:
-            print("Cleaning up previous uploads...")
-            for filename in os.listdir(UPLOAD_FOLDER):
-                file_path = os.path.join(UPLOAD_FOLDER, filename)
-                if os.path.isfile(file_path):
-                    os.remove(file_path)
-                    print(f"Deleted old upload: {filename}")
-
-            print("Cleaning up previous processed files...")
-            for filename in os.listdir(PROCESSED_FOLDER):
-                file_path = os.path.join(PROCESSED_FOLDER, filename)
-                if os.path.isfile(file_path):
-                    os.remove(file_path)
-                    print(f"Deleted old processed file: {filename}")
-        except Exception as e:
-            print(f"Warning: Could not clean up old files: {e}")
+        output_mode = request.form.get('output_mode', 'combined')
+        if output_mode not in ('combined', 'per_shard'):
+            return jsonify({'error': 'Invalid output mode'}), 400
+
+        # Optional reference file (e.g. the paid-invoices register) to check against
+        reference_file = request.files.get('reference')
+        if reference_file and reference_file.filename and not is_supported_filename(reference_file.filename):
+            return jsonify({'error': f"Reference file must be one of: {', '.join(INPUT_EXTENSIONS)}"}), 400
 
         # Generate unique task ID
         task_id = str(uuid.uuid4())
@@ -1826,88 +2584,363 @@ def upload_file():
             print(f"ERROR creating upload folder: {e}")
             return jsonify({'error': f'Server configuration error: {str(e)}'}), 500
 
-        # Save uploaded file
+        # Save uploaded files
+        input_paths = []
+        filenames = []
+        reference = None
         try:
-            filename = secure_filename(file.filename)
-            if not filename:
-                filename = f"upload_{task_id}.gz"
-
-            input_path = os.path.join(UPLOAD_FOLDER, f"{task_id}_{filename}")
-            print(f"Saving file to: {input_path}")
-
-            # Save the file
-            file.save(input_path)
-
-            # Verify file was saved
-            if not os.path.exists(input_path):
-                raise Exception("File was not saved properly")
-
-            file_size = os.path.getsize(input_path)
-            print(f"File saved successfully, size: {file_size} bytes")
+            for index, file in enumerate(files):
+                filename = secure_filename(file.filename)
+                if not filename:
+                    filename = f"upload_{task_id}_{index}.gz"
+
+                if len(files) == 1:
+                    input_path = os.path.join(UPLOAD_FOLDER, f"{task_id}_{filename}")
+                else:
+                    input_path = os.path.join(UPLOAD_FOLDER, f"{task_id}_{index}_{filename}")
+                print(f"Saving file to: {input_path}")
+
+                # Save the file
+                file.save(input_path)
+                input_paths.append(input_path)
+                filenames.append(filename)
+
+                # Verify file was saved
+                if not os.path.exists(input_path):
+                    raise Exception("File was not saved properly")
+
+                file_size = os.path.getsize(input_path)
+                print(f"File saved successfully, size: {file_size} bytes")
+
+            if reference_file and reference_file.filename:
+                reference_name = secure_filename(reference_file.filename) or 'reference.gz'
+                reference = (os.path.join(UPLOAD_FOLDER, f"{task_id}_reference_{reference_name}"), reference_name)
+                reference_file.save(reference[0])
 
         except Exception as e:
             print(f"ERROR saving file: {e}")
             print(traceback.format_exc())
+            remove_files(input_paths + ([reference[0]] if reference else []))
             return jsonify({'error': f'Failed to save file: {str(e)}'}), 500
 
-        # Validate file can be opened
-        try:
-            print("Validating gz file...")
-            with gzip.open(input_path, 'rt', encoding='utf-8') as f:
-                header = f.readline()
-                if not header.strip():
-                    raise ValueError('File appears to be empty or corrupted')
-                print(f"File validation successful, header: {header[:100]}...")
-        except Exception as e:
-            print(f"ERROR validating file: {e}")
-            # Clean up invalid file
-            if os.path.exists(input_path):
-                os.remove(input_path)
-                print("Cleaned up invalid file")
-            return jsonify({'error': f'Invalid or corrupted gz file: {str(e)}'}), 400
+        return start_processing(task_id, input_paths, filenames, output_mode, request.form.get('dataset', ''),
+                                reference, request.form.get('dry_run') in ('1', 'true', 'on'),
+                                request.form.get('row_order') or 'input',
+                                request.form.get('duplicates_only') in ('1', 'true', 'on'))
 
-        # Ensure processed directory exists
-        try:
-            os.makedirs(PROCESSED_FOLDER, exist_ok=True)
-            print(f"Processed folder ensured: {PROCESSED_FOLDER}")
-        except Exception as e:
-            print(f"ERROR creating processed folder: {e}")
-            return jsonify({'error': f'Server configuration error: {str(e)}'}), 500
+    except Exception as e:
+        print(f"UNEXPECTED ERROR in upload: {e}")
+        print(traceback.format_exc())
+        return jsonify({'error': f'Unexpected server error: {str(e)}'}), 500
 
-        # Generate output filename
-        try:
-            output_filename = f"processed_{filename.replace('.gz', '.csv')}"
-            output_path = os.path.join(PROCESSED_FOLDER, f"{task_id}_{output_filename}")
-            print(f"Output path: {output_path}")
-        except Exception as e:
-            print(f"ERROR generating output path: {e}")
-            return jsonify({'error': f'Path generation error: {str(e)}'}), 500
+@app.route('/upload/init', methods=['POST'])
+@login_required
+def upload_init():
+    """Start a chunked upload; the file is preallocated at its final location"""
+    data = request.get_json(silent=True) or {}
+    filename = data.get('filename', '')
+    try:
+        size = int(data.get('size', -1))
+    except (TypeError, ValueError):
+        size = -1
+
+    if not filename:
+        return jsonify({'error': 'No file selected'}), 400
+    if not is_supported_filename(filename):
+        return jsonify({'error': f"File must be one of: {', '.join(INPUT_EXTENSIONS)}"}), 400
+    if size <= 0 or size > app.config['MAX_CHUNKED_UPLOAD_BYTES']:
+        return jsonify({'error': 'Invalid file size'}), 400
+
+    upload_id = str(uuid.uuid4())
+    safe_name = secure_filename(filename) or f"upload_{upload_id}.gz"
+    path = os.path.join(UPLOAD_FOLDER, f"{upload_id}_{safe_name}")
+    chunk_size = app.config['UPLOAD_CHUNK_SIZE']
 
-        # Start processing in background
-        try:
-            print("Starting background processing...")
-            thread = threading.Thread(
-                target=preprocess_invoice_data_browse,
-                args=(input_path, output_path, task_id)
-            )
-            thread.daemon = True
-            thread.start()
-            print("Background thread started successfully")
-        except Exception as e:
-            print(f"ERROR starting background thread: {e}")
-            print(traceback.format_exc())
-            return jsonify({'error': f'Failed to start processing: {str(e)}'}), 500
+    try:
+        os.makedirs(UPLOAD_FOLDER, exist_ok=True)
+        with open(path, 'wb') as f:
+            f.truncate(size)
+    except Exception as e:
+        print(f"ERROR creating upload file: {e}")
+        return jsonify({'error': f'Server configuration error: {str(e)}'}), 500
+
+    with upload_sessions_lock:
+        upload_sessions[upload_id] = {
+            'path': path,
+            'filename': safe_name,
+            'size': size,
+            'chunk_size': chunk_size,
+            'received': set(),
+            'user_id': session['user_id']
+        }
+    processing_status[upload_id] = {
+        'status': 'uploading',
+        'message': 'Receiving file...',
+        'progress': 0
+    }
+    retention.register(upload_id, path)
+    retention.start()
+    print(f"Chunked upload {upload_id} started: {safe_name}, {size} bytes")
+
+    return jsonify({
+        'upload_id': upload_id,
+        'chunk_size': chunk_size,
+        'total_chunks': -(-size // chunk_size)
+    })
+
+def get_upload_session(upload_id, user_id=None):
+    """Upload session owned by user_id (default: the current user), or None"""
+    upload = upload_sessions.get(upload_id)
+    if not upload or upload['user_id'] != (session['user_id'] if user_id is None else user_id):
+        return None
+    return upload
+
+@app.route('/upload/<upload_id>', methods=['GET'])
+@login_required
+def upload_state(upload_id):
+    """Chunks received so far, so a client can resume"""
+    upload = get_upload_session(upload_id)
+    if not upload:
+        return jsonify({'error': 'Upload not found'}), 404
+    with upload_sessions_lock:
+        received = sorted(upload['received'])
+    return jsonify({
+        'upload_id': upload_id,
+        'chunk_size': upload['chunk_size'],
+        'total_chunks': -(-upload['size'] // upload['chunk_size']),
+        'received_chunks': received
+    })
+
+@app.route('/upload/<upload_id>/preview', methods=['GET'])
+@login_required
+def upload_preview(upload_id):
+    """
+    Estimated duplicate rates from the start of an upload, which may still
+    be in progress (see preview.preview_invoice_file).
 
-        print("Upload successful, returning response")
-        return jsonify({
-            'task_id': task_id,
-            'message': 'File uploaded successfully, processing started'
-        })
+    Reads the chunks received without a gap from the first one. Optional
+    query parameters: max_mb (decompressed MB to read) and sample_rate
+    (share of keys counted, in (0, 1]).
+    """
+    upload = get_upload_session(upload_id)
+    if not upload:
+        return jsonify({'error': 'Upload not found'}), 404
+    with upload_sessions_lock:
+        received = set(upload['received'])
+    contiguous = 0
+    while contiguous in received:
+        contiguous += 1
+    available = min(contiguous * upload['chunk_size'], upload['size'])
+    if not available:
+        return jsonify({'error': 'Upload the first chunk before previewing'}), 409
+
+    max_mb = request.args.get('max_mb', type=float)
+    sample_rate = request.args.get('sample_rate', app.config['PREVIEW_SAMPLE_RATE'], type=float)
+    if max_mb is not None and max_mb <= 0:
+        return jsonify({'error': 'max_mb must be positive'}), 400
+    max_bytes = int(max_mb * 1024 * 1024) if max_mb is not None else app.config['PREVIEW_MAX_BYTES']
 
+    try:
+        preview = preview_invoice_file(upload['path'], max_bytes, sample_rate, filters=app.config['ROW_FILTERS'],
+                                       available_bytes=available, normalization=app.config['KEY_NORMALIZATION'])
+    except (ValueError, EOFError, OSError) as e:
+        return jsonify({'error': str(e)}), 400
     except Exception as e:
-        print(f"UNEXPECTED ERROR in upload: {e}")
+        print(f"ERROR previewing {upload_id}: {e}")
         print(traceback.format_exc())
-        return jsonify({'error': f'Unexpected server error: {str(e)}'}), 500
+        return jsonify({'error': f'Preview failed: {str(e)}'}), 500
+
+    retention.touch(upload_id)
+    preview['filename'] = upload['filename']
+    print(f"Preview of {upload_id}: {preview['total_input_lines']} lines in {preview['seconds']}s")
+    return jsonify(preview)
+
+@app.route('/upload/<upload_id>/chunk/<int:index>', methods=['PUT'])
+@login_required
+def upload_chunk(upload_id, index):
+    """
+    Write one chunk (raw request body) at index * chunk_size.
+
+    The body is streamed straight into the preallocated file. An optional
+    X-Chunk-SHA256 header is verified; a chunk only counts as received
+    when its length and checksum match.
+    """
+    payload, code = store_chunk(session['user_id'], upload_id, index, request.content_length, request.stream,
+                                request.headers.get('X-Chunk-SHA256'))
+    return jsonify(payload), code
+
+def check_chunk(user_id, upload_id, index, content_length):
+    """(upload, expected length) for a chunk, or (None, (error payload, status code))"""
+    upload = get_upload_session(upload_id, user_id)
+    if not upload:
+        return None, ({'error': 'Upload not found'}, 404)
+
+    chunk_size = upload['chunk_size']
+    offset = index * chunk_size
+    if index < 0 or offset >= upload['size']:
+        return None, ({'error': 'Chunk index out of range'}, 400)
+    expected_length = min(chunk_size, upload['size'] - offset)
+    if content_length != expected_length:
+        return None, ({'error': f'Chunk {index} must be {expected_length} bytes'}, 400)
+    return upload, expected_length
+
+class ChunkWriter:
+    """
+    Writes one chunk of an upload into its part file as the body arrives.
+
+    finish() checks the length and checksum and marks the chunk received;
+    a chunk that is never finished stays missing and can be sent again.
+    """
+
+    def __init__(self, upload_id, upload, index, expected_length):
+        self.upload_id = upload_id
+        self.upload = upload
+        self.index = index
+        self.remaining = expected_length
+        self.digest = hashlib.sha256()
+        self._file = open(upload['path'], 'r+b')
+        self._file.seek(index * upload['chunk_size'])
+
+    def write(self, block):
+        """Write the next part of the body (at most self.remaining bytes)"""
+        self.digest.update(block)
+        self._file.write(block)
+        self.remaining -= len(block)
+
+    def close(self):
+        self._file.close()
+
+    def error(self, e):
+        """Response for an OSError raised while writing"""
+        self.close()
+        print(f"ERROR writing chunk {self.index} of {self.upload_id}: {e}")
+        return {'error': f'Failed to write chunk: {str(e)}'}, 500
+
+    def finish(self, expected_checksum=None):
+        """Close the chunk; returns (response payload, status code)"""
+        try:
+            self.close()
+        except OSError as e:
+            return self.error(e)
+        if self.remaining:
+            return {'error': f'Chunk {self.index} was truncated'}, 400
+        if expected_checksum and expected_checksum.lower() != self.digest.hexdigest():
+            return {'error': f'Checksum mismatch for chunk {self.index}'}, 400
+
+        upload = self.upload
+        with upload_sessions_lock:
+            upload['received'].add(self.index)
+            received = len(upload['received'])
+        total_chunks = -(-upload['size'] // upload['chunk_size'])
+        status = processing_status.get(self.upload_id)
+        if status:
+            status['progress'] = int(100 * received / total_chunks)
+            status['message'] = f'Received {received} of {total_chunks} chunks...'
+        retention.touch(self.upload_id)
+
+        return {'index': self.index, 'sha256': self.digest.hexdigest(), 'received_chunks': received}, 200
+
+def open_chunk(user_id, upload_id, index, content_length):
+    """(ChunkWriter, None) for a chunk, or (None, (error payload, status code))"""
+    upload, checked = check_chunk(user_id, upload_id, index, content_length)
+    if not upload:
+        return None, checked
+    try:
+        return ChunkWriter(upload_id, upload, index, checked), None
+    except OSError as e:
+        print(f"ERROR writing chunk {index} of {upload_id}: {e}")
+        return None, ({'error': f'Failed to write chunk: {str(e)}'}, 500)
+
+def store_chunk(user_id, upload_id, index, content_length, stream, expected_checksum=None):
+    """Write one chunk read from a binary stream; returns (response payload, status code)"""
+    writer, error = open_chunk(user_id, upload_id, index, content_length)
+    if not writer:
+        return error
+    try:
+        while writer.remaining:
+            block = stream.read(min(1024 * 1024, writer.remaining))
+            if not block:
+                break
+            writer.write(block)
+    except OSError as e:
+        return writer.error(e)
+    return writer.finish(expected_checksum)
+
+@app.route('/upload/finalize', methods=['POST'])
+@login_required
+def upload_finalize():
+    """Check that every chunk of the given uploads arrived and start processing them as one task"""
+    data = request.get_json(silent=True) or {}
+    upload_ids = data.get('upload_ids') or []
+    output_mode = data.get('output_mode', 'combined')
+    if output_mode not in ('combined', 'per_shard'):
+        return jsonify({'error': 'Invalid output mode'}), 400
+    if not upload_ids:
+        return jsonify({'error': 'No file provided'}), 400
+    reference_id = data.get('reference_upload_id')
+    if reference_id:
+        if reference_id in upload_ids:
+            return jsonify({'error': 'The reference file must be a separate upload'}), 400
+        upload_ids = upload_ids + [reference_id]
+
+    uploads = []
+    for upload_id in upload_ids:
+        upload = get_upload_session(upload_id)
+        if not upload:
+            return jsonify({'error': 'Upload not found'}), 404
+        total_chunks = -(-upload['size'] // upload['chunk_size'])
+        missing = total_chunks - len(upload['received'])
+        if missing:
+            return jsonify({'error': f"{upload['filename']} is missing {missing} chunks"}), 400
+        uploads.append(upload)
+
+    with upload_sessions_lock:
+        for upload_id in upload_ids:
+            upload_sessions.pop(upload_id, None)
+    for upload_id in upload_ids:
+        retention.forget(upload_id)
+        processing_status.pop(upload_id, None)
+
+    reference = None
+    if reference_id:
+        reference_upload = uploads.pop()
+        reference = (reference_upload['path'], reference_upload['filename'])
+
+    task_id = str(uuid.uuid4())
+    print(f"Chunked uploads finalized as task {task_id}")
+    return start_processing(task_id, [u['path'] for u in uploads], [u['filename'] for u in uploads], output_mode,
+                            data.get('dataset') or '', reference, bool(data.get('dry_run')),
+                            data.get('row_order') or 'input', bool(data.get('duplicates_only')))
+
+@app.route('/materialize/<task_id>', methods=['POST'])
+@login_required
+def materialize(task_id):
+    """Write the output of a finished dry run from its saved key counts"""
+    status = processing_status.get(task_id)
+    if not status or status['status'] != 'completed' or not status.get('dry_run'):
+        return jsonify({'error': 'Dry run not found or not finished'}), 404
+    job = dry_runs.pop(task_id, None)
+    if not job:
+        return jsonify({'error': 'Output is already being written'}), 409
+
+    output_path, index_path, output_paths = output_paths_for(task_id, job['filenames'], job['output_mode'])
+    input_paths = job['input_paths']
+    processing_status[task_id] = {
+        'status': 'processing',
+        'message': 'Starting...',
+        'progress': 5,
+        'start_time': datetime.now()
+    }
+    retention.register(task_id, *job['paths'], *output_paths)
+    thread = threading.Thread(
+        target=preprocess_invoice_data_browse,
+        args=(input_paths[0] if len(input_paths) == 1 else input_paths, output_path, task_id, index_path,
+              ', '.join(job['filenames']), None, job['reference_path'], job['counts_path'], False, job['layout'])
+    )
+    thread.daemon = True
+    thread.start()
+    print(f"Materializing output of dry run {task_id}")
+    return jsonify({'task_id': task_id, 'message': 'Writing output from saved counts'})
 
 @app.route('/status/<task_id>')
 @login_required
@@ -1915,23 +2948,91 @@ def get_status(task_id):
     status = processing_status.get(task_id, {'status': 'not_found', 'message': 'Task not found'})
     return jsonify(status)
 
-@app.route('/download/<task_id>')
+@app.route('/results/<task_id>')
+@login_required
+def get_results(task_id):
+    """
+    Page through processed rows.
+
+    Query parameters: concat1/concat2/concat3 (Duplicate or Non Duplicate),
+    primary_vendor_code, header_po, min_amount, max_amount, sort (row,
+    amount, invoice_date, primary_vendor_code), order (asc/desc), limit and
+    cursor (next_cursor of the previous page).
+    """
+    status = processing_status.get(task_id)
+    if not status or status['status'] != 'completed':
+        return jsonify({'error': 'Results not ready'}), 404
+    index_file = status.get('index_file')
+    if not index_file or not os.path.exists(index_file):
+        return jsonify({'error': 'No result index for this task'}), 404
+
+    filters = {key: request.args.get(key) for key in (
+        'concat1', 'concat2', 'concat3', 'primary_vendor_code', 'header_po', 'min_amount', 'max_amount')}
+    try:
+        page = query_results(
+            index_file,
+            filters=filters,
+            sort=request.args.get('sort', 'row'),
+            descending=request.args.get('order', 'asc') == 'desc',
+            cursor=request.args.get('cursor'),
+            limit=request.args.get('limit', 100)
+        )
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+    retention.touch(task_id)
+    return jsonify(page)
+
+@app.route('/summary/<task_id>')
 @login_required
-def download_file(task_id):
+def download_summary(task_id):
+    """Processing summary with duplicate analytics as a JSON file"""
     status = processing_status.get(task_id)
     if not status or status['status'] != 'completed':
-        return jsonify({'error': 'File not ready for download'}), 404
+        return jsonify({'error': 'Summary not ready'}), 404
 
-    output_file = status['output_file']
-    if not os.path.exists(output_file):
-        return jsonify({'error': 'Processed file not found'}), 404
+    retention.touch(task_id)
+    response = jsonify(dict(status['summary'], processing_time_mins=status.get('processing_time_mins')))
+    response.headers['Content-Disposition'] = 'attachment; filename=duplicate_summary.json'
+    return response
 
+@app.route('/download/<task_id>')
+@app.route('/download/<task_id>/<int:shard>')
+@login_required
+def download_file(task_id, shard=None):
+    output_file, download_name, error = download_target(task_id, shard)
+    if error:
+        return jsonify(error[0]), error[1]
     return send_file(
         output_file,
         as_attachment=True,
-        download_name=f"processed_invoice_data.csv"
+        download_name=download_name
     )
 
+def download_target(task_id, shard=None):
+    """(output path, download name, None) for a finished task, or (None, None, (error payload, status code))"""
+    status = processing_status.get(task_id)
+    if not status or status['status'] != 'completed':
+        return None, None, ({'error': 'File not ready for download'}, 404)
+    if status.get('dry_run'):
+        return None, None, ({'error': 'A dry run has no output file; write it with /materialize first'}, 404)
+
+    if shard is None:
+        output_file = status.get('output_file')
+        download_name = "processed_invoice_data.csv"
+    else:
+        output_files = status.get('output_files', [])
+        if shard >= len(output_files):
+            return None, None, ({'error': 'Shard not found'}, 404)
+        output_file = output_files[shard]
+        download_name = f"processed_invoice_data_part{shard + 1}.csv"
+
+    if not output_file or not os.path.exists(output_file):
+        return None, None, ({'error': 'Processed file not found'}, 404)
+
+    retention.touch(task_id)
+    return output_file, download_name, None
+
 if __name__ == '__main__':
     # Initialize database
     init_db()
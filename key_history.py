@@ -0,0 +1,171 @@
+"""Persistent index of CONCAT keys from past uploads for cross-period duplicate checks"""
+import hashlib
+import sqlite3
+import threading
+from datetime import datetime
+
+LOOKUP_BATCH_SIZE = 500
+INSERT_BATCH_SIZE = 50000
+FINGERPRINT_BLOCK_SIZE = 1024 * 1024
+
+# One check_and_record per history database at a time in this process; the
+# IMMEDIATE transaction serializes it with other processes
+history_locks = {}
+history_locks_lock = threading.Lock()
+
+def key_hash(key):
+    """
+    64-bit hash stored instead of the key text.
+
+    Keeps each entry at a few bytes, so hundreds of millions of keys fit in
+    one table; the chance of a false match is about n / 2**64 per lookup.
+    """
+    return int.from_bytes(hashlib.blake2b(key.encode('utf-8'), digest_size=8).digest(), 'big', signed=True)
+
+def upload_fingerprint(paths):
+    """Hash of the contents of an upload's files, so a re-run of the same upload is recognised"""
+    digest = hashlib.blake2b(digest_size=16)
+    for path in paths:
+        with open(path, 'rb') as f:
+            while True:
+                block = f.read(FINGERPRINT_BLOCK_SIZE)
+                if not block:
+                    break
+                digest.update(block)
+        digest.update(b'\0')
+    return digest.hexdigest()
+
+class KeyHistory:
+    """
+    SQLite table of every CONCAT key recorded from earlier uploads and the
+    upload (source) where it was first seen.
+
+    keys is a WITHOUT ROWID table whose primary key (rule, hash) covers the
+    lookups, so each lookup is a single B-tree probe. A source may carry the
+    fingerprint of its upload (see upload_fingerprint).
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.conn = sqlite3.connect(path, timeout=60)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.conn.execute('PRAGMA cache_size=-65536')
+        self.conn.execute('''
+            CREATE TABLE IF NOT EXISTS sources (
+                id INTEGER PRIMARY KEY,
+                name TEXT NOT NULL,
+                recorded_at TEXT NOT NULL,
+                fingerprint TEXT
+            )
+        ''')
+        columns = [row[1] for row in self.conn.execute('PRAGMA table_info(sources)')]
+        if 'fingerprint' not in columns:
+            self.conn.execute('ALTER TABLE sources ADD COLUMN fingerprint TEXT')
+        self.conn.execute('CREATE INDEX IF NOT EXISTS idx_sources_fingerprint ON sources (fingerprint)')
+        self.conn.execute('''
+            CREATE TABLE IF NOT EXISTS keys (
+                rule INTEGER NOT NULL,
+                hash INTEGER NOT NULL,
+                source_id INTEGER NOT NULL,
+                PRIMARY KEY (rule, hash)
+            ) WITHOUT ROWID
+        ''')
+        self.conn.commit()
+
+    def lookup(self, counts, exclude_source=None):
+        """
+        Keys of counts (one dict per CONCAT rule) already in the history.
+
+        Returns one dict per rule mapping key -> 'source name (date)' of the
+        upload where the key was first seen. Keys first seen in source id
+        exclude_source are left out.
+        """
+        sources = {}
+        matches = []
+        for rule, rule_counts in enumerate(counts):
+            rule_matches = {}
+            batch = {}
+            for key in rule_counts:
+                batch[key_hash(key)] = key
+                if len(batch) >= LOOKUP_BATCH_SIZE:
+                    self._lookup_batch(rule, batch, rule_matches)
+                    batch = {}
+            if batch:
+                self._lookup_batch(rule, batch, rule_matches)
+            if exclude_source is not None:
+                rule_matches = {key: source_id for key, source_id in rule_matches.items()
+                                if source_id != exclude_source}
+            matches.append(rule_matches)
+
+        for rule_matches in matches:
+            for key, source_id in rule_matches.items():
+                if source_id not in sources:
+                    sources[source_id] = self._source_label(source_id)
+                rule_matches[key] = sources[source_id]
+        return matches
+
+    def _lookup_batch(self, rule, batch, rule_matches):
+        sql = f"SELECT hash, source_id FROM keys WHERE rule = ? AND hash IN ({', '.join('?' * len(batch))})"
+        for hashed, source_id in self.conn.execute(sql, [rule, *batch]):
+            rule_matches[batch[hashed]] = source_id
+
+    def _source_label(self, source_id):
+        row = self.conn.execute('SELECT name, recorded_at FROM sources WHERE id = ?', (source_id,)).fetchone()
+        if row is None:
+            return 'unknown upload'
+        return f'{row[0]} ({row[1][:10]})'
+
+    def check_and_record(self, counts, source_name, fingerprint=None):
+        """
+        lookup() and record() in one transaction, so uploads processed at
+        the same time see each other's keys in the order they commit.
+
+        With a fingerprint, a source already recorded for the same upload
+        is reused: a re-run neither matches its own earlier keys nor adds a
+        source. Returns the lookup() matches.
+        """
+        with history_locks_lock:
+            lock = history_locks.setdefault(self.path, threading.Lock())
+        with lock:
+            self.conn.execute('BEGIN IMMEDIATE')
+            try:
+                source_id = self._source_id(fingerprint)
+                matches = self.lookup(counts, exclude_source=source_id)
+                self.record(counts, source_name, fingerprint, source_id)
+            except BaseException:
+                self.conn.rollback()
+                raise
+        return matches
+
+    def _source_id(self, fingerprint):
+        if fingerprint is None:
+            return None
+        row = self.conn.execute('SELECT MIN(id) FROM sources WHERE fingerprint = ?', (fingerprint,)).fetchone()
+        return row[0]
+
+    def record(self, counts, source_name, fingerprint=None, source_id=None):
+        """
+        Add the keys of counts under source_id, or a new source; keys
+        already present keep their first source. Returns the source id.
+        """
+        if source_id is None:
+            cursor = self.conn.execute(
+                'INSERT INTO sources (name, recorded_at, fingerprint) VALUES (?, ?, ?)',
+                (source_name, datetime.now().isoformat(timespec='seconds'), fingerprint)
+            )
+            source_id = cursor.lastrowid
+        batch = []
+        for rule, rule_counts in enumerate(counts):
+            for key in rule_counts:
+                batch.append((rule, key_hash(key), source_id))
+                if len(batch) >= INSERT_BATCH_SIZE:
+                    self.conn.executemany('INSERT OR IGNORE INTO keys VALUES (?, ?, ?)', batch)
+                    batch = []
+        if batch:
+            self.conn.executemany('INSERT OR IGNORE INTO keys VALUES (?, ?, ?)', batch)
+        self.conn.commit()
+        return source_id
+
+    def close(self):
+        self.conn.close()
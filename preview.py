@@ -0,0 +1,322 @@
+"""Quick duplicate-rate estimate from the start of a file or a hash sample of its keys"""
+import io
+import math
+import os
+import time
+import zlib
+from itertools import chain
+
+from duplicate_engine import (
+    DEFAULT_FILTERS, REQUIRED_COLUMNS, RULES, _ROW_FIELDS, decompress_stream,
+    duplicate_keys, prepare_records, read_records, validate_filters, validate_normalization
+)
+
+PREVIEW_MAX_BYTES = 32 * 1024 * 1024
+
+# z value of the reported confidence intervals (95%)
+CONFIDENCE_Z = 1.96
+
+# Fields shown for the rows of an example duplicate group
+EXAMPLE_FIELDS = ('invoice_no', 'header_po', 'primary_vendor_code', 'invoice_date', 'invoice_amount')
+EXAMPLE_ROWS = 5
+
+# Decompressed bytes per read from a partial upload; a decompressor that
+# hits the end of the uploaded data drops what the failing read decoded
+PARTIAL_READ_SIZE = 64 * 1024
+
+# Schema problems list at most this many record numbers or values each
+PROBLEM_SAMPLES = 5
+
+def key_sampled(key, threshold):
+    """True if key falls in the hash sample; every row of a key is sampled or none is"""
+    return zlib.crc32(key.encode('utf-8', 'surrogatepass')) < threshold
+
+def preview_invoice_file(input_path, max_bytes=PREVIEW_MAX_BYTES, sample_rate=1.0, filters=None, examples=3,
+                         available_bytes=None, normalization=None):
+    """
+    Estimate duplicate rates without processing the whole file.
+
+    At most max_bytes of decompressed input are read (None reads it all),
+    cut at a line break. With sample_rate below 1, only keys whose hash
+    falls in that fraction are counted, per rule; since a key is in or out
+    with all its rows, the duplicate rate of the sampled keys is an
+    unbiased estimate for the rows read. available_bytes limits reading to
+    the start of a file that is still being uploaded. normalization
+    normalizes key fields as in the full check.
+
+    Per rule the result has the estimated duplicate rate with a confidence
+    interval, the estimated duplicate rows and groups for the whole file,
+    and the largest duplicate groups seen. The intervals treat the rows
+    read as a sample with inclusion probability sample_rate x the fraction
+    of the file read. A prefix is not a random sample: duplicates whose
+    copies lie beyond it are missed, so a prefix estimate is low for rules
+    that match across periods (CONCAT 2 and 3) in date-ordered files.
+    """
+    started = time.time()
+    filters = DEFAULT_FILTERS if filters is None else validate_filters(filters)
+    validate_normalization(normalization)
+    if not 0 < sample_rate <= 1:
+        raise ValueError('sample_rate must be in (0, 1]')
+
+    problems = []
+    widths = {'count': 0, 'records': []}
+    amounts = {'count': 0, 'values': []}
+    dates = {'count': 0, 'values': []}
+    stats = {'total_input_lines': 0, 'lines_processed': 0}
+    counts = ({}, {}, {})
+    sampled_rows = []
+    hashed = sample_rate < 1
+    threshold = int(sample_rate * 2 ** 32)
+    with open(input_path, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        partial = available_bytes is not None and available_bytes < size
+        counter = _CountingReader(f, available_bytes if partial else None)
+        reader = _PrefixReader(decompress_stream(counter), max_bytes, partial)
+        records = _complete_records(read_records(reader), reader)
+        header = next(records, None)
+        if header is None:
+            raise ValueError('Not enough of the file is uploaded to read its header yet' if partial
+                             else 'File appears to be empty')
+        problems += _header_problems(header, filters)
+
+        for row in prepare_records(chain([header], _check_widths(records, len(header), widths)), stats,
+                                   filters=filters, normalization=normalization):
+            sampled = False
+            for rule_counts, key in zip(counts, (row.concat1, row.concat2, row.concat3)):
+                if not hashed or key_sampled(key, threshold):
+                    rule_counts[key] = rule_counts.get(key, 0) + 1
+                    sampled = True
+            if sampled:
+                sampled_rows.append(row)
+            if row.invoice_amount_after_removing_decimal == '0' and not _is_number(row.invoice_amount):
+                _note(amounts, row.invoice_amount)
+            if row.invoice_date and not row.invoice_year:
+                _note(dates, row.invoice_date)
+
+        complete = reader.ended and not partial
+        # Share of the (compressed) file taken by the decompressor; only its
+        # own input buffer (one read, 8 to 128 KB) is counted ahead
+        fraction = 1.0 if complete else min(counter.consumed / size, 1.0)
+
+    if widths['count']:
+        problems.append(f"{widths['count']:,} records have a different number of fields than the header "
+                        f"(records {', '.join(map(str, widths['records']))})")
+    if amounts['count']:
+        problems.append(f"{amounts['count']:,} invoice_amount values are not numbers and count as 0 "
+                        f"(e.g. {', '.join(map(repr, amounts['values']))})")
+    if dates['count']:
+        problems.append(f"{dates['count']:,} invoice_date values have no recognisable date, so CONCAT 2 has no year "
+                        f"(e.g. {', '.join(map(repr, dates['values']))})")
+
+    coverage = sample_rate * fraction
+    estimated_lines = stats['lines_processed'] / fraction if fraction else 0
+    top = duplicate_keys(counts, examples)
+    rules = {}
+    for rule, rule_counts in zip(RULES, counts):
+        rate, low, high = _duplicate_rate(rule_counts, coverage)
+        groups = sum(1 for count in rule_counts.values() if count > 1)
+        group_error = CONFIDENCE_Z * math.sqrt(groups * (1 - coverage)) / coverage if coverage else 0
+        rules[rule] = {
+            'sampled_rows': sum(rule_counts.values()),
+            'duplicate_rows': sum(count for count in rule_counts.values() if count > 1),
+            'duplicate_groups': groups,
+            'duplicate_rate': round(rate, 6),
+            'confidence_interval': [round(low, 6), round(high, 6)],
+            'estimated_duplicate_rows': round(rate * estimated_lines),
+            'estimated_duplicate_rows_interval': [round(low * estimated_lines), round(high * estimated_lines)],
+            'estimated_duplicate_groups': round(groups / coverage),
+            'estimated_duplicate_groups_interval': [max(groups, round(groups / coverage - group_error)),
+                                                    round(groups / coverage + group_error)],
+            'examples': _examples(rule, top[rule], sampled_rows)
+        }
+
+    return {
+        'complete': complete,
+        'bytes_read': reader.length,
+        'fraction_read': round(fraction, 4),
+        'sample_rate': sample_rate,
+        'total_input_lines': stats['total_input_lines'],
+        'lines_processed': stats['lines_processed'],
+        'estimated_lines_processed': round(estimated_lines),
+        'filtered': stats['filtered'],
+        'rules': rules,
+        'schema_problems': problems,
+        'seconds': round(time.time() - started, 2)
+    }
+
+class _CountingReader(io.RawIOBase):
+    """
+    Reader over the first limit bytes of a file (None: all of it) that
+    counts the bytes handed on in consumed. It has its own peek(), so
+    decompress_stream adds no read-ahead buffer and bytes that were
+    peeked but not read are not counted.
+    """
+
+    def __init__(self, f, limit=None):
+        self._file = f
+        self._remaining = limit
+        self._pending = b''
+        self.consumed = 0
+
+    def readable(self):
+        return True
+
+    def _take(self, size):
+        if self._remaining is not None:
+            size = self._remaining if size < 0 else min(size, self._remaining)
+        data = self._file.read(size)
+        if self._remaining is not None:
+            self._remaining -= len(data)
+        return data
+
+    def peek(self, size=1):
+        if len(self._pending) < size:
+            self._pending += self._take(size - len(self._pending))
+        return self._pending
+
+    def read(self, size=-1):
+        pending = self._pending
+        if size is None or size < 0:
+            data = pending + self._take(-1)
+            self._pending = b''
+        elif len(pending) >= size:
+            data = pending[:size]
+            self._pending = pending[size:]
+        else:
+            data = pending + self._take(size - len(pending))
+            self._pending = b''
+        self.consumed += len(data)
+        return data
+
+    def readinto(self, b):
+        data = self.read(len(b))
+        b[:len(data)] = data
+        return len(data)
+
+class _PrefixReader(io.RawIOBase):
+    """
+    Decompressed input up to about limit bytes (None: all of it), then to
+    the end of that line. For a partial upload the input ends where the
+    uploaded data does; truncated is then True if that is inside a line.
+    """
+
+    def __init__(self, binary, limit, partial):
+        self._binary = binary
+        self._limit = limit
+        self._partial = partial
+        self._done = False
+        self._last = b'\n'
+        self.length = 0
+        self.ended = False
+
+    def readable(self):
+        return True
+
+    @property
+    def truncated(self):
+        return self._partial and self._last != b'\n'
+
+    def readinto(self, b):
+        if self._done:
+            return 0
+        try:
+            if self._limit is None or self.length < self._limit:
+                size = min(len(b), PARTIAL_READ_SIZE) if self._partial else len(b)
+                if self._limit is not None:
+                    size = min(size, self._limit - self.length)
+                data = self._binary.read(size)
+                if not data:
+                    self._done = self.ended = True
+            else:
+                data = self._binary.readline()
+                self._done = True
+                self.ended = not self._binary.read(1)
+        except Exception:
+            # Decompressors raise (EOFError, ZstdError, ...) where the
+            # compressed data of an incomplete upload stops
+            if not self._partial:
+                raise
+            data = b''
+            self._done = True
+        if data:
+            self._last = data[-1:]
+            self.length += len(data)
+            b[:len(data)] = data
+        return len(data)
+
+def _complete_records(records, reader):
+    """Records, without the last one if the input stopped inside it"""
+    previous = None
+    for record in records:
+        if previous is not None:
+            yield previous
+        previous = record
+    if previous is not None and not reader.truncated:
+        yield previous
+
+def _header_problems(header, filters):
+    problems = []
+    columns = set(header)
+    missing = [col for col in REQUIRED_COLUMNS if col not in columns]
+    if missing:
+        problems.append(f"Missing required columns (read as empty): {', '.join(missing)}")
+    missing_filters = [spec['column'] for spec in filters
+                       if spec['column'] not in columns and spec['column'] not in missing]
+    if missing_filters:
+        problems.append(f"Missing filter columns (filters never match): {', '.join(missing_filters)}")
+    repeated = sorted({col for col in header if header.count(col) > 1 and col in _ROW_FIELDS})
+    if repeated:
+        problems.append(f"Repeated columns (the last one is used): {', '.join(repeated)}")
+    padded = [col for col in header if col.strip() != col and col.strip() in REQUIRED_COLUMNS]
+    if padded:
+        problems.append(f"Column names with surrounding spaces: {', '.join(map(repr, padded))}")
+    return problems
+
+def _check_widths(records, width, widths):
+    """Pass records through, noting those whose field count differs from the header"""
+    for number, record in enumerate(records, 2):
+        if record and len(record) != width:
+            _note(widths, number, 'records')
+        yield record
+
+def _note(problem, value, samples='values'):
+    problem['count'] += 1
+    if len(problem[samples]) < PROBLEM_SAMPLES:
+        problem[samples].append(value)
+
+def _is_number(value):
+    try:
+        float(value or '0')
+        return True
+    except (ValueError, TypeError):
+        return False
+
+def _duplicate_rate(rule_counts, coverage):
+    """
+    (rate, low, high): share of sampled rows whose key occurs more than once.
+
+    Keys are the sampling units, so the interval uses the variance of a
+    ratio estimator over keys, with a finite population correction of
+    1 - coverage.
+    """
+    keys = len(rule_counts)
+    rows = sum(rule_counts.values())
+    if not rows:
+        return 0.0, 0.0, 0.0
+    rate = sum(count for count in rule_counts.values() if count > 1) / rows
+    if keys < 2:
+        return rate, rate, rate
+    residuals = sum(((count if count > 1 else 0) - rate * count) ** 2 for count in rule_counts.values())
+    mean_rows = rows / keys
+    variance = (1 - coverage) * residuals / (keys - 1) / keys / mean_rows ** 2
+    error = CONFIDENCE_Z * math.sqrt(variance)
+    return rate, max(0.0, rate - error), min(1.0, rate + error)
+
+def _examples(rule, keys, rows):
+    """The rows (EXAMPLE_FIELDS, at most EXAMPLE_ROWS) of each example duplicate key"""
+    wanted = {key: [] for key, _ in keys}
+    for row in rows:
+        group = wanted.get(getattr(row, rule))
+        if group is not None and len(group) < EXAMPLE_ROWS:
+            group.append({field: getattr(row, field) for field in EXAMPLE_FIELDS})
+    return [{'key': key, 'rows': count, 'sample_rows': wanted[key]} for key, count in keys]
@@ -0,0 +1,195 @@
+"""Per-task SQLite index over processed rows for paginated queries"""
+import base64
+import json
+import math
+import sqlite3
+
+from duplicate_engine import DUPLICATE_FLAGS, OUTPUT_COLUMNS
+
+INSERT_BATCH_SIZE = 10000
+MAX_PAGE_SIZE = 1000
+
+# Output column -> SQL column
+COLUMN_NAMES = [f'c{i}' for i in range(len(OUTPUT_COLUMNS))]
+_COLUMN_OF = dict(zip(OUTPUT_COLUMNS, COLUMN_NAMES))
+
+# Sort key -> SQL expression (ties are broken by rowid, i.e. file order)
+SORTS = {
+    'row': None,
+    'amount': 'amount_value',
+    'invoice_date': _COLUMN_OF['invoice_date'],
+    'primary_vendor_code': _COLUMN_OF['primary_vendor_code'],
+}
+
+REMARK_FILTERS = {
+    'concat1': 'concat1_dup',
+    'concat2': 'concat2_dup',
+    'concat3': 'concat3_dup',
+}
+
+# One index per sort column and per selective filter (vendor, PO: the few
+# matching rows are sorted directly), and one per (remark filter, sort) pair:
+# a remark matches a large share of the indexed rows, so those pages are
+# read in index order. Index entries end with the rowid, which breaks ties;
+# a remark filter in file order scans the table by rowid.
+_INDEXES = (
+    [('vendor', _COLUMN_OF['primary_vendor_code']), ('header_po', _COLUMN_OF['header_po'])] +
+    [(sort, column) for sort, column in SORTS.items() if column and sort != 'primary_vendor_code'] +
+    [(f'{name}_{sort}', f'{column}, {sort_column}')
+     for name, column in REMARK_FILTERS.items()
+     for sort, sort_column in SORTS.items() if sort_column]
+)
+
+class ResultIndexWriter:
+    """
+    Builds the index while the output is written.
+
+    tee() passes rows through unchanged and inserts the rows some CONCAT
+    rule marks as Duplicate in batches; indexes are created by close(),
+    after the bulk insert.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.conn = sqlite3.connect(path)
+        self.conn.execute('PRAGMA journal_mode=OFF')
+        self.conn.execute('PRAGMA synchronous=OFF')
+        self.conn.execute('DROP TABLE IF EXISTS results')
+        self.conn.execute(
+            'CREATE TABLE results (' +
+            ', '.join(f'{name} TEXT' for name in COLUMN_NAMES) +
+            ', amount_value REAL, concat1_dup INTEGER, concat2_dup INTEGER, concat3_dup INTEGER)'
+        )
+        self._insert = (
+            f"INSERT INTO results VALUES ({', '.join('?' * (len(COLUMN_NAMES) + 4))})"
+        )
+        self._batch = []
+
+    def add(self, row):
+        flags = row.flags
+        if not flags:
+            return
+        values = list(row.output_values()[:len(OUTPUT_COLUMNS)])
+        try:
+            values.append(float(row.invoice_amount or 0))
+        except (ValueError, TypeError):
+            values.append(0.0)
+        values.extend(1 if flags & flag else 0 for flag in DUPLICATE_FLAGS)
+        self._batch.append(values)
+        if len(self._batch) >= INSERT_BATCH_SIZE:
+            self._flush()
+
+    def tee(self, rows):
+        for row in rows:
+            self.add(row)
+            yield row
+
+    def _flush(self):
+        if self._batch:
+            self.conn.executemany(self._insert, self._batch)
+            self._batch = []
+
+    def close(self):
+        self._flush()
+        for name, column in _INDEXES:
+            self.conn.execute(f'CREATE INDEX idx_{name} ON results ({column})')
+        self.conn.commit()
+        self.conn.close()
+
+def _encode_cursor(values):
+    return base64.urlsafe_b64encode(json.dumps(values).encode()).decode()
+
+def _decode_cursor(cursor):
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except (ValueError, TypeError):
+        raise ValueError('Invalid cursor')
+    if not isinstance(values, list) or len(values) != 2:
+        raise ValueError('Invalid cursor')
+    return values
+
+def _number(filters, key):
+    try:
+        value = float(filters[key])
+    except (ValueError, TypeError):
+        value = math.nan
+    if not math.isfinite(value):
+        raise ValueError(f'{key} must be a number, not {filters[key]!r}')
+    return value
+
+def query_results(path, filters=None, sort='row', descending=False, cursor=None, limit=100):
+    """
+    One page of indexed rows (those marked Duplicate by a CONCAT rule).
+
+    filters: concat1/concat2/concat3 ('Duplicate' or 'Non Duplicate'),
+    primary_vendor_code, header_po, min_amount, max_amount. Returns
+    {'rows': [...], 'next_cursor': str or None}; pass next_cursor back to
+    get the following page.
+    """
+    filters = filters or {}
+    if sort not in SORTS:
+        raise ValueError(f"Unknown sort '{sort}'")
+    try:
+        limit = max(1, min(int(limit), MAX_PAGE_SIZE))
+    except (ValueError, TypeError):
+        raise ValueError(f'limit must be a whole number, not {limit!r}')
+
+    where = []
+    params = []
+    sort_column = SORTS[sort]
+    for key, column in REMARK_FILTERS.items():
+        value = filters.get(key)
+        if value:
+            if value not in ('Duplicate', 'Non Duplicate'):
+                raise ValueError(f"{key} must be 'Duplicate' or 'Non Duplicate'")
+            # In file order, + keeps SQLite from reading a (remark, sort)
+            # index and sorting every match; the table is scanned by rowid
+            where.append(f"{'' if sort_column else '+'}{column} = ?")
+            params.append(1 if value == 'Duplicate' else 0)
+    equal_columns = set()
+    for key in ('primary_vendor_code', 'header_po'):
+        if filters.get(key):
+            where.append(f'{_COLUMN_OF[key]} = ?')
+            params.append(filters[key])
+            equal_columns.add(_COLUMN_OF[key])
+    if filters.get('min_amount') not in (None, ''):
+        where.append('amount_value >= ?')
+        params.append(_number(filters, 'min_amount'))
+    if filters.get('max_amount') not in (None, ''):
+        where.append('amount_value <= ?')
+        params.append(_number(filters, 'max_amount'))
+
+    if sort_column in equal_columns:
+        sort_column = None  # one value left, so file order
+    direction = 'DESC' if descending else 'ASC'
+    compare = '<' if descending else '>'
+    if cursor:
+        sort_value, last_rowid = _decode_cursor(cursor)
+        if sort_column:
+            where.append(f'({sort_column}, rowid) {compare} (?, ?)')
+            params.extend([sort_value, last_rowid])
+        else:
+            where.append(f'rowid {compare} ?')
+            params.append(last_rowid)
+
+    order = f'{sort_column} {direction}, rowid {direction}' if sort_column else f'rowid {direction}'
+    sql = (
+        f"SELECT rowid, {sort_column or 'NULL'}, {', '.join(COLUMN_NAMES)} FROM results" +
+        (f" WHERE {' AND '.join(where)}" if where else '') +
+        f' ORDER BY {order} LIMIT ?'
+    )
+    params.append(limit + 1)
+
+    conn = sqlite3.connect(f'file:{path}?mode=ro', uri=True)
+    try:
+        fetched = conn.execute(sql, params).fetchall()
+    finally:
+        conn.close()
+
+    page = fetched[:limit]
+    rows = [dict(zip(OUTPUT_COLUMNS, record[2:])) for record in page]
+    next_cursor = None
+    if len(fetched) > limit:
+        last = page[-1]
+        next_cursor = _encode_cursor([last[1], last[0]])
+    return {'rows': rows, 'next_cursor': next_cursor}
@@ -0,0 +1,42 @@
+import csv
+import gzip
+import os
+import random
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from duplicate_engine import REQUIRED_COLUMNS  # noqa: E402
+
+def invoice_records(count, seed=1):
+    """Header and count random invoice records with a realistic share of duplicates"""
+    rng = random.Random(seed)
+    records = [list(REQUIRED_COLUMNS)]
+    for i in range(count):
+        row = {
+            'invoice_creation_date': '2024-01-01',
+            'payee_name': f'Payee {rng.randint(1, 50)}',
+            'primary_vendor_code': f'V{rng.randint(1, 300)}',
+            'barcode': str(i),
+            'invoice_status': rng.choice(['open', 'paid', 'open', 'cancelled']),
+            'header_po': f'PO{rng.randint(1, max(count // 100, 5)):05d}',
+            'invoice_no': f'INV{i}' + rng.choice(['', '', '', 'SCR']),
+            'invoice_date': f'202{rng.randint(1, 3)}-{rng.randint(1, 2):02d}-{rng.randint(1, 3):02d}T00:00:00.000Z',
+            'invoice_source_name': rng.choice(['EDI', 'DROPSHIP', 'PORTAL']),
+            'invoice_quantity': str(rng.randint(1, 5)),
+            'invoice_amount': f'{rng.randint(1, 300)}.{rng.randint(0, 99):02d}',
+        }
+        records.append([row.get(col, '') for col in REQUIRED_COLUMNS])
+    return records
+
+@pytest.fixture
+def invoice_file(tmp_path):
+    """write(count, seed=1, name='invoices.csv.gz') -> path of a gzipped random invoice file"""
+    def write(count, seed=1, name='invoices.csv.gz'):
+        path = tmp_path / name
+        with gzip.open(path, 'wt', encoding='utf-8', newline='') as f:
+            csv.writer(f).writerows(invoice_records(count, seed))
+        return str(path)
+    return write
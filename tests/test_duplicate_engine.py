@@ -0,0 +1,135 @@
+import csv
+import gzip
+import io
+import random
+
+import pytest
+
+import duplicate_engine
+from duplicate_engine import (
+    REQUIRED_COLUMNS, RULE_LABELS, WINDOW_COLUMN, AmountTolerance, DuplicateCheck, parse_tolerance, process_invoice_file,
+    read_records
+)
+
+def _invoice(vendor, po, date, amount, invoice_no):
+    row = {'primary_vendor_code': vendor, 'header_po': po, 'invoice_date': f'{date}T00:00:00.000Z',
+           'invoice_amount': amount, 'invoice_no': invoice_no, 'invoice_status': 'open'}
+    return [row.get(col, '') for col in REQUIRED_COLUMNS]
+
+def _write(path, records):
+    with gzip.open(path, 'wt', encoding='utf-8', newline='') as f:
+        csv.writer(f).writerows([list(REQUIRED_COLUMNS)] + records)
+    return str(path)
+
+def _read(path):
+    with open(path, newline='', encoding='utf-8') as f:
+        return list(csv.DictReader(f))
+
+def test_duplicates_only_keeps_rows_flagged_by_annotations_only(tmp_path):
+    input_path = _write(tmp_path / 'invoices.csv.gz', [
+        # Same vendor and amount two days apart across a year end: only the time-window rule matches
+        _invoice('V1', 'PO1', '2023-12-31', '100.00', 'A1'),
+        _invoice('V1', 'PO2', '2024-01-02', '100.00', 'A2'),
+        # Same PO, date and amount: CONCAT duplicates
+        _invoice('V2', 'PO3', '2024-03-01', '250.00', 'B1'),
+        _invoice('V2', 'PO3', '2024-03-01', '250.00', 'B2'),
+        _invoice('V3', 'PO4', '2024-05-01', '75.00', 'C1'),
+    ])
+    full_path = str(tmp_path / 'full.csv')
+    only_path = str(tmp_path / 'only.csv')
+    process_invoice_file(input_path, full_path, layout={'window_days': 30})
+    process_invoice_file(input_path, only_path, layout={'window_days': 30, 'duplicates_only': True})
+
+    full = _read(full_path)
+    window_only = [row['invoice_no'] for row in full
+                   if row[WINDOW_COLUMN] == 'Duplicate'
+                   and all(value != 'Duplicate' for column, value in row.items() if column.startswith('CONCAT'))]
+    assert window_only == ['A1', 'A2']
+    assert [row['invoice_no'] for row in _read(only_path)] == ['A1', 'A2', 'B1', 'B2']
+
+def _tolerance_matches(records, tolerance):
+    """AmountTolerance.match() of every processed row"""
+    check = DuplicateCheck([list(REQUIRED_COLUMNS)] + records, raw=True)
+    tolerance = check.amount_tolerance(tolerance)
+    return [tolerance.match(row) for row in check]
+
+def _pairwise_matches(records, tolerance):
+    """Reference for _tolerance_matches: every pair of rows compared directly"""
+    value, percent = parse_tolerance(tolerance)
+
+    def within(a, b):
+        if percent:
+            low, high = sorted((abs(a), abs(b)))
+            return (a < 0) == (b < 0) and high - low <= low * value / 100 + 1e-9
+        return abs(a - b) <= value + 1e-9
+
+    rows = list(DuplicateCheck([list(REQUIRED_COLUMNS)] + records, raw=True))
+    amounts = []
+    for row in rows:
+        try:
+            amount = float(row.invoice_amount or '0')
+        except ValueError:
+            amount = float('nan')
+        amounts.append(amount)
+    bases = [AmountTolerance._bases(row) for row in rows]
+    matches = []
+    for i, amount in enumerate(amounts):
+        matches.append([label for rule, label in enumerate(RULE_LABELS)
+                        if amount == amount and any(j != i and bases[j][rule] == bases[i][rule]
+                                                    and amounts[j] == amounts[j] and within(amount, amounts[j])
+                                                    for j in range(len(rows)))])
+    return matches
+
+@pytest.mark.parametrize('tolerance', ['0', '0.02', '5', '12', '0%', '0.5%', '1%'])
+def test_amount_tolerance_matches_pairwise_reference(tolerance):
+    rng = random.Random(tolerance)
+    amounts = ['1239.99', '1240.01', '0', '0.5', '0.505', '-3', '-3.02', '1000', '1010', 'x', '', 'nan']
+    records = [_invoice(rng.choice('AB'), rng.choice(['PO1', 'PO2', 'PO3']),
+                        rng.choice(['2024-01-01', '2024-01-02', '2025-03-03']),
+                        rng.choice([f'{rng.uniform(-50, 1300):.2f}', rng.choice(amounts)]), str(i))
+               for i in range(600)]
+    assert _tolerance_matches(records, tolerance) == _pairwise_matches(records, tolerance)
+
+@pytest.mark.parametrize('cents', [1, 2, 3, 7, 10, 25, 100])
+def test_amount_tolerance_exact_boundary(cents):
+    tolerance = f'{cents / 100:.2f}'
+    for low in range(-300, 3000, 11):
+        for difference, expected in ((cents, True), (cents + 1, False)):
+            records = [_invoice('V1', 'PO1', '2024-01-01', f'{amount / 100:.2f}', str(amount))
+                       for amount in (low, low + difference)]
+            assert _tolerance_matches(records, tolerance) == [list(RULE_LABELS) if expected else []] * 2, (low, difference)
+
+@pytest.mark.parametrize('tolerance', ['1%', '5%', '12.5%'])
+def test_amount_tolerance_exact_percentage_boundary(tolerance):
+    percent = float(tolerance[:-1])
+    for low in range(1, 5000, 37):
+        high = low * (1 + percent / 100)
+        for amount, expected in ((high, True), (high * 1.0001 + 0.01, False)):
+            records = [_invoice('V1', 'PO1', '2024-01-01', repr(value), str(value)) for value in (float(low), amount)]
+            assert _tolerance_matches(records, tolerance) == [list(RULE_LABELS) if expected else []] * 2, (low, amount)
+
+def _random_csv(rng, rows, quoted):
+    """CSV text with mixed LF and CRLF line ends; with quoted, fields holding commas, quotes and line breaks"""
+    plain = ['', 'abc', '12.50', 'PO00042', 'caf\u00e9', ' padded ']
+    special = ['a,b', 'say "hi"', 'two\nlines', 'crlf\r\ninside', 'bare\rreturn', '"', ',']
+    out = io.StringIO()
+    for i in range(rows):
+        if rng.random() < 0.03:
+            out.write(rng.choice(['\n', '\r\n']))  # blank line
+            continue
+        writer = csv.writer(out, lineterminator=rng.choice(['\n', '\r\n']))
+        writer.writerow([rng.choice(special if quoted and rng.random() < 0.2 else plain) for _ in range(rng.randint(1, 6))])
+    return out.getvalue()
+
+@pytest.mark.parametrize('block_size', [5, 64, 4096])
+@pytest.mark.parametrize('quoted', [False, True])
+def test_read_records_matches_csv_reader(monkeypatch, block_size, quoted):
+    monkeypatch.setattr(duplicate_engine, 'READ_BLOCK_SIZE', block_size)
+    for seed in range(20):
+        text = _random_csv(random.Random(seed), 300, quoted)
+        expected = list(csv.reader(io.StringIO(text, newline='')))
+        assert list(read_records(io.BytesIO(text.encode('utf-8')))) == expected, seed
+
+def test_read_records_decodes_invalid_lines_as_latin1():
+    data = 'vendor,name\r\nV1,café\r\n'.encode('utf-8') + 'V2,café\r\n'.encode('latin-1')
+    assert list(read_records(io.BytesIO(data))) == [['vendor', 'name'], ['V1', 'café'], ['V2', 'café']]
@@ -0,0 +1,44 @@
+import csv
+import gzip
+
+import pytest
+
+from duplicate_engine import FULL_NORMALIZATION, OUTPUT_COLUMNS, process_invoice_file
+from incremental import DELTA_COLUMN, process_invoice_delta
+
+from conftest import invoice_records
+
+REMARKS = [column for column in OUTPUT_COLUMNS if column.endswith(' Remarks')]
+DUPLICATE_COUNTS = ['concat1_duplicates', 'concat2_duplicates', 'concat3_duplicates']
+
+def _write(path, records):
+    with gzip.open(path, 'wt', encoding='utf-8', newline='') as f:
+        csv.writer(f).writerows(records)
+    return str(path)
+
+def _remarks(path):
+    """barcode -> (remarks, delta status or None) of each row of an output file"""
+    with open(path, newline='', encoding='utf-8') as f:
+        return {row['barcode']: ([row[column] for column in REMARKS], row.get(DELTA_COLUMN))
+                for row in csv.DictReader(f)}
+
+@pytest.mark.parametrize('normalization', [None, FULL_NORMALIZATION])
+def test_incremental_runs_match_full_run(tmp_path, normalization):
+    records = invoice_records(3000, seed=7)
+    state_path = str(tmp_path / 'state')
+    remarks = {}
+    for run, rows in enumerate((1000, 1800, 3000)):
+        input_path = _write(tmp_path / f'input{run}.csv.gz', records[:rows + 1])
+        output_path = str(tmp_path / f'delta{run}.csv')
+        summary = process_invoice_delta(input_path, output_path, state_path, normalization=normalization)
+        for barcode, (row_remarks, status) in _remarks(output_path).items():
+            # Each row is written once as new, later only when its key turns duplicate
+            assert (barcode in remarks) == (status == 'reflagged')
+            remarks[barcode] = row_remarks
+
+    full_path = str(tmp_path / 'full.csv')
+    full_summary = process_invoice_file(input_path, full_path, normalization=normalization)
+    full = {barcode: row_remarks for barcode, (row_remarks, status) in _remarks(full_path).items()}
+    assert remarks == full
+    assert [summary[key] for key in DUPLICATE_COUNTS] == [full_summary[key] for key in DUPLICATE_COUNTS]
+    assert summary['incremental']['reflagged_rows'] > 0
@@ -0,0 +1,60 @@
+import csv
+import gzip
+import io
+import threading
+
+from duplicate_engine import RULES, process_invoice_file
+from key_history import KeyHistory
+
+from conftest import invoice_records
+
+def _write(path, records):
+    with gzip.open(path, 'wt', encoding='utf-8', newline='') as f:
+        csv.writer(f).writerows(records)
+    return str(path)
+
+def _run(path, history_path):
+    return process_invoice_file(path, io.StringIO(), history_path=history_path)['history']
+
+def test_rerun_of_same_upload_does_not_match_itself(invoice_file, tmp_path):
+    history_path = str(tmp_path / 'history.db')
+    path = invoice_file(2000)
+    assert _run(path, history_path) == dict.fromkeys(RULES, 0)
+    assert _run(path, history_path) == dict.fromkeys(RULES, 0)
+    history = KeyHistory(history_path)
+    try:
+        assert history.conn.execute('SELECT COUNT(*) FROM sources').fetchone()[0] == 1
+    finally:
+        history.close()
+
+def test_other_upload_with_same_keys_matches(tmp_path):
+    history_path = str(tmp_path / 'history.db')
+    records = invoice_records(2000)
+    _run(_write(tmp_path / 'jan.csv.gz', records), history_path)
+    history = _run(_write(tmp_path / 'feb.csv.gz', records + records[1:11]), history_path)
+    assert history['concat1'] > 0
+
+def test_concurrent_uploads_see_each_other(tmp_path):
+    records = invoice_records(3000)
+    paths = [_write(tmp_path / 'a.csv.gz', records[:2001]),
+             _write(tmp_path / 'b.csv.gz', [records[0]] + records[1001:])]
+    none = dict.fromkeys(RULES, 0)
+    _run(paths[0], str(tmp_path / 'a_first.db'))
+    b_second = _run(paths[1], str(tmp_path / 'a_first.db'))
+    _run(paths[1], str(tmp_path / 'b_first.db'))
+    a_second = _run(paths[0], str(tmp_path / 'b_first.db'))
+    assert b_second != none and a_second != none
+
+    history_path = str(tmp_path / 'history.db')
+    results = [None, None]
+
+    def run(i):
+        results[i] = _run(paths[i], history_path)
+
+    threads = [threading.Thread(target=run, args=(i,)) for i in range(2)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    # The same outcome as running them one after the other, in either order
+    assert results in ([none, b_second], [a_second, none])
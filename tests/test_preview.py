@@ -0,0 +1,25 @@
+import os
+
+from preview import preview_invoice_file
+
+def test_partial_upload_estimates_match_complete_file(invoice_file):
+    path = invoice_file(20000)
+    size = os.path.getsize(path)
+    total = preview_invoice_file(path, max_bytes=None)['lines_processed']
+
+    complete = preview_invoice_file(path, max_bytes=512 * 1024)
+    partial = preview_invoice_file(path, max_bytes=512 * 1024, available_bytes=size - 1)
+
+    assert not complete['complete'] and not partial['complete']
+    assert abs(partial['fraction_read'] - complete['fraction_read']) <= 0.01
+    assert abs(partial['estimated_lines_processed'] - complete['estimated_lines_processed']) <= 0.05 * total
+    assert abs(partial['estimated_lines_processed'] - total) <= 0.15 * total
+    for rule, estimate in complete['rules'].items():
+        assert abs(partial['rules'][rule]['estimated_duplicate_rows'] -
+                   estimate['estimated_duplicate_rows']) <= 0.05 * total
+
+def test_partial_upload_stops_at_available_bytes(invoice_file):
+    path = invoice_file(20000)
+    result = preview_invoice_file(path, max_bytes=None, available_bytes=os.path.getsize(path) // 2)
+    assert not result['complete']
+    assert 0.4 <= result['fraction_read'] <= 0.6
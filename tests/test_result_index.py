@@ -0,0 +1,45 @@
+import csv
+import io
+
+import pytest
+
+from duplicate_engine import OUTPUT_COLUMNS, process_invoice_file
+from result_index import query_results
+
+REMARKS = [column for column in OUTPUT_COLUMNS if column.endswith(' Remarks')]
+
+@pytest.fixture
+def indexed(invoice_file, tmp_path):
+    output = io.StringIO()
+    index_path = str(tmp_path / 'results.sqlite')
+    process_invoice_file(invoice_file(3000), output, index_path=index_path)
+    return list(csv.DictReader(io.StringIO(output.getvalue()))), index_path
+
+def _all_pages(index_path, **kwargs):
+    rows, cursor = [], None
+    while True:
+        page = query_results(index_path, cursor=cursor, limit=97, **kwargs)
+        rows += page['rows']
+        cursor = page['next_cursor']
+        if not cursor:
+            return rows
+
+def test_only_duplicates_are_indexed(indexed):
+    output, index_path = indexed
+    rows = _all_pages(index_path)
+    duplicates = [row['barcode'] for row in output if any(row[column] == 'Duplicate' for column in REMARKS)]
+    assert 0 < len(duplicates) < len(output)
+    assert [row['barcode'] for row in rows] == duplicates
+
+def test_filtered_pages_are_sorted(indexed):
+    _, index_path = indexed
+    rows = _all_pages(index_path, filters={'concat3': 'Duplicate'}, sort='amount', descending=True)
+    amounts = [float(row['invoice_amount']) for row in rows]
+    assert amounts and amounts == sorted(amounts, reverse=True)
+    assert all(row[REMARKS[2]] == 'Duplicate' for row in rows)
+
+@pytest.mark.parametrize('filters', [{'min_amount': 'abc'}, {'max_amount': 'nan'}])
+def test_non_numeric_amount_filter_is_rejected(indexed, filters):
+    _, index_path = indexed
+    with pytest.raises(ValueError, match='must be a number'):
+        query_results(index_path, filters=filters)